@@ -2,46 +2,150 @@ import sys
 import os
 import shutil
 import subprocess
-from PyQt5.QtWidgets import QLineEdit, QApplication, QWidget, QMainWindow,QHBoxLayout, QVBoxLayout, QCheckBox, QGridLayout, QFrame, QMessageBox, QFileDialog, QTextEdit , QProgressBar 
-from PyQt5.QtCore import Qt, QThread, pyqtSignal, QTimer
+import threading
+from collections import deque
+from functools import partial
+from PyQt5.QtWidgets import QLineEdit, QApplication, QWidget, QMainWindow,QHBoxLayout, QVBoxLayout, QCheckBox, QGridLayout, QFrame, QMessageBox, QFileDialog, QPlainTextEdit, QProgressBar, QScrollArea
+from PyQt5.QtCore import Qt, QObject, QThread, pyqtSignal, QTimer
 from PyQt5.QtGui import QIcon
 import widgets
-from mirror_util import list_dirs, list_os, manage_alma_download, manage_debian_download, manage_proxmox_download, manage_rocky_download
+from mirror_util import current_endpoint, rsync_url, list_mirror_dirs, list_os, discover, run_download_job, job_label, format_size, format_duration, JobLog, JobScheduler, DEFAULT_MAX_WORKERS, DEFAULT_PER_HOST_LIMIT, RSYNC_SHARDS, CONTENT_PROFILES, DEFAULT_CONTENT_PROFILE, content_filter, preflight, format_preflight, BANDWIDTH, BANDWIDTH_SCHEDULE, CACHE_DIR, JobControl, JobJournal, batch_jobs, ENGINE, indexed_size, parse_job_spec
+
+LOG_MAX_LINES = 5000
+LOG_FLUSH_INTERVAL_MS = 100
+# File des tâches de l'interface, proposée à la reprise à la connexion suivante
+GUI_JOURNAL_FILE = os.path.join(CACHE_DIR, "journal-gui.json")
+
+# Listages des distributions, lancés à la première sélection de l'OS : clé -> (chemin, exclude_dot_numbers).
+# Les chemins sont relatifs à la racine du serveur le plus rapide pour l'OS.
+DISTRIBUTION_TARGETS = {
+    "almalinux": {"almalinux": ("almalinux/", True)},
+    "debian": {"debian": ("debian/dists/", True)},
+    "proxmox": {
+        "proxmox:ceph-reef": ("proxmox/debian/ceph-reef/dists/", False),
+        "proxmox:ceph-squid": ("proxmox/debian/ceph-squid/dists/", False),
+        "proxmox:pbs": ("proxmox/debian/pbs/dists/", False),
+        "proxmox:pve": ("proxmox/debian/pve/dists/", False),
+    },
+    "rockylinux": {"rockylinux": ("rockylinux/", True)},
+}
+
+
+class DiscoveryThread(QThread):
+    result = pyqtSignal(str, list)
+
+    def __init__(self, tasks):
+        super().__init__()
+        self.tasks = tasks
 
-MIRROR_URL_ALMA = "https://mirror.sharlio.fr/almalinux/"
-MIRROR_URL_DEBIAN = "https://mirror.sharlio.fr/debian/dists/"
-MIRROR_URL_PROXMOX = "https://mirror.sharlio.fr/proxmox/debian/"
-MIRROR_URL_PROXMOX_PVE = "https://mirror.sharlio.fr/proxmox/debian/pve/dists/"
-MIRROR_URL_PROXMOX_PBS = "https://mirror.sharlio.fr/proxmox/debian/pbs/dists/"
-MIRROR_URL_PROXMOX_CEPH_REEF = "https://mirror.sharlio.fr/proxmox/debian/ceph-reef/dists/"
-MIRROR_URL_PROXMOX_CEPH_SQUID = "https://mirror.sharlio.fr/proxmox/debian/ceph-squid/dists/"
-MIRROR_URL_ROCKY = "https://mirror.sharlio.fr/rockylinux/"
+    def run(self):
+        discover(self.tasks, self.result.emit)
 
 
-class DownloadThread(QThread):
-    progress_text = pyqtSignal(str)
-    progress_percent = pyqtSignal(int)
+class IndexedSizeThread(QThread):
+    """Volumes des distributions d'après le dernier parcours HTTP (lecture des index en
+    cache, hors du thread de l'interface)."""
+    sizes = pyqtSignal(str, str, dict)
 
-    def __init__(self, os_name, distri, path, rsync_user):
+    def __init__(self, os_name, distris, profile):
         super().__init__()
         self.os_name = os_name
-        self.distri = distri
+        self.distris = distris
+        self.profile = profile
+
+    def run(self):
+        content = content_filter(self.profile)
+        sizes = {}
+        for distri in self.distris:
+            known = indexed_size(self.os_name, distri, content)
+            if known:
+                sizes[distri] = known
+        self.sizes.emit(self.os_name, self.profile, sizes)
+
+
+class PreflightThread(QThread):
+    report = pyqtSignal(object)
+    failed = pyqtSignal(str)
+
+    def __init__(self, jobs, path, rsync_user, job_options):
+        super().__init__()
+        self.jobs = jobs
+        self.path = path
+        self.rsync_user = rsync_user
+        self.job_options = job_options
+
+    def run(self):
+        # preflight n'intercepte que les erreurs attendues par tâche : toute autre doit
+        # quand même rendre la main à l'interface
+        try:
+            report = preflight(self.jobs, self.path, self.rsync_user, self.job_options)
+        except Exception as e:
+            self.failed.emit(f"{type(e).__name__}: {e}")
+            return
+        self.report.emit(report)
+
+
+class ProcessEventBridge(QObject):
+    """Relaie vers le thread de l'interface les événements des processus rsync/debmirror et
+    l'avancement des tâches, publiés depuis la boucle de mirror_util.ENGINE."""
+    event = pyqtSignal(dict)
+
+
+class LogBuffer:
+    """Lignes de journal en attente d'affichage, alimentées par les threads de téléchargement.
+    Seules les max_lines dernières sont gardées entre deux rafraîchissements de l'écran."""
+
+    def __init__(self, max_lines=LOG_MAX_LINES):
+        self.lines = deque(maxlen=max_lines)
+        self.lock = threading.Lock()
+
+    def append(self, line):
+        with self.lock:
+            self.lines.append(line)
+
+    def drain(self):
+        with self.lock:
+            lines = list(self.lines)
+            self.lines.clear()
+        return lines
+
+
+class DownloadThread(QThread):
+    job_done = pyqtSignal(object)
+
+    def __init__(self, job, path, rsync_user, log_buffer, options=None):
+        super().__init__()
+        self.job = job
+        self.os_name, self.distri = job
         self.path = path
         self.rsync_user = rsync_user
+        self.log_buffer = log_buffer
+        self.options = options or {}
+        self.result = None
+        self.control = JobControl()
 
     def run(self):
-        if self.os_name == "almalinux":
-            manage_alma_download(self.os_name, self.distri, self.path, self.rsync_user, text_callback=self.progress_text.emit,percent_callback=self.progress_percent.emit)
-        elif self.os_name == "debian":
-            manage_debian_download(self.os_name, self.distri, self.path, self.rsync_user, text_callback=self.progress_text.emit,percent_callback=self.progress_percent.emit)
-        elif self.os_name == "proxmox":
-            try:
-                proxmox_category, debian_dist = self.distri.split(':')
-                manage_proxmox_download(self.os_name, proxmox_category, debian_dist, self.path, self.rsync_user, text_callback=self.progress_text.emit,percent_callback=self.progress_percent.emit)
-            except ValueError:
-                self.progress_text.emit(f"ERREUR: Tâche Proxmox mal formée : {self.distri}")
-        elif self.os_name == "rockylinux":
-            manage_rocky_download(self.os_name, self.distri, self.path, self.rsync_user, text_callback=self.progress_text.emit,percent_callback=self.progress_percent.emit)
+        job_log = JobLog(self.job)
+        label = job_label(self.job)
+
+        def on_text(text):
+            job_log.write(text)
+            self.log_buffer.append(f"[{label}] {text}")
+
+        try:
+            result = self.result = run_download_job(self.os_name, self.distri, self.path, self.rsync_user,
+                                                    text_callback=on_text, control=self.control, **self.options)
+            if result.status == "skipped":
+                on_text("Bilan : miroir source inchangé, rien à synchroniser.")
+            elif result.status == "cancelled":
+                on_text(f"Bilan : tâche annulée après {format_size(result.bytes_transferred)} transférés.")
+            else:
+                on_text(f"Bilan : {format_size(result.bytes_transferred)} transférés, {result.files_new} nouveaux, "
+                        f"{result.files_updated} mis à jour, {result.files_deleted} supprimés en {format_duration(result.duration)}.")
+        finally:
+            job_log.close()
+            self.log_buffer.append(f"[{label}] Journal complet : {job_log.path}")
+            self.job_done.emit(self.job)
 
 
 class MainWindow(QMainWindow):
@@ -49,19 +153,35 @@ class MainWindow(QMainWindow):
         super().__init__()
 
         self.check = False
-        self.os = list_os()
-        self.alma = list_dirs(MIRROR_URL_ALMA, exclude=True, exclude_dot_numbers=True)
-        self.debian = list_dirs(MIRROR_URL_DEBIAN, exclude=True, exclude_dot_numbers=True)
-        self.proxmox = list_dirs(MIRROR_URL_PROXMOX, exclude=True, exclude_dot_numbers=False)
-        self.proxmox_pve = list_dirs(MIRROR_URL_PROXMOX_PVE, exclude=True, exclude_dot_numbers=False)
-        self.proxmox_pbs = list_dirs(MIRROR_URL_PROXMOX_PBS, exclude=True, exclude_dot_numbers=False)
-        self.proxmox_ceph_reef = list_dirs(MIRROR_URL_PROXMOX_CEPH_REEF, exclude=True, exclude_dot_numbers=False)
-        self.proxmox_ceph_squid = list_dirs(MIRROR_URL_PROXMOX_CEPH_SQUID, exclude=True, exclude_dot_numbers=False)
-        self.rocky = list_dirs(MIRROR_URL_ROCKY, exclude=True, exclude_dot_numbers=True)
+        self.os = []
+        self.os_distributions = {}
+        self.list_proxmox = {}
+        self.pending_discovery = set()
+        self.requested_distributions = set()
+        self.discovery_threads = []
+        self.size_threads = []
         self.launch_download = False
         self.download_dest_path = None
 
         self.distri_checkboxes = {}
+        self.scheduler = None
+        self.threads = {}
+        self.launch_options = {}
+        self.paused = False
+        self.cancelled = False
+        self.journal = JobJournal(GUI_JOURNAL_FILE)
+        self.job_rows = {}
+        self.job_stats_labels = {}
+        self.job_stats = {}
+        self.log_buffer = LogBuffer()
+        self.log_timer = QTimer(self)
+        self.log_timer.setInterval(LOG_FLUSH_INTERVAL_MS)
+        self.log_timer.timeout.connect(self.flush_log)
+        self.active_processes = set()
+        self.processes_label = None
+        self.process_events = ProcessEventBridge()
+        self.process_events.event.connect(self.process_event)
+        self.process_events_token = ENGINE.subscribe(self.process_events.event.emit, types=("start", "exit", "timeout", "percent", "stats"))
 
         self.setWindowTitle("Repolio")
         self.setWindowIcon(QIcon('SharlioLogo.ico'))
@@ -73,6 +193,8 @@ class MainWindow(QMainWindow):
             QTimer.singleShot(100, self.close)
 
         self.setup_ui()
+
+        self.start_discovery({"os": list_os})
     
     def check_dependencies(self):
         """Vérifie que rsync et debmirror sont installés."""
@@ -140,48 +262,130 @@ class MainWindow(QMainWindow):
         choose_repo_layout.setColumnStretch(1, 2)
         choose_repo_layout.setColumnStretch(2, 1)
 
-        self.os_distributions = {
-            "almalinux": self.alma,
-            "debian": self.debian,
-            "proxmox": self.proxmox,
-            "rockylinux": self.rocky
-        }
+        self.distri_layouts = {}
+        self.os_checkboxes = {}
+
+        self.os_layout = QGridLayout()
+        self.os_layout.setColumnStretch(0, 1)
+        self.os_layout.setColumnStretch(1, 3)
+        self.os_loading_label = widgets.create_label("Récupération des dépôts disponibles…")
+        self.os_layout.addWidget(self.os_loading_label, 0, 0, 1, 2)
+        choose_repo_layout.addLayout(self.os_layout, 0, 0, 1, 3)
+        current_row = 1
+
+        workers_layout = QHBoxLayout()
+        workers_layout.addWidget(widgets.create_label("Téléchargements simultanés :"))
+        self.input_workers = widgets.create_spinbox(1, 16, DEFAULT_MAX_WORKERS)
+        workers_layout.addWidget(self.input_workers)
+        workers_layout.addWidget(widgets.create_label("Par serveur :"))
+        self.input_per_host = widgets.create_spinbox(1, 16, DEFAULT_PER_HOST_LIMIT)
+        workers_layout.addWidget(self.input_per_host)
+        workers_layout.addWidget(widgets.create_label("Flux rsync par tâche (AlmaLinux/Rocky) :"))
+        self.input_shards = widgets.create_spinbox(1, 16, max(1, RSYNC_SHARDS))
+        workers_layout.addWidget(self.input_shards)
+        workers_layout.addWidget(widgets.create_label("Contenu :"))
+        self.content_profile = DEFAULT_CONTENT_PROFILE
+        profiles = [DEFAULT_CONTENT_PROFILE] + [name for name in CONTENT_PROFILES if name != DEFAULT_CONTENT_PROFILE]
+        workers_layout.addWidget(widgets.create_dropdown(profiles, self.set_content_profile, width=100))
+        self.force_checkbox = QCheckBox("Forcer (même si le miroir source n'a pas changé)")
+        workers_layout.addWidget(self.force_checkbox)
+        self.dedup_checkbox = QCheckBox("Dédupliquer (liens physiques)")
+        workers_layout.addWidget(self.dedup_checkbox)
+        workers_layout.addStretch(1)
+        choose_repo_layout.addLayout(workers_layout, current_row, 0, 1, 3)
+        current_row += 1
+
+        bandwidth_layout = QHBoxLayout()
+        bandwidth_layout.addWidget(widgets.create_label("Bande passante :"))
+        self.bandwidth_schedule = BANDWIDTH_SCHEDULE
+        bandwidth_layout.addWidget(self.create_bandwidth_input())
+        self.batch_checkbox = QCheckBox("Pool partagé entre distributions (Debian/Proxmox)")
+        bandwidth_layout.addWidget(self.batch_checkbox)
+        bandwidth_layout.addStretch(1)
+        choose_repo_layout.addLayout(bandwidth_layout, current_row, 0, 1, 3)
+        current_row += 1
+
+        self.button_download = widgets.create_button("Télécharger", self.button_download_pressed)
+        choose_repo_layout.addWidget(self.button_download, current_row, 0)
+        choose_repo_layout.setRowStretch(current_row + 1, 1)
+        self.choose_repo_widget.setLayout(choose_repo_layout)
 
-        self.list_proxmox = {
-            "ceph-reef": self.proxmox_ceph_reef,
-            "ceph-squid": self.proxmox_ceph_squid,
-            "pbs": self.proxmox_pbs,
-            "pve": self.proxmox_pve
-        }
+    def add_os_rows(self):
+        self.os_loading_label.setParent(None)
+        if not self.os:
+            self.os_layout.addWidget(widgets.create_label("Aucun dépôt disponible sur le miroir."), 0, 0, 1, 2)
+            return
 
-        self.distri_layouts = {}
-        
         current_row = 0
 
         for os_name in self.os:
             os_checkbox = QCheckBox(os_name, self)
+            self.os_checkboxes[os_name] = os_checkbox
             
             distri_layout = QVBoxLayout() 
             self.distri_layouts[os_name] = distri_layout
 
             os_checkbox.stateChanged.connect(lambda state, name=os_name: self.toggle_distributions(name, state))
 
-            choose_repo_layout.addWidget(os_checkbox, current_row, 0, Qt.AlignTop)
-            choose_repo_layout.addLayout(distri_layout, current_row, 1, Qt.AlignTop)
+            self.os_layout.addWidget(os_checkbox, current_row, 0, Qt.AlignTop)
+            self.os_layout.addLayout(distri_layout, current_row, 1, Qt.AlignTop)
             current_row += 1 
 
             separator = QFrame()
             separator.setFrameShape(QFrame.HLine) 
             separator.setFrameShadow(QFrame.Sunken)
             
-            choose_repo_layout.addWidget(separator, current_row, 0, 1, 3) 
+            self.os_layout.addWidget(separator, current_row, 0, 1, 2) 
             current_row += 1
 
-        button_download = widgets.create_button("Télécharger", self.button_download_pressed)
-        choose_repo_layout.addWidget(button_download, current_row, 0)
-        choose_repo_layout.setRowStretch(current_row + 1, 1)
-        self.choose_repo_widget.setLayout(choose_repo_layout)
+    def start_discovery(self, tasks):
+        self.pending_discovery.update(tasks)
+        thread = DiscoveryThread(tasks)
+        thread.result.connect(self.discovery_result)
+        self.discovery_threads.append(thread)
+        thread.start()
+
+    def load_distributions(self, os_name):
+        if os_name in self.requested_distributions:
+            return
+        self.requested_distributions.add(os_name)
+        targets = DISTRIBUTION_TARGETS.get(os_name, {})
+        if targets:
+            self.start_discovery({
+                key: partial(list_mirror_dirs, os_name, path, exclude=True, exclude_dot_numbers=exclude_dot_numbers)
+                for key, (path, exclude_dot_numbers) in targets.items()
+            })
+
+    def discovery_result(self, key, dirs):
+        self.pending_discovery.discard(key)
+        if key == "os":
+            self.os = dirs
+            self.add_os_rows()
+            return
+
+        os_name, _, category = key.partition(":")
+        if category:
+            self.list_proxmox[category] = dirs
+        else:
+            self.os_distributions[os_name] = dirs
+
+        checkbox = self.os_checkboxes.get(os_name)
+        if checkbox is not None and checkbox.isChecked():
+            self.refresh_distributions(os_name)
 
+    def is_discovery_pending(self, os_name):
+        return any(key == os_name or key.startswith(f"{os_name}:") for key in self.pending_discovery)
+
+    def refresh_distributions(self, os_name):
+        checked = {
+            (category, cb.text())
+            for category, checkboxes in self.distri_checkboxes.get(os_name, {}).items()
+            for cb in checkboxes if cb.isChecked()
+        }
+        self.toggle_distributions(os_name, Qt.Checked)
+        for category, checkboxes in self.distri_checkboxes[os_name].items():
+            for cb in checkboxes:
+                cb.setChecked((category, cb.text()) in checked)
 
     def connect_to_repo(self):
         self.rsync_user = self.input_user.text().strip()
@@ -193,8 +397,10 @@ class MainWindow(QMainWindow):
         
         os.environ["RSYNC_PASSWORD"] = rsync_pass
 
+        # Serveur réellement contacté : il change avec le classement et les bascules
+        endpoint = current_endpoint()
         try:
-            cmd = ["rsync", f"rsync://{self.rsync_user}@mirror.sharlio.fr/almalinux"]
+            cmd = ["rsync", rsync_url(self.rsync_user, "almalinux")]
             subprocess.run(cmd, check=True, capture_output=True, text=True, timeout=10)     
 
         except subprocess.CalledProcessError:
@@ -204,7 +410,7 @@ class MainWindow(QMainWindow):
             QMessageBox.critical(self, "Erreur", "La commande 'rsync' est introuvable.")
             return
         except subprocess.TimeoutExpired:
-            QMessageBox.critical(self, "Erreur de connexion", "Le serveur mirror.sharlio.fr ne répond pas (timeout).")
+            QMessageBox.critical(self, "Erreur de connexion", f"Le serveur {endpoint} ne répond pas (timeout).")
             return
         except Exception as e:
             QMessageBox.critical(self, "Erreur", f"Une erreur inconnue est survenue : {e}")
@@ -212,6 +418,23 @@ class MainWindow(QMainWindow):
 
         self.check = True
         self.show_choose_repo()
+        self.offer_resume()
+
+    def offer_resume(self):
+        unfinished = self.journal.unfinished()
+        if unfinished is None:
+            return
+        dest, jobs, job_options = unfinished
+        answer = QMessageBox.question(self, "Reprise",
+                                      f"Tâches non terminées lors de la dernière session (destination : {dest}) :\n"
+                                      + "\n".join(f"- {job_label(job)}" for job in jobs)
+                                      + "\n\nLes reprendre ? Les fichiers partiels déjà téléchargés seront réutilisés.",
+                                      QMessageBox.Yes | QMessageBox.No)
+        if answer != QMessageBox.Yes:
+            self.journal.clear()
+            return
+        self.download_dest_path = dest
+        self.launch_jobs(jobs, job_options)
 
     def toggle_distributions(self, os_name, state):
         layout = self.distri_layouts[os_name]
@@ -224,8 +447,14 @@ class MainWindow(QMainWindow):
         self.distri_checkboxes[os_name] = {} 
     
         if state == Qt.Checked:
+            self.load_distributions(os_name)
+            if self.is_discovery_pending(os_name):
+                loading_label = widgets.create_label("Chargement…")
+                loading_label.setStyleSheet("color: #888;")
+                layout.addWidget(loading_label)
+
             if os_name == "proxmox":
-                for category, dists in self.list_proxmox.items():
+                for category, dists in sorted(self.list_proxmox.items()):
                     if not dists:
                         continue 
                     category_label = widgets.create_label(category)
@@ -251,6 +480,24 @@ class MainWindow(QMainWindow):
                     cb = QCheckBox(distri)
                     layout.addWidget(cb)
                     self.distri_checkboxes[os_name]['main'].append(cb)
+                self.load_indexed_sizes(os_name)
+
+    def load_indexed_sizes(self, os_name):
+        distris = self.os_distributions.get(os_name, [])
+        if os_name not in ("almalinux", "rockylinux") or not distris:
+            return
+        thread = IndexedSizeThread(os_name, distris, self.content_profile)
+        thread.sizes.connect(self.indexed_sizes_result)
+        self.size_threads.append(thread)
+        thread.start()
+
+    def indexed_sizes_result(self, os_name, profile, sizes):
+        if profile != self.content_profile:
+            return
+        for cb in self.distri_checkboxes.get(os_name, {}).get('main', []):
+            known = sizes.get(cb.text())
+            cb.setToolTip(f"{format_size(known['bytes'])} ({known['files']} fichiers, profil {profile}) "
+                          f"d'après le dernier parcours du miroir" if known else "")
     
     def get_selected_distributions(self):
         selected = {}
@@ -279,18 +526,6 @@ class MainWindow(QMainWindow):
             QMessageBox.information(self, "Aucune sélection", "Veuillez sélectionner au moins un OS et une version.")
             return
 
-        recap_text = "Vous avez sélectionné :\n"
-
-        for os_name, data in selected.items():
-            if os_name == "proxmox":
-                recap_text += f"- {os_name}:\n"
-                for category, dists in data.items():
-                    recap_text += f"  - {category}: {', '.join(dists)}\n"
-            else:
-                recap_text += f"- {os_name} : {', '.join(data)}\n"
-
-        QMessageBox.information(self, "Récapitulatif des sélections", recap_text)
-
         self.download_dest_path = QFileDialog.getExistingDirectory(
             self, "Choisir un dossier de destination", ""
         )
@@ -299,64 +534,246 @@ class MainWindow(QMainWindow):
             QMessageBox.information(self, "Annulé", "Téléchargement annulé : aucun dossier choisi.")
             return
 
-        self.launch_download = True
-        self.download_queue = []
+        jobs = []
         
         for os_name, data in selected.items():
             if os_name == "proxmox":
                 for category, dists in data.items():
                     for deb_dist in dists:
-                        self.download_queue.append((os_name, f"{category}:{deb_dist}"))
+                        jobs.append((os_name, f"{category}:{deb_dist}"))
             else:
                 for distri in data:
-                    self.download_queue.append((os_name, distri))
+                    jobs.append((os_name, distri))
+        if self.batch_checkbox.isChecked():
+            jobs, _ = batch_jobs(jobs)
+
+        self.selected_distributions = selected
+        self.button_download.setEnabled(False)
+        self.statusBar().showMessage("Estimation des volumes à télécharger…")
+        self.preflight_thread = PreflightThread(jobs, self.download_dest_path, self.rsync_user,
+                                                {job: self.job_options() for job in jobs})
+        self.preflight_thread.report.connect(self.preflight_finished)
+        self.preflight_thread.failed.connect(self.preflight_failed)
+        self.preflight_thread.start()
+
+    def preflight_failed(self, error):
+        self.preflight_thread.wait()
+        self.button_download.setEnabled(True)
+        self.statusBar().clearMessage()
+        QMessageBox.critical(self, "Erreur", f"Estimation des volumes impossible : {error}")
+
+    def preflight_finished(self, report):
+        self.preflight_thread.wait()
+        self.button_download.setEnabled(True)
+        self.statusBar().clearMessage()
+
+        recap_text = "Vous avez sélectionné :\n"
 
-        self.download_next()
-        print("Dossier de destination :", self.download_dest_path)
-        print("Distributions sélectionnées :", selected) 
-        print("File d'attente des tâches :", self.download_queue) 
+        for os_name, data in self.selected_distributions.items():
+            if os_name == "proxmox":
+                recap_text += f"- {os_name}:\n"
+                for category, dists in data.items():
+                    recap_text += f"  - {category}: {', '.join(dists)}\n"
+            else:
+                recap_text += f"- {os_name} : {', '.join(data)}\n"
+
+        recap_text += "\nEstimation :\n" + "\n".join(format_preflight(report))
+        if not report["ok"]:
+            recap_text += "\n\nATTENTION : l'espace disque libre semble insuffisant."
+        recap_text += f"\n\nDestination : {self.download_dest_path}\nLancer le téléchargement ?"
+
+        answer = QMessageBox.question(self, "Récapitulatif des sélections", recap_text,
+                                      QMessageBox.Yes | QMessageBox.No,
+                                      QMessageBox.Yes if report["ok"] else QMessageBox.No)
+        if answer != QMessageBox.Yes:
+            QMessageBox.information(self, "Annulé", "Téléchargement annulé.")
+            return
+
+        jobs = list(report["jobs"])
+        sizes = {job: estimate["bytes"] for job, estimate in report["jobs"].items() if estimate}
+        # Options de l'estimation : un réglage modifié pendant celle-ci ne s'applique pas
+        job_options = self.preflight_thread.job_options
+        self.launch_jobs(jobs, {job: job_options[job] for job in jobs}, sizes)
+
+    def launch_jobs(self, jobs, job_options, sizes=None):
+        self.launch_download = True
+        self.launch_options = job_options
+        self.paused = False
+        self.cancelled = False
+        try:
+            self.journal.start(self.download_dest_path, jobs, job_options)
+        except OSError as e:
+            self.log_buffer.append(f"ERREUR: Impossible d'écrire le journal des tâches. {e}")
+        self.scheduler = JobScheduler(jobs, max_workers=self.input_workers.value(), per_host_limit=self.input_per_host.value(),
+                                      sizes=sizes)
+        self.log_buffer.append(f"Destination : {self.download_dest_path} ; file d'attente : "
+                               + ", ".join(job_label(job) for job in self.scheduler.pending))
+        self.show_progress_page(self.scheduler.pending)
+        self.start_ready_jobs()
+
+    def job_options(self):
+        return {"shards": self.input_shards.value(), "content": content_filter(self.content_profile),
+                "force": self.force_checkbox.isChecked(), "dedup": self.dedup_checkbox.isChecked()}
+
+    def create_bandwidth_input(self):
+        bandwidth_input = widgets.create_text_input("illimité, 5M ou 08:00-19:00=5M,19:00-08:00=0", width=360)
+        bandwidth_input.setText(self.bandwidth_schedule)
+        bandwidth_input.editingFinished.connect(lambda: self.set_bandwidth(bandwidth_input))
+        return bandwidth_input
+
+    def set_bandwidth(self, bandwidth_input):
+        schedule = bandwidth_input.text().strip()
+        if schedule == self.bandwidth_schedule:
+            return
+        try:
+            BANDWIDTH.configure(schedule)
+        except ValueError as e:
+            QMessageBox.warning(self, "Bande passante", str(e))
+            bandwidth_input.setText(self.bandwidth_schedule)
+            return
+        self.bandwidth_schedule = schedule
+        self.log_buffer.append(f"Budget de bande passante : {schedule or 'illimité'}")
+
+    def set_content_profile(self, profile):
+        self.content_profile = profile
+        for os_name, categories in self.distri_checkboxes.items():
+            if categories:
+                self.load_indexed_sizes(os_name)
 
     def show_choose_repo(self):
         self.auth_widget.setParent(None)
         self.setCentralWidget(self.choose_repo_widget)
 
-    def show_progressBar(self, os_name, distri):
+    def show_progress_page(self, jobs):
         self.progress_widget = QWidget()
         layout = QVBoxLayout()
 
+        self.total_stats_label = widgets.create_label("")
+        self.total_stats_label.setStyleSheet("font-weight: bold;")
+        layout.addWidget(self.total_stats_label)
+        self.processes_label = widgets.create_label("")
+        layout.addWidget(self.processes_label)
+
+        bandwidth_layout = QHBoxLayout()
+        bandwidth_layout.addWidget(widgets.create_label("Bande passante :"))
+        bandwidth_layout.addWidget(self.create_bandwidth_input())
+        bandwidth_layout.addStretch(1)
+        layout.addLayout(bandwidth_layout)
+
+        jobs_widget = QWidget()
+        jobs_layout = QGridLayout()
+        jobs_layout.setColumnStretch(1, 1)
+        self.job_rows = {}
+        self.job_stats_labels = {}
+        self.job_stats = {}
+        for row, job in enumerate(jobs):
+            bar = QProgressBar()
+            bar.setRange(0, 100)
+            bar.setFormat("%p%")
+            stats_label = widgets.create_label("")
+            status = widgets.create_label("En attente")
+            jobs_layout.addWidget(widgets.create_label(job_label(job)), row, 0)
+            jobs_layout.addWidget(bar, row, 1)
+            jobs_layout.addWidget(stats_label, row, 2)
+            jobs_layout.addWidget(status, row, 3)
+            self.job_rows[job] = (bar, status)
+            self.job_stats_labels[job] = stats_label
+        jobs_widget.setLayout(jobs_layout)
+
+        jobs_area = QScrollArea()
+        jobs_area.setWidgetResizable(True)
+        jobs_area.setWidget(jobs_widget)
+        layout.addWidget(jobs_area)
+
         log_layout = QHBoxLayout()
         self.show_log_button = widgets.create_button("+", self.toggle_log)
         self.log_visible = False
         log_layout.addWidget(self.show_log_button)
         layout.addLayout(log_layout)
 
-        self.progress_text = QTextEdit()
+        self.progress_text = QPlainTextEdit()
         self.progress_text.setReadOnly(True)
+        self.progress_text.setMaximumBlockCount(LOG_MAX_LINES)
         self.progress_text.setVisible(False)  
         layout.addWidget(self.progress_text)
 
-        self.progress_bar = QProgressBar()
-        self.progress_bar.setRange(0, 100)
-        self.progress_bar.setFormat("%p%")  
-        layout.addWidget(self.progress_bar)
-
-        cancel_button = widgets.create_button("Annuler", self.cancel_download)
-        layout.addWidget(cancel_button)
+        buttons_layout = QHBoxLayout()
+        self.pause_button = widgets.create_button("Pause", self.toggle_pause)
+        buttons_layout.addWidget(self.pause_button)
+        self.cancel_button = widgets.create_button("Annuler", self.cancel_download)
+        buttons_layout.addWidget(self.cancel_button)
+        buttons_layout.addStretch(1)
+        layout.addLayout(buttons_layout)
 
         self.progress_widget.setLayout(layout)
         self.setCentralWidget(self.progress_widget)
+        self.log_timer.start()
 
-        self.thread = DownloadThread(os_name, distri, self.download_dest_path,self.rsync_user)
-        self.thread.progress_text.connect(self.update_progress_text)
-        self.thread.progress_percent.connect(self.update_progress_percent)
-        self.thread.finished.connect(self.download_finished)
-        self.thread.start()
+    def start_ready_jobs(self):
+        if self.paused:
+            return
+        for job in self.scheduler.next_jobs():
+            thread = DownloadThread(job, self.download_dest_path, self.rsync_user, self.log_buffer, self.launch_options.get(job))
+            thread.job_done.connect(self.download_finished)
+            self.threads[job] = thread
+            self.job_rows[job][1].setText("En cours")
+            self.set_journal_state(job, "running")
+            thread.start()
+
+    def toggle_pause(self):
+        self.paused = not self.paused
+        for job, thread in self.threads.items():
+            if self.paused:
+                thread.control.pause()
+            else:
+                thread.control.resume()
+            self.job_rows[job][1].setText("En pause" if self.paused else "En cours")
+        self.pause_button.setText("Reprendre" if self.paused else "Pause")
+        self.log_buffer.append("Téléchargements suspendus." if self.paused else "Téléchargements repris.")
+        if not self.paused:
+            self.start_ready_jobs()
 
     def cancel_download(self):
-        if hasattr(self, "thread") and self.thread.isRunning():
-            self.thread.terminate()
-            self.progress_text.append("\nTéléchargement annulé.")
-            self.progress_bar.setValue(0)
+        if self.scheduler is None or self.cancelled:
+            return
+        # Les tâches en cours s'arrêtent d'elles-mêmes : download_finished les marque annulées
+        self.cancelled = True
+        self.pause_button.setEnabled(False)
+        self.cancel_button.setEnabled(False)
+        for job in self.scheduler.cancel_pending():
+            self.job_rows[job][1].setText("Annulé")
+        for job, thread in self.threads.items():
+            thread.control.cancel()
+            self.job_rows[job][1].setText("Annulation…")
+        self.log_buffer.append("Téléchargement annulé.")
+        if self.scheduler.is_done():
+            self.all_downloads_finished()
+
+    def process_event(self, event):
+        # L'avancement des tâches arrive par ENGINE comme les événements de leurs processus
+        if event["type"] in ("percent", "stats"):
+            job = parse_job_spec(event["job"])
+            if job not in self.job_rows:
+                return
+            if event["type"] == "percent":
+                self.update_progress_percent(job, event["percent"])
+            else:
+                self.update_progress_stats(job, event["stats"])
+            return
+        if event["type"] == "start":
+            self.active_processes.add(event["pid"])
+        elif event["type"] == "exit":
+            self.active_processes.discard(event["pid"])
+        elif event["type"] == "timeout":
+            self.log_buffer.append(f"[{event['job']}] Aucune sortie depuis {event['idle']} s : processus {event['pid']} arrêté.")
+        if self.processes_label is not None:
+            self.processes_label.setText(f"Processus rsync/debmirror actifs : {len(self.active_processes)}")
+
+    def set_journal_state(self, job, state):
+        try:
+            self.journal.set_state(job, state)
+        except OSError as e:
+            self.log_buffer.append(f"ERREUR: Impossible d'écrire le journal des tâches. {e}")
 
     def clear_layout(self,layout):
         while layout.count():
@@ -367,34 +784,79 @@ class MainWindow(QMainWindow):
                 self.clear_layout(child.layout())
 
 
-    def download_next(self):
-        if not self.download_queue:
-            self.all_downloads_finished()
+    def download_finished(self, job):
+        thread = self.threads.pop(job, None)
+        if thread is None:
             return
-        os_name, distri = self.download_queue.pop(0)
-        self.show_progressBar(os_name, distri)
-
-    def download_finished(self):
-        self.progress_text.append("\nTéléchargement terminé.")
-        self.progress_bar.setValue(100)
-        QTimer.singleShot(100, self.download_next)
+        thread.wait()
+        self.scheduler.job_done(job)
+        state = thread.result.status if thread.result is not None else "failed"
+        self.set_journal_state(job, state)
+        bar, status = self.job_rows[job]
+        if state == "cancelled":
+            status.setText("Annulé")
+            self.log_buffer.append(f"[{job_label(job)}] Téléchargement annulé.")
+        else:
+            bar.setValue(100)
+            status.setText({"failed": "Échec", "skipped": "À jour"}.get(state, "Terminé"))
+            self.log_buffer.append(f"[{job_label(job)}] Téléchargement terminé.")
+        if self.scheduler.is_done():
+            self.all_downloads_finished()
+        else:
+            self.start_ready_jobs()
 
     def toggle_log(self):
         self.log_visible = not self.log_visible
         self.progress_text.setVisible(self.log_visible)
         self.show_log_button.setText("-" if self.log_visible else "+")
 
-    def update_progress_text(self, text):
-        self.progress_text.append(text)
+    def flush_log(self):
+        lines = self.log_buffer.drain()
+        if not lines:
+            return
+        self.progress_text.appendPlainText("\n".join(lines))
         self.progress_text.verticalScrollBar().setValue(
             self.progress_text.verticalScrollBar().maximum()
         )
 
-    def update_progress_percent(self, value):
-        self.progress_bar.setValue(value)
+    def update_progress_percent(self, job, value):
+        self.job_rows[job][0].setValue(value)
+
+    def update_progress_stats(self, job, stats):
+        self.job_stats[job] = stats
+        self.job_stats_labels[job].setText(self.format_stats(stats["bytes_done"], stats["bytes_total"], stats["rate"], stats["eta"]))
+
+        running = [self.job_stats[j] for j in self.scheduler.running if j in self.job_stats]
+        bytes_done = sum(s["bytes_done"] for s in self.job_stats.values())
+        bytes_total = sum(s["bytes_total"] for s in self.job_stats.values())
+        rate = sum(s["rate"] for s in running)
+        eta = (bytes_total - bytes_done) / rate if rate > 0 and bytes_total else None
+        self.total_stats_label.setText(f"Total : {self.format_stats(bytes_done, bytes_total, rate, eta)}")
+
+    @staticmethod
+    def format_stats(bytes_done, bytes_total, rate, eta):
+        size = f"{format_size(bytes_done)} / {format_size(bytes_total)}" if bytes_total else format_size(bytes_done)
+        return f"{size} · {format_size(rate)}/s · reste {format_duration(eta)}"
 
     def all_downloads_finished(self):
-        QMessageBox.information(self, "Terminé", "Tous les téléchargements sont terminés.")
+        self.flush_log()
+        self.pause_button.setEnabled(False)
+        self.cancel_button.setEnabled(False)
+        if self.cancelled:
+            QMessageBox.information(self, "Annulé", "Téléchargement annulé. Les tâches non terminées pourront être "
+                                                    "reprises à la prochaine connexion.")
+        else:
+            QMessageBox.information(self, "Terminé", "Tous les téléchargements sont terminés.")
+
+    def closeEvent(self, event):
+        # Les processus rsync/debmirror ont leur propre groupe et survivraient à la fenêtre ;
+        # le journal garde les tâches interrompues pour la prochaine connexion
+        for thread in self.threads.values():
+            thread.control.cancel()
+        for thread in self.threads.values():
+            thread.wait()
+        ENGINE.unsubscribe(self.process_events_token)
+        super().closeEvent(event)
 
 if __name__ == "__main__":
     app = QApplication(sys.argv)
@@ -0,0 +1,330 @@
+"""Banc de mesure hors ligne de mirror_util.
+
+Démarre un démon rsync et un serveur HTTP locaux qui servent des arborescences Debian et RPM
+synthétiques, puis chronomètre la synchronisation initiale, la resynchronisation sans
+changement, la resynchronisation après une petite modification, le listage des dépôts et le
+débit des analyseurs de progression. Les résultats peuvent être enregistrés comme référence
+puis comparés aux exécutions suivantes :
+
+    python3 mirror_bench.py --save-baseline bench_baseline.json
+    python3 mirror_bench.py --compare bench_baseline.json
+"""
+import argparse
+import gzip
+import hashlib
+import json
+import lzma
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+import mirror_crawl
+import mirror_metrics
+import mirror_util
+
+BENCH_USER = "bench"
+DEFAULT_TOLERANCE = 0.2
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def _wait_for_port(port, timeout=10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=0.5):
+                return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError(f"Le port {port} ne répond pas après {timeout} s")
+
+def _write_file(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(data)
+
+
+def make_rpm_tree(root, os_name, release, files, file_size, seed=0):
+    """Crée <root>/<os_name>/<release>/{BaseOS,AppStream}/x86_64/os avec files paquets au total."""
+    rng = random.Random(seed)
+    repos = ("BaseOS", "AppStream")
+    for i in range(files):
+        repo = repos[i % len(repos)]
+        path = os.path.join(root, os_name, release, repo, "x86_64", "os", "Packages", f"bench-{i:06d}-1.0-1.el9.x86_64.rpm")
+        _write_file(path, rng.randbytes(file_size))
+    for repo in repos:
+        repomd = f"<repomd><revision>{seed}</revision><data type=\"primary\"/></repomd>\n"
+        _write_file(os.path.join(root, os_name, release, repo, "x86_64", "os", "repodata", "repomd.xml"), repomd.encode())
+
+def _release_file(dist, components, index_files):
+    lines = [
+        "Origin: Bench",
+        f"Suite: {dist}",
+        f"Codename: {dist}",
+        "Architectures: amd64",
+        f"Components: {' '.join(components)}",
+        f"Date: {time.strftime('%a, %d %b %Y %H:%M:%S UTC', time.gmtime())}",
+    ]
+    for field, algo in (("MD5Sum", hashlib.md5), ("SHA256", hashlib.sha256)):
+        lines.append(f"{field}:")
+        for name, data in sorted(index_files.items()):
+            lines.append(f" {algo(data).hexdigest()} {len(data):>16} {name}")
+    return ("\n".join(lines) + "\n").encode()
+
+def make_debian_tree(root, dist, packages, file_size, seed=0, components=("main", "non-free", "non-free-firmware")):
+    """Crée une archive Debian minimale mais valide (pool/, Packages, Sources et Release) sous <root>/debian."""
+    rng = random.Random(seed)
+    archive = os.path.join(root, "debian")
+    stanzas = []
+    for i in range(packages):
+        name = f"bench{i:06d}"
+        relpath = f"pool/main/b/{name}/{name}_1.0-1_amd64.deb"
+        data = rng.randbytes(file_size)
+        _write_file(os.path.join(archive, relpath), data)
+        stanzas.append(
+            f"Package: {name}\nVersion: 1.0-1\nArchitecture: amd64\nFilename: {relpath}\n"
+            f"Size: {len(data)}\nMD5sum: {hashlib.md5(data).hexdigest()}\nSHA256: {hashlib.sha256(data).hexdigest()}\n"
+        )
+
+    index_files = {}
+    for component in components:
+        packages_data = ("\n".join(stanzas) if component == "main" else "").encode()
+        for subdir, name, data in (("binary-amd64", "Packages", packages_data), ("source", "Sources", b"")):
+            base = f"{component}/{subdir}/{name}"
+            index_files[base] = data
+            index_files[f"{base}.gz"] = gzip.compress(data, mtime=0)
+            index_files[f"{base}.xz"] = lzma.compress(data)
+    for name, data in index_files.items():
+        _write_file(os.path.join(archive, "dists", dist, name), data)
+    _write_file(os.path.join(archive, "dists", dist, "Release"), _release_file(dist, components, index_files))
+
+def mutate_tree(root, fraction, seed=1):
+    """Réécrit une fraction des fichiers de root et en ajoute autant : petite mise à jour amont."""
+    rng = random.Random(seed)
+    paths = sorted(
+        os.path.join(dirpath, name)
+        for dirpath, _, names in os.walk(root) for name in names
+        if name.endswith((".rpm", ".deb"))
+    )
+    count = max(1, int(len(paths) * fraction))
+    for path in rng.sample(paths, count):
+        size = os.path.getsize(path)
+        _write_file(path, rng.randbytes(size))
+        base, ext = os.path.splitext(path)
+        _write_file(f"{base}-update{ext}", rng.randbytes(size))
+    return count
+
+
+def start_rsync_daemon(workdir, modules):
+    port = _free_port()
+    config_path = os.path.join(workdir, "rsyncd.conf")
+    with open(config_path, "w", encoding="utf-8") as f:
+        f.write("use chroot = no\nnumeric ids = yes\n")
+        for name, path in modules.items():
+            f.write(f"[{name}]\n    path = {path}\n    read only = yes\n")
+    process = subprocess.Popen(
+        ["rsync", "--daemon", "--no-detach", f"--config={config_path}", f"--port={port}",
+         "--address=127.0.0.1", f"--log-file={os.path.join(workdir, 'rsyncd.log')}"],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    _wait_for_port(port)
+    return process, port
+
+class _QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+def start_http_server(root):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), partial(_QuietHandler, directory=root))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, server.server_address[1]
+
+
+def _timed(fn, *args, **kwargs):
+    started = time.perf_counter()
+    value = fn(*args, **kwargs)
+    return time.perf_counter() - started, value
+
+def _sync(os_name, distri, dest, force=True):
+    elapsed, result = _timed(mirror_util.run_download_job, os_name, distri, dest, BENCH_USER, force=force)
+    if result.exit_code != 0:
+        raise RuntimeError(f"{os_name}:{distri} a échoué (code {result.exit_code})")
+    return elapsed
+
+def bench_parsers(lines=100_000):
+    rsync_lines = [f"  {i * 1024:,}  {i * 100 // lines}%   12.34MB/s    0:01:{i % 60:02d} (xfr#{i}, to-chk={lines - i}/{lines})" for i in range(1, lines + 1)]
+    debmirror_lines = [f"[{i * 100 // lines:3d}%] Getting: pool/main/b/bench{i:06d}/bench{i:06d}_1.0-1_amd64.deb" for i in range(lines)]
+
+    progress = mirror_util.TransferProgress()
+    rsync_time, _ = _timed(lambda: [mirror_util._parse_rsync_progress(line, None, progress) for line in rsync_lines])
+    progress = mirror_util.TransferProgress()
+    progress.update(0, lines * 1024)
+    debmirror_time, _ = _timed(lambda: [mirror_util._parse_debmirror_progress(line, True, None, progress) for line in debmirror_lines])
+    page = ("<pre>" + "".join(f'<a href="bench{i:06d}.rpm">bench{i:06d}.rpm</a>    01-May-2024 12:00    {i * 1024}\n'
+                              for i in range(lines)) + "</pre>").encode()
+    listing_time, _ = _timed(lambda: mirror_crawl.read_listing(_StaticPage(page)))
+    return {"parse_rsync_progress": rsync_time, "parse_debmirror_progress": debmirror_time, "parse_autoindex": listing_time}
+
+class _StaticPage:
+    # Réponse HTTP minimale pour mirror_crawl.read_listing
+    headers = {"Content-Type": "text/html; charset=utf-8"}
+
+    def __init__(self, body):
+        self.body = body
+
+    def iter_content(self, chunk_size):
+        for start in range(0, len(self.body), chunk_size):
+            yield self.body[start:start + chunk_size]
+
+def bench_discovery(http_url):
+    try:
+        import requests  # noqa: F401
+    except ImportError:
+        print("requests absent : mesures de listage ignorées.", file=sys.stderr)
+        return {}
+
+    def discover_all():
+        mirror_util.list_os()
+        for url in (f"{http_url}almalinux/", f"{http_url}rockylinux/", f"{http_url}debian/dists/"):
+            mirror_util.list_dirs(url)
+
+    results = {}
+    shutil.rmtree(mirror_util.LISTING_CACHE_DIR, ignore_errors=True)
+    results["discovery_cold"], _ = _timed(discover_all)
+    results["discovery_warm"], _ = _timed(discover_all)
+    ttl = mirror_util.LISTING_CACHE_TTL
+    mirror_util.LISTING_CACHE_TTL = 0
+    try:
+        results["discovery_revalidate"], _ = _timed(discover_all)
+    finally:
+        mirror_util.LISTING_CACHE_TTL = ttl
+
+    def crawl(ttl):
+        index = mirror_crawl.RemoteIndex("almalinux/9/").load()
+        index.crawl(mirror_util._get_session(), http_url, ttl=ttl)
+
+    shutil.rmtree(mirror_crawl.CRAWL_DIR, ignore_errors=True)
+    results["crawl_cold"], _ = _timed(lambda: crawl(0))
+    results["crawl_revalidate"], _ = _timed(lambda: crawl(0))
+    return results
+
+def run_benchmarks(files, file_size, delta, parser_lines, keep_workdir=False):
+    if shutil.which("rsync") is None:
+        raise RuntimeError("rsync est introuvable")
+
+    workdir = tempfile.mkdtemp(prefix="sharlio-bench-")
+    daemon = server = None
+    results = {}
+    try:
+        upstream = os.path.join(workdir, "upstream")
+        make_rpm_tree(upstream, "almalinux", "9", files, file_size)
+        make_rpm_tree(upstream, "rockylinux", "9", files, file_size, seed=1)
+        make_debian_tree(upstream, "bookworm", files, file_size)
+
+        daemon, rsync_port = start_rsync_daemon(workdir, {
+            "almalinux": os.path.join(upstream, "almalinux"),
+            "rockylinux": os.path.join(upstream, "rockylinux"),
+            "debian": os.path.join(upstream, "debian"),
+        })
+        server, http_port = start_http_server(upstream)
+        http_url = f"http://127.0.0.1:{http_port}/"
+
+        mirror_util.configure_mirror(host="127.0.0.1", url=http_url, rsync_port=rsync_port)
+        mirror_util.LISTING_CACHE_DIR = os.path.join(workdir, "listings")
+        mirror_crawl.CRAWL_DIR = os.path.join(workdir, "crawl")
+        mirror_util.STAGING_DIR = os.path.join(workdir, "staging")
+        mirror_util.FRESHNESS_DIR = os.path.join(workdir, "freshness")
+        mirror_metrics.METRICS_DIR = mirror_metrics.TEXTFILE_DIR = os.path.join(workdir, "metrics")
+        dest = os.path.join(workdir, "mirror")
+
+        results["rpm_cold_sync"] = _sync("almalinux", "9", dest)
+        results["rpm_noop_resync"] = _sync("almalinux", "9", dest)
+        results["rpm_probe_skip"] = _sync("almalinux", "9", dest, force=False)
+        mutate_tree(os.path.join(upstream, "almalinux"), delta)
+        results["rpm_delta_resync"] = _sync("almalinux", "9", dest)
+
+        if shutil.which("debmirror"):
+            results["debian_cold_sync"] = _sync("debian", "bookworm", dest)
+            results["debian_noop_resync"] = _sync("debian", "bookworm", dest)
+        else:
+            print("debmirror absent : mesures Debian ignorées.", file=sys.stderr)
+
+        results.update(bench_discovery(http_url))
+        results.update(bench_parsers(parser_lines))
+    finally:
+        if server:
+            server.shutdown()
+        if daemon:
+            daemon.terminate()
+            daemon.wait()
+        if keep_workdir:
+            print(f"Dossier de travail conservé : {workdir}", file=sys.stderr)
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+    return results
+
+
+def compare(results, baseline, tolerance=DEFAULT_TOLERANCE):
+    """Affiche l'écart à la référence et renvoie les mesures plus lentes de plus de tolerance."""
+    regressions = []
+    print(f"{'mesure':<28}{'référence':>12}{'actuel':>12}{'écart':>10}")
+    for name, value in results.items():
+        reference = baseline.get(name)
+        if reference is None:
+            print(f"{name:<28}{'-':>12}{value:>12.3f}{'-':>10}")
+            continue
+        change = (value - reference) / reference if reference else 0.0
+        flag = "  <-- régression" if change > tolerance else ""
+        print(f"{name:<28}{reference:>12.3f}{value:>12.3f}{change:>+10.1%}{flag}")
+        if change > tolerance:
+            regressions.append(name)
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="mirror_bench", description="Banc de mesure hors ligne de mirror_util.")
+    parser.add_argument("--files", type=int, default=2000, help="nombre de paquets par arborescence synthétique")
+    parser.add_argument("--file-size", type=int, default=64 * 1024, help="taille de chaque paquet en octets")
+    parser.add_argument("--delta", type=float, default=0.01, help="fraction des paquets modifiés avant la resynchronisation partielle")
+    parser.add_argument("--parser-lines", type=int, default=100_000, help="nombre de lignes pour les mesures des analyseurs")
+    parser.add_argument("--save-baseline", help="enregistre les résultats comme référence dans ce fichier")
+    parser.add_argument("--compare", help="compare les résultats au fichier de référence")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE, help="ralentissement toléré avant de signaler une régression")
+    parser.add_argument("--keep-workdir", action="store_true", help="conserve les arborescences générées")
+    args = parser.parse_args(argv)
+
+    try:
+        results = run_benchmarks(args.files, args.file_size, args.delta, args.parser_lines, args.keep_workdir)
+    except RuntimeError as e:
+        print(f"ERREUR: {e}", file=sys.stderr)
+        return mirror_util.EXIT_USAGE
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w", encoding="utf-8") as f:
+            json.dump({
+                "params": {"files": args.files, "file_size": args.file_size, "delta": args.delta, "parser_lines": args.parser_lines},
+                "results": results,
+            }, f, indent=2)
+            f.write("\n")
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)["results"]
+        return mirror_util.EXIT_JOB_FAILED if compare(results, baseline, args.tolerance) else mirror_util.EXIT_OK
+
+    for name, value in results.items():
+        print(f"{name:<28}{value:>12.3f} s")
+    return mirror_util.EXIT_OK
+
+
+if __name__ == "__main__":
+    sys.exit(main())
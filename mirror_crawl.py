@@ -0,0 +1,297 @@
+"""Parcours HTTP des pages d'index (autoindex) d'un miroir.
+
+read_listing() lit une page d'index Apache, nginx ou lighttpd au fil du téléchargement, sans
+construire d'arbre HTML, et en extrait le nom, la taille et la date de chaque entrée.
+RemoteIndex parcourt en parallèle une arborescence du miroir et mémorise ces entrées dans un
+index local compressé. Les listages récents sont réutilisés, les autres revalidés par requête
+conditionnelle ; l'index répond ensuite aux questions de taille et de changement sans rsync.
+"""
+import calendar
+import codecs
+import gzip
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from html.parser import HTMLParser
+from urllib.parse import quote, unquote, urlsplit
+
+CRAWL_DIR = os.environ.get("SHARLIO_CRAWL_DIR", os.path.join(os.path.expanduser("~"), ".cache", "sharlio-mirror-temp", "crawl"))
+CRAWL_WORKERS = int(os.environ.get("SHARLIO_CRAWL_WORKERS", 8))
+# Durée (s) pendant laquelle le listage d'un dossier est réutilisé sans interroger le miroir
+CRAWL_TTL = int(os.environ.get("SHARLIO_CRAWL_TTL", 6 * 3600))
+# Garde-fou contre les boucles de liens symboliques côté serveur
+CRAWL_MAX_DEPTH = 16
+CRAWL_TIMEOUT = 10
+LISTING_CHUNK = 64 * 1024
+SIZE_UNITS = {"": 1, "K": 1024, "M": 1024 ** 2, "G": 1024 ** 3, "T": 1024 ** 4, "P": 1024 ** 5}
+MONTHS = {name: number for number, name in enumerate(
+    ("jan", "feb", "mar", "apr", "may", "jun", "jul", "aug", "sep", "oct", "nov", "dec"), 1)}
+
+# "2024-05-01 12:00" (Apache), "01-May-2024 12:00" (nginx), "2024-May-01 12:00:00" (lighttpd),
+# suivi de la taille : "-" pour un dossier, "1234" ou "1.2K"
+_ENTRY_META_RE = re.compile(
+    r"(?:(\d{4})-(\d{2}|[A-Za-z]{3})-(\d{1,2})|(\d{1,2})-([A-Za-z]{3})-(\d{4}))[ T]+(\d{1,2}):(\d{2})(?::(\d{2}))?"
+    r"\s+(?:(-)|(\d+(?:\.\d+)?)\s?([KMGTP]?)i?B?\b)", re.IGNORECASE)
+_CHARSET_RE = re.compile(r"charset=[\"']?([\w.-]+)", re.IGNORECASE)
+
+
+def _parse_meta(text):
+    # (taille, mtime, taille exacte) lus dans le texte qui suit le lien
+    match = _ENTRY_META_RE.search(text)
+    if not match:
+        return None, None, True
+    year, month, day, day2, month2, year2, hour, minute, second, dash, number, unit = match.groups()
+    if year is None:
+        year, month, day = year2, month2, day2
+    month = int(month) if month.isdigit() else MONTHS.get(month.lower())
+    try:
+        mtime = calendar.timegm((int(year), month, int(day), int(hour), int(minute), int(second or 0)))
+    except (TypeError, ValueError, OverflowError):
+        mtime = None
+    if dash or number is None:
+        return None, mtime, True
+    unit = unit.upper()
+    return int(float(number) * SIZE_UNITS[unit]), mtime, not unit and "." not in number
+
+
+class _AutoindexParser(HTMLParser):
+    """Analyseur incrémental : une entrée par lien relatif, complétée par le texte qui le suit
+    jusqu'au lien ou à la ligne de tableau suivants (les balises y comptent pour une espace)."""
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.entries = []
+        self.exact = True
+        self._href = None
+        self._in_link = False
+        self._tail = []
+
+    def handle_starttag(self, tag, attrs):
+        if tag == "a":
+            self._flush()
+            self._href = dict(attrs).get("href")
+            self._in_link = True
+        elif tag in ("tr", "li"):
+            self._flush()
+        elif self._href is not None:
+            self._tail.append(" ")
+
+    def handle_endtag(self, tag):
+        if tag == "a":
+            self._in_link = False
+        elif tag in ("tr", "li", "pre", "table", "ul"):
+            self._flush()
+        elif self._href is not None:
+            self._tail.append(" ")
+
+    def handle_data(self, data):
+        if self._href is not None and not self._in_link:
+            self._tail.append(data)
+
+    def close(self):
+        super().close()
+        self._flush()
+
+    def _flush(self):
+        href, tail = self._href, self._tail
+        self._href, self._tail = None, []
+        if not href:
+            return
+        parts = urlsplit(href)
+        if parts.scheme or parts.netloc or parts.query or not parts.path or parts.path.startswith("/"):
+            return
+        path = unquote(parts.path)
+        if path.startswith("./"):
+            path = path[2:]
+        name = path.rstrip("/")
+        if not name or "/" in name or name in (".", ".."):
+            return
+        size, mtime, exact = _parse_meta("".join(tail))
+        self.exact = self.exact and exact
+        if path.endswith("/"):
+            self.entries.append([name + "/", None, mtime])
+        else:
+            self.entries.append([name, size, mtime])
+
+
+def _response_encoding(response):
+    match = _CHARSET_RE.search(response.headers.get("Content-Type", ""))
+    return match.group(1) if match else "utf-8"
+
+def read_listing(response):
+    """Entrées de la page d'index response (requête lancée avec stream=True), lue par morceaux.
+    Renvoie (entrées, tailles exactes) : chaque entrée vaut [nom, taille, mtime] ; le nom des
+    sous-dossiers se termine par "/", taille et mtime valent None quand la page ne les donne
+    pas. Les tailles sont approchées si la page les arrondit ("1.2K")."""
+    try:
+        decoder = codecs.getincrementaldecoder(_response_encoding(response))(errors="replace")
+    except LookupError:
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    parser = _AutoindexParser()
+    for chunk in response.iter_content(LISTING_CHUNK):
+        parser.feed(decoder.decode(chunk))
+    parser.feed(decoder.decode(b"", final=True))
+    parser.close()
+    return parser.entries, parser.exact
+
+def size_matches(local_size, remote_size, exact=True):
+    """Vrai si la taille locale correspond à celle de l'index, arrondie à 5 % près si inexacte."""
+    if exact:
+        return local_size == remote_size
+    return abs(local_size - remote_size) <= remote_size // 20 + 1
+
+
+class RemoteIndex:
+    """Index local de l'arborescence HTTP root (chemin relatif à la racine du miroir, ex.
+    "almalinux/9/"), mémorisé dans CRAWL_DIR.
+    dirs vaut {chemin relatif du dossier: {"entries", "exact", "etag", "last_modified", "checked"}}."""
+
+    def __init__(self, root):
+        self.root = root.strip("/") + "/"
+        self.path = os.path.join(CRAWL_DIR, hashlib.sha256(self.root.encode()).hexdigest() + ".json.gz")
+        self.dirs = {}
+        self.crawled = None
+        self.url = None
+        self._lock = threading.Lock()
+
+    def load(self):
+        try:
+            with gzip.open(self.path, "rt", encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError, EOFError):
+            data = {}
+        self.dirs = data.get("dirs", {})
+        self.crawled = data.get("crawled")
+        self.url = data.get("url")
+        return self
+
+    def save(self):
+        os.makedirs(CRAWL_DIR, exist_ok=True)
+        tmp_path = f"{self.path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with gzip.open(tmp_path, "wt", encoding="utf-8") as f:
+            json.dump({"root": self.root, "url": self.url, "crawled": self.crawled, "dirs": self.dirs},
+                      f, ensure_ascii=False, separators=(",", ":"))
+        os.replace(tmp_path, self.path)
+
+    def _visit(self, session, base_url, relpath, known, ttl, timeout):
+        import requests
+
+        now = time.time()
+        if known and now - known.get("checked", 0) < ttl:
+            return known, "cached"
+        headers = {}
+        if known and known.get("etag"):
+            headers["If-None-Match"] = known["etag"]
+        if known and known.get("last_modified"):
+            headers["If-Modified-Since"] = known["last_modified"]
+        try:
+            with session.get(base_url + quote(self.root + relpath), headers=headers, timeout=timeout, stream=True) as response:
+                if response.status_code == 304 and known:
+                    return dict(known, checked=now), "revalidated"
+                response.raise_for_status()
+                entries, exact = read_listing(response)
+                etag, last_modified = response.headers.get("ETag"), response.headers.get("Last-Modified")
+        except (requests.exceptions.RequestException, OSError):
+            return known, "errors"
+        return {"entries": entries, "exact": exact, "etag": etag, "last_modified": last_modified, "checked": now}, "fetched"
+
+    def crawl(self, session, base_url, include=None, ttl=CRAWL_TTL, workers=CRAWL_WORKERS,
+              timeout=CRAWL_TIMEOUT, text_callback=None):
+        """Parcourt l'arborescence sous base_url + root en parallèle et met à jour l'index.
+
+        include(chemin relatif du dossier, terminé par "/") renvoie faux pour ne pas descendre
+        dans un dossier : son listage précédent est conservé tel quel. Un dossier injoignable
+        garde lui aussi son dernier listage connu ; les dossiers disparus sont retirés.
+        Renvoie {"dirs", "fetched", "revalidated", "cached", "errors", "changes"} ; changes
+        (voir diff) vaut None au premier parcours. L'index n'est pas enregistré si la racine
+        est injoignable."""
+        with self._lock:
+            previous = self.dirs
+            current = {}
+            stats = {"dirs": 0, "fetched": 0, "revalidated": 0, "cached": 0, "errors": 0}
+            reported = 0
+            with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+                pending = {executor.submit(self._visit, session, base_url, "", previous.get(""), ttl, timeout): ""}
+                while pending:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        relpath = pending.pop(future)
+                        listing, outcome = future.result()
+                        stats[outcome] += 1
+                        if listing is None:
+                            continue
+                        current[relpath] = listing
+                        if relpath.count("/") >= CRAWL_MAX_DEPTH:
+                            continue
+                        for name, _, _ in listing["entries"]:
+                            child = relpath + name
+                            if not name.endswith("/") or (include and not include(child)):
+                                continue
+                            pending[executor.submit(self._visit, session, base_url, child, previous.get(child), ttl, timeout)] = child
+                    if text_callback and len(current) >= reported + 100:
+                        reported = len(current)
+                        text_callback(f"{self.root} : {reported} dossiers parcourus…")
+
+            if "" not in current:
+                return dict(stats, changes=None)
+            if include:
+                for relpath, listing in previous.items():
+                    if relpath not in current and not all(include(ancestor) for ancestor in _ancestors(relpath)):
+                        current[relpath] = listing
+            stats["dirs"] = len(current)
+            stats["changes"] = diff_dirs(previous, current) if previous else None
+            self.dirs = current
+            self.crawled = time.time()
+            self.url = base_url + quote(self.root)
+            self.save()
+            return stats
+
+    def files(self, prefix=""):
+        """(chemin relatif, taille, mtime, taille exacte) de chaque fichier indexé sous prefix."""
+        for relpath, listing in self.dirs.items():
+            if not relpath.startswith(prefix):
+                continue
+            for name, size, mtime in listing["entries"]:
+                if not name.endswith("/"):
+                    yield relpath + name, size, mtime, listing.get("exact", True)
+
+    def total(self, prefix="", keep=None):
+        """{"bytes", "files", "unknown"} des fichiers sous prefix retenus par keep(chemin
+        relatif) ; unknown compte les fichiers dont la page d'index ne donne pas la taille."""
+        totals = {"bytes": 0, "files": 0, "unknown": 0}
+        for relpath, size, _, _ in self.files(prefix):
+            if keep and not keep(relpath):
+                continue
+            totals["files"] += 1
+            if size is None:
+                totals["unknown"] += 1
+            else:
+                totals["bytes"] += size
+        return totals
+
+    def newest(self, prefix=""):
+        """Date de modification la plus récente sous prefix, ou None."""
+        return max((mtime for _, _, mtime, _ in self.files(prefix) if mtime is not None), default=None)
+
+
+def _ancestors(relpath):
+    parts = relpath.rstrip("/").split("/")
+    return ["/".join(parts[:i]) + "/" for i in range(1, len(parts) + 1)]
+
+def _file_map(dirs):
+    return {relpath + name: (size, mtime)
+            for relpath, listing in dirs.items() for name, size, mtime in listing["entries"] if not name.endswith("/")}
+
+def diff_dirs(previous, current):
+    """Fichiers ajoutés, modifiés (taille ou date) et supprimés entre deux états de
+    RemoteIndex.dirs : {"added", "changed", "removed"}, listes de chemins relatifs triées."""
+    before, after = _file_map(previous), _file_map(current)
+    return {
+        "added": sorted(after.keys() - before.keys()),
+        "changed": sorted(path for path in after.keys() & before.keys() if after[path] != before[path]),
+        "removed": sorted(before.keys() - after.keys()),
+    }
@@ -0,0 +1,297 @@
+"""Déduplication des miroirs locaux par liens physiques.
+
+Un index persistant associe chaque fichier du dossier de destination à sa taille, sa date de
+modification, son inode et son empreinte SHA256. Seuls les fichiers nouveaux ou modifiés
+sont relus, et seulement quand un autre fichier a la même taille. Les fichiers identiques
+(taille, SHA256 et, par défaut, date de modification) sont remplacés par des liens physiques
+vers un même inode. L'index sert aussi à pré-remplir un staging avant téléchargement, et
+reference_args() choisit les dossiers --link-dest/--copy-dest des tâches rsync.
+"""
+import errno
+import hashlib
+import json
+import os
+import shutil
+import stat as stat_module
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+DEDUP_DIR = os.environ.get("SHARLIO_DEDUP_DIR", os.path.join(os.path.expanduser("~"), ".cache", "sharlio-mirror-temp", "dedup"))
+DEDUP_WORKERS = int(os.environ.get("SHARLIO_DEDUP_WORKERS", 4))
+# Les petits fichiers coûtent plus en inodes et en lectures qu'ils ne font gagner
+DEDUP_MIN_SIZE = int(os.environ.get("SHARLIO_DEDUP_MIN_SIZE", 64 * 1024))
+# Deux fichiers liés partagent leur date de modification : si elle diffère en amont, rsync -t
+# retransfère l'un d'eux à chaque synchronisation et le lien est défait aussitôt
+DEDUP_MATCH_MTIME = os.environ.get("SHARLIO_DEDUP_MATCH_MTIME", "1") != "0"
+# Métadonnées réécrites à chaque synchronisation et dossiers de travail : jamais liés. Les
+# instantanés Debian/Proxmox sont des liens vers leur staging : c'est lui qu'on déduplique
+DEDUP_SKIP_DIRS = ("dists", "repodata", ".delta", ".rsync-partial", ".temp", ".staging", ".snapshots")
+# Nombre maximal de dossiers --link-dest/--copy-dest acceptés par rsync
+RSYNC_MAX_ALT_DEST = 20
+
+_index_locks = {}
+_index_locks_lock = threading.Lock()
+
+
+def _index_lock(root):
+    with _index_locks_lock:
+        return _index_locks.setdefault(os.path.realpath(root), threading.Lock())
+
+def _sha256_file(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def _replace_with(source, path, link=True):
+    # Place une copie ou un lien de source à la place de path, sans fenêtre où path manque
+    tmp_path = os.path.join(os.path.dirname(path), f".{os.path.basename(path)}.{os.getpid()}.dedup")
+    try:
+        if link:
+            os.link(source, tmp_path)
+        else:
+            shutil.copy2(source, tmp_path)
+        os.replace(tmp_path, path)
+    except OSError:
+        if os.path.lexists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+class DedupIndex:
+    """Index (taille, SHA256) -> fichiers du dossier root, mémorisé dans DEDUP_DIR.
+    Chaque entrée vaut [taille, mtime_ns, périphérique, inode, sha256 ou None]."""
+
+    def __init__(self, root):
+        self.root = os.path.realpath(root)
+        self.path = os.path.join(DEDUP_DIR, hashlib.sha256(self.root.encode()).hexdigest() + ".json")
+        self.files = {}
+        self._by_digest = None
+
+    def load(self):
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                self.files = json.load(f)
+        except (OSError, ValueError):
+            self.files = {}
+        self._by_digest = None
+        return self
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self.files, f)
+        os.replace(tmp_path, self.path)
+
+    def _current(self, relpath):
+        # Vrai si le fichier n'a pas changé depuis son indexation
+        entry = self.files.get(relpath)
+        try:
+            stat = os.lstat(os.path.join(self.root, relpath))
+        except OSError:
+            return False
+        return entry is not None and [stat.st_size, stat.st_mtime_ns, stat.st_dev, stat.st_ino] == entry[:4]
+
+    def lookup(self, size, sha256):
+        """Chemin absolu d'un fichier indexé de contenu (size, sha256) encore intact, ou None."""
+        if self._by_digest is None:
+            self._by_digest = {}
+            for relpath, entry in self.files.items():
+                if entry[4]:
+                    self._by_digest.setdefault((entry[0], entry[4]), []).append(relpath)
+        for relpath in self._by_digest.get((size, sha256), ()):
+            if self._current(relpath):
+                return os.path.join(self.root, relpath)
+        return None
+
+    def scan(self, subdirs=None, workers=DEDUP_WORKERS, min_size=DEDUP_MIN_SIZE, text_callback=None):
+        """Met l'index à jour pour les sous-dossiers donnés (tout root par défaut). Les fichiers
+        inchangés gardent leur empreinte ; les autres ne sont relus que si un fichier d'un
+        autre inode a la même taille. Renvoie (fichiers parcourus, octets relus)."""
+        prefixes = []
+        for subdir in subdirs or [self.root]:
+            relative = os.path.relpath(os.path.realpath(subdir), self.root)
+            if relative == os.curdir:
+                prefixes = [""]
+                break
+            if not relative.startswith(os.pardir):
+                prefixes.append(relative + os.sep)
+
+        seen = {}
+        for prefix in prefixes:
+            top = os.path.join(self.root, prefix)
+            for dirpath, dirs, files in os.walk(top):
+                dirs[:] = [name for name in dirs if name not in DEDUP_SKIP_DIRS]
+                for name in files:
+                    path = os.path.join(dirpath, name)
+                    try:
+                        stat = os.lstat(path)
+                    except OSError:
+                        continue
+                    if not stat_module.S_ISREG(stat.st_mode) or stat.st_size < min_size:
+                        continue
+                    relpath = os.path.relpath(path, self.root)
+                    key = [stat.st_size, stat.st_mtime_ns, stat.st_dev, stat.st_ino]
+                    known = self.files.get(relpath)
+                    seen[relpath] = known if known and known[:4] == key else key + [None]
+        # Les fichiers disparus sont oubliés : ceux des dossiers parcourus, et ceux des dossiers
+        # supprimés ailleurs (anciens instantanés)
+        existing_dirs = {}
+        for relpath in list(self.files):
+            if relpath in seen:
+                continue
+            parent = os.path.dirname(relpath)
+            if parent not in existing_dirs:
+                existing_dirs[parent] = os.path.isdir(os.path.join(self.root, parent))
+            if any(relpath.startswith(prefix) for prefix in prefixes) or not existing_dirs[parent]:
+                del self.files[relpath]
+        self.files.update(seen)
+        self._by_digest = None
+
+        inodes_by_size = {}
+        for entry in self.files.values():
+            inodes_by_size.setdefault(entry[0], set()).add((entry[2], entry[3]))
+        # Les chemins d'un même inode (mêmes taille et date) ne sont relus qu'une fois
+        digests = {tuple(entry[:4]): entry[4] for entry in self.files.values() if entry[4]}
+        to_hash = {}
+        for relpath, entry in self.files.items():
+            key = tuple(entry[:4])
+            if entry[4] is None and key not in digests and len(inodes_by_size[entry[0]]) > 1:
+                to_hash.setdefault(key, relpath)
+
+        bytes_hashed = sum(self.files[relpath][0] for relpath in to_hash.values())
+        if to_hash and text_callback:
+            text_callback(f"Déduplication : {len(to_hash)} fichiers à relire.")
+
+        def digest(item):
+            key, relpath = item
+            try:
+                return key, _sha256_file(os.path.join(self.root, relpath))
+            except OSError:
+                return key, None
+
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+            digests.update(dict(executor.map(digest, to_hash.items())))
+        for entry in self.files.values():
+            if entry[4] is None:
+                entry[4] = digests.get(tuple(entry[:4]))
+        return len(seen), bytes_hashed
+
+    def link_duplicates(self, match_mtime=DEDUP_MATCH_MTIME, dry_run=False, text_callback=None):
+        """Remplace les copies identiques par des liens physiques vers le même inode (celui qui
+        a déjà le plus de chemins). Avec match_mtime, seules les copies de même date de
+        modification sont liées. Renvoie {"linked", "bytes_saved", "unlinked"}, unlinked
+        étant le nombre de copies identiques restées distinctes (dates différentes) ;
+        bytes_saved ne compte que les inodes dont tous les liens ont été remplacés."""
+        groups = {}
+        for relpath, entry in sorted(self.files.items()):
+            if entry[4]:
+                mtime = entry[1] // 10**9 if match_mtime else None
+                groups.setdefault((entry[0], entry[4], entry[2], mtime), []).append(relpath)
+
+        linked = 0
+        bytes_saved = 0
+        for (size, _, _, _), relpaths in groups.items():
+            by_inode = {}
+            for relpath in relpaths:
+                by_inode.setdefault(self.files[relpath][3], []).append(relpath)
+            if len(by_inode) < 2:
+                continue
+            canonical = max(by_inode.values(), key=len)[0]
+            reference = self.files[canonical]
+            for inode, paths in by_inode.items():
+                if inode == reference[3]:
+                    continue
+                try:
+                    links = os.lstat(os.path.join(self.root, paths[0])).st_nlink
+                except OSError:
+                    continue
+                done = 0
+                for relpath in paths:
+                    if not self._current(relpath) or not self._current(canonical):
+                        continue
+                    if not dry_run:
+                        try:
+                            _replace_with(os.path.join(self.root, canonical), os.path.join(self.root, relpath))
+                        except OSError as e:
+                            if e.errno != errno.EMLINK and text_callback:
+                                text_callback(f"ERREUR: lien impossible pour {relpath}. {e}")
+                            continue
+                        self.files[relpath] = list(reference)
+                    done += 1
+                linked += done
+                # Un inode encore lié ailleurs (hors de l'index) ne libère rien
+                if done == links:
+                    bytes_saved += size
+
+        copies = {}
+        for (size, sha256, device, _), relpaths in groups.items():
+            copies.setdefault((size, sha256, device), set()).update(self.files[relpath][3] for relpath in relpaths)
+        self._by_digest = None
+        return {"linked": linked, "bytes_saved": bytes_saved,
+                "unlinked": sum(len(inodes) - 1 for inodes in copies.values())}
+
+def dedup_tree(root, subdirs=None, workers=DEDUP_WORKERS, match_mtime=DEDUP_MATCH_MTIME, dry_run=False, text_callback=None):
+    """Met à jour l'index de root pour subdirs (tout root par défaut) puis lie les fichiers
+    identiques de tout root. Renvoie le bilan de link_duplicates complété de "scanned" et
+    "bytes_hashed". Les passes sur un même root sont sérialisées."""
+    with _index_lock(root):
+        index = DedupIndex(root).load()
+        scanned, bytes_hashed = index.scan(subdirs, workers, text_callback=text_callback)
+        report = index.link_duplicates(match_mtime, dry_run, text_callback)
+        if not dry_run:
+            index.save()
+    report.update(scanned=scanned, bytes_hashed=bytes_hashed)
+    return report
+
+def seed_files(root, dest_root, entries, text_callback=None):
+    """Place dans dest_root les fichiers {chemin relatif: (taille, sha256)} déjà présents
+    sous root d'après son index : lien physique sur le même système de fichiers, copie
+    locale sinon. Renvoie les chemins relatifs ainsi obtenus, sans téléchargement."""
+    with _index_lock(root):
+        index = DedupIndex(root).load()
+    seeded = []
+    for relpath, (size, sha256) in entries.items():
+        if not sha256 or size < DEDUP_MIN_SIZE:
+            continue
+        source = index.lookup(size, sha256)
+        if source is None:
+            continue
+        path = os.path.join(dest_root, relpath)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        try:
+            try:
+                _replace_with(source, path)
+            except OSError as e:
+                if e.errno not in (errno.EXDEV, errno.EMLINK, errno.EPERM):
+                    raise
+                _replace_with(source, path, link=False)
+        except OSError as e:
+            if text_callback:
+                text_callback(f"ERREUR: pré-remplissage impossible pour {relpath}. {e}")
+            continue
+        seeded.append(relpath)
+    return seeded
+
+def reference_args(target_dir, candidates):
+    """Options rsync --link-dest (même système de fichiers que target_dir) ou --copy-dest
+    (sinon) pour les dossiers candidats existants, dans l'ordre et dans la limite acceptée
+    par rsync : un fichier identique y est repris localement au lieu d'être téléchargé."""
+    try:
+        device = os.stat(target_dir).st_dev
+    except OSError:
+        return []
+    args = []
+    seen = {os.path.realpath(target_dir)}
+    for candidate in candidates:
+        real = os.path.realpath(candidate)
+        if real in seen or not os.path.isdir(real):
+            continue
+        seen.add(real)
+        option = "--link-dest" if os.stat(real).st_dev == device else "--copy-dest"
+        args.append(f"{option}={real}")
+        if len(args) == RSYNC_MAX_ALT_DEST:
+            break
+    return args
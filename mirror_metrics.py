@@ -0,0 +1,179 @@
+"""Métriques des synchronisations.
+
+Chaque tâche produit un SyncResult : statut, code de sortie, serveur, durée de chaque phase,
+octets et fichiers transférés, débits, processus lancés et arrêtés. write_metrics() ajoute
+ce bilan à sync-results.jsonl (une ligne JSON par tâche, historique complet), garde le
+dernier bilan de chaque tâche dans latest.json et régénère sharlio_mirror.prom, lu par le
+textfile collector de node_exporter (SHARLIO_TEXTFILE_DIR, par défaut SHARLIO_METRICS_DIR).
+"""
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+METRICS_DIR = os.environ.get("SHARLIO_METRICS_DIR", os.path.join(os.path.expanduser("~"), ".cache", "sharlio-mirror-temp", "metrics"))
+# Dossier lu par le textfile collector de node_exporter (par défaut METRICS_DIR)
+TEXTFILE_DIR = os.environ.get("SHARLIO_TEXTFILE_DIR", METRICS_DIR)
+RESULTS_FILE = "sync-results.jsonl"
+LATEST_FILE = "latest.json"
+PROM_FILE = "sharlio_mirror.prom"
+
+_metrics_lock = threading.Lock()
+
+
+class SyncResult:
+    """Bilan d'une tâche : statut, octets et fichiers transférés, durée de chaque phase et débits."""
+
+    def __init__(self, job_name):
+        self.job = job_name
+        self.exit_code = None
+        self.started = time.time()
+        self.finished = None
+        self.phases = {}
+        self.bytes_transferred = 0
+        self.files_new = 0
+        self.files_updated = 0
+        self.files_deleted = 0
+        self.peak_throughput = 0.0
+        self.skipped = False
+        self.cancelled = False
+        self.endpoint = None
+        self.processes = 0
+        self.timeouts = 0
+
+    @contextmanager
+    def phase(self, name):
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.phases[name] = self.phases.get(name, 0.0) + time.monotonic() - started
+
+    def add_changes(self, new=0, updated=0, deleted=0):
+        self.files_new += new
+        self.files_updated += updated
+        self.files_deleted += deleted
+
+    def add_transfer(self, bytes_transferred, peak_throughput=0.0):
+        self.bytes_transferred += bytes_transferred
+        self.peak_throughput = max(self.peak_throughput, peak_throughput)
+
+    def process_event(self, event):
+        """Abonné aux événements des processus (mirror_util.ENGINE) : compte les processus
+        lancés par la tâche et ceux arrêtés faute de sortie."""
+        if event.get("job") != self.job:
+            return
+        if event["type"] == "start":
+            self.processes += 1
+        elif event["type"] == "timeout":
+            self.timeouts += 1
+
+    def finish(self, exit_code):
+        self.exit_code = exit_code
+        self.finished = time.time()
+        return self
+
+    @property
+    def status(self):
+        if self.exit_code is None:
+            return "running"
+        if self.cancelled:
+            return "cancelled"
+        if self.exit_code != 0:
+            return "failed"
+        return "skipped" if self.skipped else "ok"
+
+    @property
+    def duration(self):
+        return (self.finished or time.time()) - self.started
+
+    @property
+    def avg_throughput(self):
+        transfer_time = self.phases.get("download", 0.0)
+        return self.bytes_transferred / transfer_time if transfer_time > 0 else 0.0
+
+    def as_dict(self):
+        return {
+            "job": self.job,
+            "status": self.status,
+            "exit_code": self.exit_code,
+            "endpoint": self.endpoint,
+            "started": self.started,
+            "duration": round(self.duration, 3),
+            "phases": {name: round(seconds, 3) for name, seconds in self.phases.items()},
+            "bytes_transferred": self.bytes_transferred,
+            "files_new": self.files_new,
+            "files_updated": self.files_updated,
+            "files_deleted": self.files_deleted,
+            "avg_throughput": round(self.avg_throughput, 1),
+            "peak_throughput": round(self.peak_throughput, 1),
+            "processes": self.processes,
+            "timeouts": self.timeouts,
+        }
+
+
+def _escape_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def render_prometheus(records):
+    """Met en forme les derniers bilans de chaque tâche au format texte de Prometheus."""
+    metrics = [
+        ("sharlio_mirror_sync_success", "1 si la dernière synchronisation a réussi", lambda r: [({}, 1 if r["status"] in ("ok", "skipped") else 0)]),
+        ("sharlio_mirror_sync_skipped", "1 si la dernière synchronisation a été ignorée (miroir source inchangé)",
+         lambda r: [({}, 1 if r["status"] == "skipped" else 0)]),
+        ("sharlio_mirror_sync_cancelled", "1 si la dernière synchronisation a été annulée",
+         lambda r: [({}, 1 if r["status"] == "cancelled" else 0)]),
+        ("sharlio_mirror_sync_exit_code", "Code de sortie de la dernière synchronisation", lambda r: [({}, r["exit_code"] if r["exit_code"] is not None else -1)]),
+        ("sharlio_mirror_sync_last_run_timestamp_seconds", "Heure de début de la dernière synchronisation", lambda r: [({}, r["started"])]),
+        ("sharlio_mirror_sync_duration_seconds", "Durée de la dernière synchronisation, au total et par phase",
+         lambda r: [({"phase": "total"}, r["duration"])] + [({"phase": name}, seconds) for name, seconds in sorted(r["phases"].items())]),
+        ("sharlio_mirror_sync_bytes", "Octets transférés lors de la dernière synchronisation", lambda r: [({}, r["bytes_transferred"])]),
+        ("sharlio_mirror_sync_files", "Fichiers créés, mis à jour et supprimés lors de la dernière synchronisation",
+         lambda r: [({"change": "new"}, r["files_new"]), ({"change": "updated"}, r["files_updated"]), ({"change": "deleted"}, r["files_deleted"])]),
+        ("sharlio_mirror_sync_throughput_bytes_per_second", "Débit moyen et maximal de la dernière synchronisation",
+         lambda r: [({"stat": "avg"}, r["avg_throughput"]), ({"stat": "peak"}, r["peak_throughput"])]),
+        ("sharlio_mirror_sync_processes", "Processus rsync/debmirror lancés lors de la dernière synchronisation",
+         lambda r: [({}, r.get("processes", 0))]),
+        ("sharlio_mirror_sync_timeouts", "Processus arrêtés faute de sortie lors de la dernière synchronisation",
+         lambda r: [({}, r.get("timeouts", 0))]),
+    ]
+    lines = []
+    for name, help_text, samples in metrics:
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} gauge")
+        for record in sorted(records, key=lambda r: r["job"]):
+            for labels, value in samples(record):
+                labels = {"job": record["job"], **labels}
+                label_text = ",".join(f'{key}="{_escape_label(val)}"' for key, val in labels.items())
+                lines.append(f"{name}{{{label_text}}} {value}")
+    return "\n".join(lines) + "\n"
+
+def _write_atomic(path, data):
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+def write_metrics(result, metrics_dir=None, textfile_dir=None):
+    """Ajoute le bilan à sync-results.jsonl et régénère le fichier .prom avec le dernier
+    bilan de chaque tâche."""
+    metrics_dir = metrics_dir or METRICS_DIR
+    textfile_dir = textfile_dir or TEXTFILE_DIR
+    record = result.as_dict()
+    with _metrics_lock:
+        os.makedirs(metrics_dir, exist_ok=True)
+        with open(os.path.join(metrics_dir, RESULTS_FILE), "a", encoding="utf-8") as f:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+        latest_path = os.path.join(metrics_dir, LATEST_FILE)
+        try:
+            with open(latest_path, encoding="utf-8") as f:
+                latest = json.load(f)
+        except (OSError, ValueError):
+            latest = {}
+        latest[record["job"]] = record
+        _write_atomic(latest_path, json.dumps(latest, ensure_ascii=False, indent=2))
+
+        os.makedirs(textfile_dir, exist_ok=True)
+        _write_atomic(os.path.join(textfile_dir, PROM_FILE), render_prometheus(latest.values()))
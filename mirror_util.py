@@ -1,119 +1,1998 @@
-import requests
-from bs4 import BeautifulSoup
-import subprocess
+import asyncio
 import os
 import shutil  
+import tempfile
+import threading
+from contextlib import contextmanager, nullcontext
+import hashlib
+import fnmatch
+import gzip
+import lzma
+import re
+import json
+import time
+import argparse
+import configparser
+import sys
+import signal
+import socket
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from mirror_metrics import SyncResult, write_metrics
+from mirror_dedup import dedup_tree, seed_files, reference_args
+from mirror_crawl import RemoteIndex, read_listing, size_matches, CRAWL_TTL
 
-MIRROR_URL = "https://mirror.sharlio.fr/"
+# Serveur source : modifiable par l'environnement, le fichier de configuration ou configure_mirror()
+MIRROR_HOST = os.environ.get("SHARLIO_MIRROR_HOST", "mirror.sharlio.fr")
+MIRROR_URL = os.environ.get("SHARLIO_MIRROR_URL", f"https://{MIRROR_HOST}/")
+RSYNC_PORT = int(os.environ["SHARLIO_RSYNC_PORT"]) if os.environ.get("SHARLIO_RSYNC_PORT") else None
 
+SUPPORTED_OS = ("almalinux", "debian", "proxmox", "rockylinux")
 
-def _get_soup(url):
+# Codes de sortie de la ligne de commande
+EXIT_OK = 0
+EXIT_JOB_FAILED = 1
+EXIT_USAGE = 2
+EXIT_NO_SPACE = 3
+EXIT_INTERRUPTED = 130
+
+DEFAULT_MAX_WORKERS = 3
+DEFAULT_PER_HOST_LIMIT = 2
+DISCOVERY_WORKERS = 8
+HTTP_TIMEOUT = 10
+# Processus externes (voir ProcessEngine) : secondes sans sortie avant arrêt, 0 pour aucune limite
+PROCESS_IDLE_TIMEOUT = int(os.environ.get("SHARLIO_PROCESS_IDLE_TIMEOUT", 0))
+PROCESS_KILL_GRACE = 10
+PROCESS_TIMEOUT_CODE = 124
+PROCESS_LINE_LIMIT = 1024 ** 2
+PROCESS_READ_CHUNK = 64 * 1024
+EVENT_QUEUE_SIZE = 1000
+
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "sharlio-mirror-temp")
+LISTING_CACHE_DIR = os.path.join(CACHE_DIR, "listings")
+LOG_DIR = os.path.join(CACHE_DIR, "logs")
+# File des tâches de la ligne de commande, pour reprendre après un arrêt (--resume)
+JOURNAL_FILE = os.environ.get("SHARLIO_JOURNAL", os.path.join(CACHE_DIR, "journal.json"))
+# Dossiers de travail de debmirror, conservés entre deux exécutions. Par défaut dans
+# <destination>/.staging : sur le même système de fichiers que le miroir, le staging et les
+# instantanés publiés partagent leurs fichiers par liens physiques
+STAGING_DIR = os.environ.get("SHARLIO_STAGING_DIR", "")
+STAGING_SUBDIR = ".staging"
+DEBMIRROR_STATE_CACHE_DAYS = 7
+# Nombre d'instantanés publiés conservés par distribution (le courant compris)
+SNAPSHOT_RETENTION = int(os.environ.get("SHARLIO_SNAPSHOT_RETENTION", 3))
+# Moteur des tâches Debian/Proxmox : debmirror, ou "delta" (comparaison des index avec le pool local)
+DEBIAN_ENGINES = ("debmirror", "delta")
+DEBIAN_ENGINE = os.environ.get("SHARLIO_DEBIAN_ENGINE", "debmirror")
+DELTA_WORKERS = int(os.environ.get("SHARLIO_DELTA_WORKERS", 4))
+DELTA_WORK_DIR = ".delta"
+POOL_INDEX_FILE = ".pool-index.json"
+# Fichiers de travail du staging qui ne sont pas publiés
+PUBLISH_EXCLUDES = (f"--exclude=/{DELTA_WORK_DIR}/", f"--exclude=/{POOL_INDEX_FILE}")
+DEBIAN_SECTIONS = ("main", "non-free", "non-free-firmware")
+DEBIAN_ARCHES = ("amd64",)
+MIRROR_EXCLUDES = ("aircrack", "aircrack-ng")
+# Dossier d'un miroir qui regroupe plusieurs distributions d'une même archive (tâche
+# "debian:bookworm,trixie") : un seul pool, un dists/<dist> par distribution
+SHARED_DIST_DIR = "shared"
+PROXMOX_REPOS = {
+    "pve": {"root": "proxmox-pve", "section": "pve-no-subscription"},
+    "pbs": {"root": "proxmox-pbs", "section": "pbs-no-subscription"},
+    "ceph-reef": {"root": "proxmox-ceph-reef", "section": "no-subscription"},
+    "ceph-squid": {"root": "proxmox-ceph-squid", "section": "no-subscription"}
+}
+# Budget global de bande passante (voir parse_bandwidth_schedule), relu toutes les
+# BANDWIDTH_CHECK_INTERVAL secondes
+BANDWIDTH_SCHEDULE = os.environ.get("SHARLIO_BANDWIDTH", "")
+BANDWIDTH_CHECK_INTERVAL = 30
+# Un rsync n'est relancé que si sa limite s'écarte de plus de BANDWIDTH_HYSTERESIS de sa
+# part, et pour l'arrivée d'autres tâches seulement après BANDWIDTH_MIN_RUN secondes
+BANDWIDTH_HYSTERESIS = 0.25
+BANDWIDTH_MIN_RUN = 600
+RATE_UNITS = {"": 1, "k": 1024, "m": 1024 ** 2, "g": 1024 ** 3}
+# Processus rsync lancés en parallèle sur une arborescence AlmaLinux/Rocky (1 : un seul flux)
+RSYNC_SHARDS = int(os.environ.get("SHARLIO_RSYNC_SHARDS", 1))
+# Profils de contenu des tâches rsync (AlmaLinux/Rocky) : ce qui est exclu n'est ni téléchargé ni stocké
+RPM_ARCHES = ("x86_64", "x86_64_v2", "aarch64", "ppc64le", "s390x", "i686", "riscv64")
+CONTENT_PROFILES = {
+    "full": {"arches": None, "isos": True, "debug": True, "source": True},
+    "binary": {"arches": None, "isos": False, "debug": False, "source": False},
+    "x86_64": {"arches": ["x86_64"], "isos": False, "debug": False, "source": False},
+}
+DEFAULT_CONTENT_PROFILE = os.environ.get("SHARLIO_CONTENT_PROFILE", "full")
+# Fichiers témoins consultés avant une tâche : s'ils n'ont pas changé depuis la dernière
+# synchronisation réussie, la tâche est ignorée (au plus FRESHNESS_MAX_AGE secondes)
+FRESHNESS_DIR = os.path.join(CACHE_DIR, "freshness")
+FRESHNESS_MAX_AGE = int(os.environ.get("SHARLIO_FRESHNESS_MAX_AGE", 7 * 24 * 3600))
+RPM_FRESHNESS_REPOS = ("BaseOS", "AppStream")
+UPSTREAM_TIMESTAMP_FILES = {"almalinux": "TIME", "rockylinux": "fullfiletimelist-rocky"}
+# Serveurs de secours, "hôte" ou "hôte:port_rsync" séparés par des virgules. Le plus rapide,
+# sondé au plus toutes les ENDPOINT_TTL secondes, est utilisé ; une tâche bascule sur le
+# suivant quand rsync échoue avec l'un des FAILOVER_EXIT_CODES ou que le serveur ne répond plus
+MIRROR_HOSTS = os.environ.get("SHARLIO_MIRROR_HOSTS", "")
+ENDPOINT_CACHE_FILE = os.path.join(CACHE_DIR, "endpoints.json")
+ENDPOINT_TTL = int(os.environ.get("SHARLIO_ENDPOINT_TTL", 1800))
+ENDPOINT_PROBE_TIMEOUT = 5
+ENDPOINT_REFERENCE_BYTES = 1024 ** 2
+FAILOVER_EXIT_CODES = (5, 10, 12, 30, 35)
+# Durée (s) pendant laquelle un listage en cache est réutilisé sans interroger le miroir
+LISTING_CACHE_TTL = int(os.environ.get("SHARLIO_LISTING_TTL", 6 * 3600))
+
+# Tailles indicatives (Go) pour ordonner la file tant qu'aucune estimation n'est disponible
+JOB_SIZE_HINTS = {
+    "debian": 150,
+    "almalinux": 120,
+    "rockylinux": 120,
+    "proxmox": 15,
+}
+
+
+_job_context = threading.local()
+
+
+def configure_mirror(host=None, url=None, rsync_port=None):
+    """Change le serveur source. Sans url, l'index HTTP est cherché sur https://<host>/."""
+    global MIRROR_HOST, MIRROR_URL, RSYNC_PORT
+    if host:
+        MIRROR_HOST = host
+        MIRROR_URL = url or f"https://{host}/"
+    elif url:
+        MIRROR_URL = url
+    if rsync_port:
+        RSYNC_PORT = int(rsync_port)
+
+
+class Endpoint:
+    """Serveur source : hôte et port rsync, URL de l'index HTTP."""
+
+    def __init__(self, host, url=None, rsync_port=None):
+        self.host = host
+        self.url = url or f"https://{host}/"
+        self.rsync_port = int(rsync_port) if rsync_port else None
+
+    @classmethod
+    def parse(cls, spec):
+        """"miroir.example" ou "miroir.example:8873" (port rsync)."""
+        host, _, port = spec.strip().partition(":")
+        if not host or (port and not port.isdigit()):
+            raise ValueError(f"Serveur invalide : {spec!r} (attendu hôte ou hôte:port)")
+        return cls(host, rsync_port=port or None)
+
+    def __str__(self):
+        return f"{self.host}:{self.rsync_port}" if self.rsync_port else self.host
+
+    def __eq__(self, other):
+        return isinstance(other, Endpoint) and str(self) == str(other)
+
+    def __hash__(self):
+        return hash(str(self))
+
+def default_endpoint():
+    return Endpoint(MIRROR_HOST, MIRROR_URL, RSYNC_PORT)
+
+def current_endpoint():
+    """Serveur de la tâche en cours (voir use_endpoint), à défaut le serveur principal."""
+    return getattr(_job_context, "endpoint", None) or default_endpoint()
+
+@contextmanager
+def use_endpoint(endpoint):
+    """Fait passer par endpoint les transferts et requêtes lancés par le thread courant."""
+    previous = getattr(_job_context, "endpoint", None)
+    _job_context.endpoint = endpoint
+    try:
+        yield endpoint
+    finally:
+        _job_context.endpoint = previous
+
+def _connect_latency(endpoint):
+    # Durée (s) de la connexion au port rsync, None si le serveur est injoignable
+    started = time.monotonic()
+    try:
+        with socket.create_connection((endpoint.host, endpoint.rsync_port or 873), timeout=ENDPOINT_PROBE_TIMEOUT):
+            pass
+    except OSError:
+        return None
+    return time.monotonic() - started
+
+def _probe_endpoint(endpoint, probe_path):
+    """{"latency", "throughput"} du serveur : connexion au port rsync puis téléchargement HTTP
+    de probe_path. None si l'un des deux échoue."""
+    import requests
+
+    latency = _connect_latency(endpoint)
+    if latency is None:
+        return None
+    started = time.monotonic()
+    try:
+        response = _get_session().get(endpoint.url + probe_path, timeout=HTTP_TIMEOUT)
+        response.raise_for_status()
+    except requests.exceptions.RequestException:
+        return None
+    return {"latency": latency, "throughput": len(response.content) / max(time.monotonic() - started, 0.001)}
+
+
+class EndpointRanking:
+    """Serveurs source de chaque OS, classés par sondage.
+
+    Le score d'un serveur est le temps estimé pour ouvrir une connexion rsync et télécharger
+    ENDPOINT_REFERENCE_BYTES. Le classement est conservé ENDPOINT_TTL secondes dans
+    ENDPOINT_CACHE_FILE ; un serveur en échec passe en dernier jusqu'au sondage suivant.
+    Le serveur principal (MIRROR_HOST) fait toujours partie des candidats."""
+
+    def __init__(self, hosts=""):
+        self.lock = threading.Lock()
+        self.probe_lock = threading.Lock()
+        self.hosts = {}
+        self.configure(hosts)
+
+    def configure(self, hosts="", per_os=None):
+        """hosts : serveurs de secours de tous les OS ; per_os : {os: serveurs} propres à un OS."""
+        parsed = {None: [Endpoint.parse(spec) for spec in (hosts or "").split(",") if spec.strip()]}
+        for os_name, specs in (per_os or {}).items():
+            parsed[os_name] = [Endpoint.parse(spec) for spec in specs.split(",") if spec.strip()]
+        with self.lock:
+            self.hosts = parsed
+
+    def endpoints(self, os_name=None):
+        candidates = [default_endpoint()] + self.hosts.get(os_name, self.hosts[None])
+        return list(dict.fromkeys(candidates))
+
+    def ranked(self, os_name=None, probe_path=None, probe=True):
+        """Serveurs de os_name, du plus rapide au plus lent. Le classement est refait s'il est
+        trop ancien, sauf si probe est faux."""
+        endpoints = self.endpoints(os_name)
+        if len(endpoints) < 2:
+            return endpoints
+        key = os_name or ""
+        if probe:
+            with self.probe_lock:
+                entry = self._load().get(key)
+                if not entry or time.time() - entry.get("probed", 0) > ENDPOINT_TTL:
+                    self._probe(key, endpoints, f"{os_name}/" if probe_path is None and os_name else probe_path or "")
+        entry = self._load().get(key) or {}
+        scores = entry.get("scores", {})
+        failed = entry.get("failed", {})
+
+        def rank(endpoint):
+            score = scores.get(str(endpoint))
+            return time.time() - failed.get(str(endpoint), 0) < ENDPOINT_TTL, score is None, score or 0
+
+        return sorted(endpoints, key=rank)
+
+    def best(self, os_name=None, probe_path=None, probe=True):
+        return self.ranked(os_name, probe_path, probe)[0]
+
+    def report_failure(self, os_name, endpoint, code):
+        """Vrai si l'échec de code code vient du serveur (erreur réseau de rsync, serveur
+        injoignable) : il passe alors en dernier et la tâche peut basculer sur le suivant."""
+        if code not in FAILOVER_EXIT_CODES and _connect_latency(endpoint) is not None:
+            return False
+        with self.lock:
+            cache = self._load()
+            cache.setdefault(os_name or "", {}).setdefault("failed", {})[str(endpoint)] = time.time()
+            self._save(cache)
+        return True
+
+    def _probe(self, key, endpoints, probe_path):
+        with ThreadPoolExecutor(max_workers=len(endpoints)) as executor:
+            probes = dict(zip(endpoints, executor.map(lambda endpoint: _probe_endpoint(endpoint, probe_path), endpoints)))
+        with self.lock:
+            cache = self._load()
+            cache[key] = {
+                "probed": time.time(),
+                "probes": {str(endpoint): probe for endpoint, probe in probes.items()},
+                "scores": {str(endpoint): round(probe["latency"] + ENDPOINT_REFERENCE_BYTES / max(probe["throughput"], 1), 3)
+                           for endpoint, probe in probes.items() if probe},
+                "failed": {},
+            }
+            self._save(cache)
+
+    def _load(self):
+        try:
+            with open(ENDPOINT_CACHE_FILE, encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _save(self, cache):
+        os.makedirs(os.path.dirname(ENDPOINT_CACHE_FILE), exist_ok=True)
+        tmp_path = f"{ENDPOINT_CACHE_FILE}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(cache, f)
+        os.replace(tmp_path, ENDPOINT_CACHE_FILE)
+
+
+try:
+    ENDPOINTS = EndpointRanking(MIRROR_HOSTS)
+except ValueError as e:
+    print(f"ERREUR: SHARLIO_MIRROR_HOSTS ignoré. {e}", file=sys.stderr)
+    ENDPOINTS = EndpointRanking()
+
+def mirror_url(os_name=None):
+    """URL de l'index HTTP du serveur le plus rapide pour os_name."""
+    return ENDPOINTS.best(os_name).url
+
+def rsync_url(rsync_user, module_path):
+    endpoint = current_endpoint()
+    port = f":{endpoint.rsync_port}" if endpoint.rsync_port else ""
+    return f"rsync://{rsync_user}@{endpoint.host}{port}/{module_path}"
+
+def _debmirror_host_args(rsync_user):
+    return [f"--host={rsync_user}@{current_endpoint().host}"]
+
+def _debmirror_rsync_args(bwlimit=0):
+    options = ["-aIL", "--partial"]
+    if current_endpoint().rsync_port:
+        options.append(f"--port={current_endpoint().rsync_port}")
+    if bwlimit:
+        options.append(f"--bwlimit={bwlimit}")
+    return [f"--rsync-options={' '.join(options)}"] if len(options) > 2 else []
+
+
+_session = None
+_session_lock = threading.Lock()
+# Versions mineures ("9.4", "8.10") masquées dans les listages
+_DOT_NUMBER_RE = re.compile(r"\.\d")
+
+
+def _get_session():
+    """Session HTTP partagée : les connexions keep-alive sont réutilisées entre les requêtes."""
+    global _session
+    with _session_lock:
+        if _session is None:
+            import requests
+            _session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=DISCOVERY_WORKERS)
+            _session.mount("https://", adapter)
+            _session.mount("http://", adapter)
+        return _session
+
+
+def _listing_cache_path(url):
+    return os.path.join(LISTING_CACHE_DIR, hashlib.sha256(url.encode()).hexdigest() + ".json")
+
+def _load_listing_cache(url):
     try:
-        response = requests.get(url, timeout=10)
-        response.raise_for_status() 
-        return BeautifulSoup(response.text, 'html.parser')
+        with open(_listing_cache_path(url), encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def _save_listing_cache(url, entry):
+    os.makedirs(LISTING_CACHE_DIR, exist_ok=True)
+    path = _listing_cache_path(url)
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(entry, f)
+    os.replace(tmp_path, path)
+
+def _fetch_listing(url, ttl=None):
+    """Renvoie les sous-dossiers de la page d'index url.
+
+    Le résultat est mis en cache sur disque : il est réutilisé tel quel pendant ttl secondes,
+    puis revalidé avec If-None-Match/If-Modified-Since. Si le miroir est injoignable, la
+    dernière version connue est renvoyée ; None si aucune n'existe."""
+    import requests
+
+    ttl = LISTING_CACHE_TTL if ttl is None else ttl
+    cached = _load_listing_cache(url)
+    if cached and time.time() - cached.get("checked", 0) < ttl:
+        return cached["dirs"]
+
+    headers = {}
+    if cached:
+        if cached.get("etag"):
+            headers["If-None-Match"] = cached["etag"]
+        if cached.get("last_modified"):
+            headers["If-Modified-Since"] = cached["last_modified"]
+
+    try:
+        with _get_session().get(url, headers=headers, timeout=HTTP_TIMEOUT, stream=True) as response:
+            if response.status_code == 304 and cached:
+                cached["checked"] = time.time()
+                _save_listing_cache(url, cached)
+                return cached["dirs"]
+            response.raise_for_status()
+            entries, _ = read_listing(response)
     except requests.exceptions.RequestException as e:
         print(f"ERREUR: Impossible de joindre {url}. {e}")
+        if cached:
+            print(f"Utilisation du listage en cache pour {url}.")
+            return cached["dirs"]
         return None
+
+    dirs = [name.rstrip("/") for name, _, _ in entries if name.endswith("/")]
+    try:
+        _save_listing_cache(url, {
+            "url": url,
+            "dirs": dirs,
+            "etag": response.headers.get("ETag"),
+            "last_modified": response.headers.get("Last-Modified"),
+            "checked": time.time(),
+        })
+    except OSError as e:
+        print(f"ERREUR: Impossible d'écrire le cache pour {url}. {e}")
+    return dirs
     
 def list_dirs(url, exclude=False, exclude_dot_numbers=False):
-    soup = _get_soup(url)
-    if not soup:
+    dirs = _fetch_listing(url)
+    if dirs is None:
         return []
-    dirs = [a.text.strip('/') for a in soup.find_all('a') if a.text.endswith('/')]
     if exclude_dot_numbers:
-        dirs = [d for d in dirs if not any(f".{i}" in d for i in range(10))]
+        dirs = [d for d in dirs if not _DOT_NUMBER_RE.search(d)]
     if exclude:
         dirs = [d for d in dirs if not d.startswith('.') and d not in ('assets', 'favicon.ico','project') and "stable" not in d]
     return dirs
 
+def list_mirror_dirs(os_name, path, exclude=False, exclude_dot_numbers=False):
+    """list_dirs sur le serveur le plus rapide pour os_name ; path est relatif à la racine du miroir."""
+    return list_dirs(mirror_url(os_name) + path, exclude, exclude_dot_numbers)
+
 def list_os():
     print("Récupération des os disponibles")
-    soup = _get_soup(MIRROR_URL)
-    if soup is None:
+    dirs = _fetch_listing(mirror_url())
+    if dirs is None:
         return []
     
-    dirs = [a.text.strip('/') for a in soup.find_all('a') if a.text.endswith('/')]
     dirs = [d for d in dirs if not d.startswith('.') and d not in ('assets', 'favicon.ico')]
     return dirs
 
-def _parse_rsync_progress(line, percent_callback):
+def discover(tasks, result_callback, max_workers=DISCOVERY_WORKERS):
+    """Exécute en parallèle les listages de tasks ({clé: fonction sans argument})
+    et appelle result_callback(clé, résultat) au fil des réponses."""
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(task): key for key, task in tasks.items()}
+        for future in as_completed(futures):
+            key = futures[future]
+            try:
+                result = future.result()
+            except Exception as e:
+                print(f"ERREUR: Listage {key} impossible. {e}")
+                result = []
+            result_callback(key, result)
+
+def _marker_paths(os_name, distri):
+    if os_name == "debian":
+        return [f"debian/dists/{dist}/Release" for dist in distri.split(",")]
+    if os_name == "proxmox":
+        proxmox_category, debian_dist = distri.split(":")
+        return [f"proxmox/debian/{proxmox_category}/dists/{dist}/Release" for dist in debian_dist.split(",")]
+    markers = [f"{os_name}/{distri}/{repo}/x86_64/os/repodata/repomd.xml" for repo in RPM_FRESHNESS_REPOS]
+    if os_name in UPSTREAM_TIMESTAMP_FILES:
+        markers.append(f"{os_name}/{UPSTREAM_TIMESTAMP_FILES[os_name]}")
+    return markers
+
+def freshness_markers(os_name, distri):
+    """URL HTTP des fichiers témoins d'une tâche sur le serveur courant : Release pour
+    Debian/Proxmox, repomd.xml et fichier d'horodatage du miroir pour AlmaLinux/Rocky."""
+    base_url = current_endpoint().url
+    return [base_url + path for path in _marker_paths(os_name, distri)]
+
+def _freshness_path(job, dest):
+    key = f"{job_spec(job)}|{os.path.abspath(dest)}"
+    return os.path.join(FRESHNESS_DIR, hashlib.sha256(key.encode()).hexdigest() + ".json")
+
+def _load_freshness(job, dest):
     try:
-        parts = line.split()
-        for part in parts:
-            if part.endswith('%') and len(part) > 1:
-                pct = int(part[:-1])
-                if percent_callback:
-                    percent_callback(pct)
-                return 
-    except:
-        pass 
+        with open(_freshness_path(job, dest), encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def save_freshness(job, dest, markers, options=None):
+    """Mémorise les fichiers témoins relevés avant une synchronisation réussie."""
+    os.makedirs(FRESHNESS_DIR, exist_ok=True)
+    path = _freshness_path(job, dest)
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump({"job": job_spec(job), "synced": time.time(), "markers": markers, "options": options}, f)
+    os.replace(tmp_path, path)
+
+def probe_upstream(job, dest):
+    """Relève les fichiers témoins de la tâche (requêtes conditionnelles si possible).
+    Renvoie {url: empreinte, ou None si le fichier n'existe pas}, ou None si le miroir ne
+    répond pas ou qu'aucun témoin n'existe."""
+    import requests
+
+    previous = _load_freshness(job, dest).get("markers") or {}
+    markers = {}
+    for url in freshness_markers(*job):
+        known = previous.get(url)
+        headers = {}
+        if known and known.get("etag"):
+            headers["If-None-Match"] = known["etag"]
+        if known and known.get("last_modified"):
+            headers["If-Modified-Since"] = known["last_modified"]
+        try:
+            response = _get_session().get(url, headers=headers, timeout=HTTP_TIMEOUT)
+        except requests.exceptions.RequestException:
+            return None
+        if response.status_code == 304 and known:
+            markers[url] = known
+        elif response.status_code == 404:
+            markers[url] = None
+        elif response.ok:
+            markers[url] = {
+                "sha256": hashlib.sha256(response.content).hexdigest(),
+                "etag": response.headers.get("ETag"),
+                "last_modified": response.headers.get("Last-Modified"),
+            }
+        else:
+            return None
+    if not any(markers.values()):
+        return None
+    return markers
+
+def is_up_to_date(job, dest, markers, options=None):
+    """Vrai si dest existe et que les témoins et les options sont ceux de la dernière
+    synchronisation réussie, faite il y a moins de FRESHNESS_MAX_AGE secondes."""
+    state = _load_freshness(job, dest)
+    if not markers or not state or not os.path.isdir(dest):
+        return False
+    if time.time() - state.get("synced", 0) > FRESHNESS_MAX_AGE or state.get("options") != options:
+        return False
+    return _marker_digests(state.get("markers") or {}) == _marker_digests(markers)
+
+def _marker_digests(markers):
+    return {url: marker and marker["sha256"] for url, marker in markers.items()}
+
+def job_dest(path, job):
+    os_name, distri = job
+    parts = distri.split(":")
+    if "," in parts[-1]:
+        parts[-1] = SHARED_DIST_DIR
+    return os.path.join(path, os_name, *parts)
+
+def _staging_name(os_name, distri):
+    parts = distri.split(":")
+    if "," in parts[-1]:
+        parts[-1] = SHARED_DIST_DIR
+    return "-".join(["debmirror", os_name, *parts])
 
-def _parse_debmirror_progress(line, pool_started, percent_callback):
-    new_pool_started = pool_started
+def _seed_source(final_dest, dists):
+    # Miroir existant qui amorce le staging : le miroir lui-même, sinon celui d'une des distributions
+    parent = os.path.dirname(final_dest)
+    for candidate in [final_dest] + [os.path.join(parent, dist) for dist in dists]:
+        if os.path.isdir(candidate):
+            return candidate
+    return final_dest
+
+def _link_shared_dists(final_dest, dists, text_callback=None):
+    """<parent>/<dist> devient un lien vers le miroir partagé pour chaque distribution : les
+    sources apt qui pointent vers l'ancien emplacement restent valides."""
+    parent, name = os.path.split(os.path.normpath(final_dest))
+    for dist in dists:
+        link_path = os.path.join(parent, dist)
+        if os.path.lexists(link_path) and not os.path.islink(link_path):
+            if text_callback:
+                text_callback(f"{link_path} est un dossier : lien vers {name} non créé.")
+            continue
+        _replace_symlink(name, link_path)
+        # L'ancien miroir de la distribution n'est plus publié : ses instantanés sont supprimés
+        snapshots = os.path.join(parent, ".snapshots", dist)
+        if os.path.isdir(snapshots):
+            shutil.rmtree(snapshots, ignore_errors=True)
+            if text_callback:
+                text_callback(f"Anciens instantanés {snapshots} supprimés (remplacés par {name}).")
+
+def _migrate_dist_stagings(os_name, distri, path, text_callback=None):
+    """Passage d'une archive au pool partagé : les stagings des distributions de la tâche
+    amorcent le staging partagé, puis sont supprimés. Le premier est simplement renommé
+    (pool et cache d'état de debmirror conservés), les suivants y sont fusionnés par liens
+    physiques."""
+    category, _, dist_list = distri.rpartition(":")
+    root = staging_root(path)
+    shared = os.path.join(root, _staging_name(os_name, distri))
+    for dist in dist_list.split(","):
+        old = os.path.join(root, _staging_name(os_name, f"{category}:{dist}" if category else dist))
+        if not os.path.isdir(old):
+            continue
+        if not os.path.isdir(shared) or not os.listdir(shared):
+            if os.path.isdir(shared):
+                os.rmdir(shared)
+            os.rename(old, shared)
+            if text_callback:
+                text_callback(f"Staging {old} repris comme staging partagé {shared}.")
+            continue
+        skipped = _seed_staging(old, shared)
+        shutil.rmtree(old, ignore_errors=True)
+        if text_callback:
+            text_callback(f"Staging {old} fusionné dans {shared} puis supprimé"
+                          + (f" ({skipped} fichiers non liés seront téléchargés de nouveau)." if skipped else "."))
+
+
+SIZE_UNITS = {"B": 1, "kB": 1024, "KB": 1024, "kiB": 1024, "KiB": 1024, "MB": 1024 ** 2, "MiB": 1024 ** 2,
+              "GB": 1024 ** 3, "GiB": 1024 ** 3, "TB": 1024 ** 4, "TiB": 1024 ** 4}
+STATS_INTERVAL = 0.5
+# rsync --info=progress2 ou --progress : "1,238,099,968  37%  18.92MB/s  0:00:42 (xfr#12, to-chk=123/4567)"
+RSYNC_PROGRESS_RE = re.compile(r"\s*([\d,]+)\s+(\d+)%\s+([\d.,]+)([kKMGT]?i?B)/s\s+(\d+):(\d+):(\d+)"
+                               r"(?:\s+\(xfr#\d+, [a-z]+-chk=(\d+)/(\d+)\))?")
+# debmirror : "Download all files that we need to get (1234 MiB)." puis "[ 45%] Getting: pool/…"
+DEBMIRROR_TOTAL_RE = re.compile(r"Download all files that we need to get \(([\d.,]+) (\w+)\)")
+DEBMIRROR_PERCENT_RE = re.compile(r"(\d+(?:\.\d+)?)%")
+
+
+def format_size(size):
+    for unit in ("o", "Ko", "Mo", "Go"):
+        if abs(size) < 1024:
+            return f"{size:.1f} {unit}" if unit != "o" else f"{int(size)} o"
+        size /= 1024
+    return f"{size:.1f} To"
+
+def format_duration(seconds):
+    if seconds is None:
+        return "--:--:--"
+    seconds = int(seconds)
+    return f"{seconds // 3600}:{seconds // 60 % 60:02d}:{seconds % 60:02d}"
+
+def _parse_size(value, unit):
+    return int(float(value.replace(",", "")) * SIZE_UNITS.get(unit, 1))
+
+
+class TransferProgress:
+    """Avancement global d'une tâche : octets transférés sur le total, débit et temps restant.
+    stats_callback reçoit as_dict() au plus toutes les STATS_INTERVAL secondes."""
+
+    def __init__(self, stats_callback=None):
+        self.stats_callback = stats_callback
+        self.bytes_done = 0
+        self.bytes_total = 0
+        self.rate = 0.0
+        self.eta = None
+        self.files_remaining = None
+        self.files_total = None
+        self.peak_rate = 0.0
+        self._last_sample = (time.monotonic(), 0)
+        self._last_report = 0.0
+
+    def update(self, bytes_done, bytes_total=None, rate=None, eta=None, files_remaining=None, files_total=None):
+        now = time.monotonic()
+        if rate is None:
+            sample_time, sample_bytes = self._last_sample
+            if now - sample_time >= 1:
+                instant = (bytes_done - sample_bytes) / (now - sample_time)
+                self.rate = instant if not self.rate else 0.7 * self.rate + 0.3 * instant
+                self._last_sample = (now, bytes_done)
+        else:
+            self.rate = rate
+        self.peak_rate = max(self.peak_rate, self.rate)
+        self.bytes_done = bytes_done
+        if bytes_total is not None:
+            self.bytes_total = max(bytes_total, bytes_done)
+        if files_remaining is not None:
+            self.files_remaining = files_remaining
+        if files_total is not None:
+            self.files_total = files_total
+        if eta is not None:
+            self.eta = eta
+        elif self.rate > 0 and self.bytes_total:
+            self.eta = (self.bytes_total - self.bytes_done) / self.rate
+        self.report()
+
+    @property
+    def percent(self):
+        if not self.bytes_total:
+            return 0
+        return min(100, int(self.bytes_done * 100 / self.bytes_total))
+
+    def as_dict(self):
+        return {
+            "bytes_done": self.bytes_done,
+            "bytes_total": self.bytes_total,
+            "rate": self.rate,
+            "eta": self.eta,
+            "files_remaining": self.files_remaining,
+            "files_total": self.files_total,
+            "percent": self.percent,
+        }
+
+    def report(self, force=False):
+        now = time.monotonic()
+        if self.stats_callback and (force or now - self._last_report >= STATS_INTERVAL):
+            self._last_report = now
+            self.stats_callback(self.as_dict())
+
+
+def _parse_rsync_progress(line, percent_callback, progress=None):
+    match = RSYNC_PROGRESS_RE.match(line)
+    if not match:
+        return
+    done, pct, rate, rate_unit, hours, minutes, seconds, remaining, total = match.groups()
+    pct = int(pct)
+    if percent_callback:
+        percent_callback(pct)
+    if progress is not None:
+        bytes_done = int(done.replace(",", ""))
+        progress.update(bytes_done, bytes_done * 100 // pct if pct else None, rate=_parse_size(rate, rate_unit),
+                        eta=int(hours) * 3600 + int(minutes) * 60 + int(seconds),
+                        files_remaining=int(remaining) if remaining else None, files_total=int(total) if total else None)
+
+def _stats_count(value):
+    # "12 (reg: 10, dir: 2)" -> 10 fichiers réguliers ; "0" -> 0
+    value = value.strip()
+    if "reg: " in value:
+        value = value.split("reg: ")[1].split(",")[0].rstrip(")")
+    return int(value.split()[0].replace(",", ""))
+
+def _parse_rsync_stats(line, stats):
+    """Relève les compteurs utiles du bilan rsync --stats dans le dictionnaire stats."""
+    key, sep, value = line.partition(": ")
+    if not sep:
+        return
     try:
-        if not pool_started and "pool/" in line:
-            new_pool_started = True
-            if percent_callback: percent_callback(1) 
-        
-        if new_pool_started and "%" in line:
-            pct_str = line.split("%")[0].split()[-1]
-            pct = int(float(pct_str))
-            if percent_callback: percent_callback(pct)
-    except:
+        if key == "Number of created files":
+            stats["created"] = _stats_count(value)
+        elif key == "Number of deleted files":
+            stats["deleted"] = _stats_count(value)
+        elif key == "Number of regular files transferred":
+            stats["transferred"] = _stats_count(value)
+        elif key == "Total transferred file size":
+            stats["bytes"] = _stats_count(value)
+        elif key == "Total file size":
+            stats["total"] = _stats_count(value)
+    except (ValueError, IndexError):
         pass
-    return new_pool_started
 
-def get_temp_dir(name: str) -> str:
-    home = os.path.expanduser("~")
-    base_temp = os.path.join(home, ".cache", "sharlio-mirror-temp")
-    os.makedirs(base_temp, exist_ok=True)
+def _add_rsync_stats(result, stats, progress=None):
+    if result is None:
+        return
+    created = stats.get("created", 0)
+    result.add_changes(new=created, updated=max(0, stats.get("transferred", 0) - created), deleted=stats.get("deleted", 0))
+    result.add_transfer(stats.get("bytes", 0), progress.peak_rate if progress else 0.0)
 
-    temp_path = os.path.join(base_temp, name)
-    if os.path.exists(temp_path):
-        shutil.rmtree(temp_path)
-    os.makedirs(temp_path, exist_ok=True)
+def _parse_debmirror_progress(line, pool_started, percent_callback, progress=None):
+    if progress is not None and line.startswith("Download all files"):
+        match = DEBMIRROR_TOTAL_RE.match(line)
+        if match:
+            progress.update(0, _parse_size(*match.groups()))
 
-    return temp_path
+    if not pool_started and "pool/" in line:
+        pool_started = True
+        if percent_callback:
+            percent_callback(1)
 
+    if pool_started and "%" in line:
+        match = DEBMIRROR_PERCENT_RE.search(line)
+        if match:
+            pct = int(float(match.group(1)))
+            if percent_callback:
+                percent_callback(pct)
+            if progress is not None and progress.bytes_total:
+                progress.update(progress.bytes_total * pct // 100)
+    return pool_started
 
-def manage_alma_download(os_name, distri, path, rsync_user, text_callback=None, percent_callback=None):
-    target_dir = f"{path}/{os_name}/{distri}" 
-    os.makedirs(target_dir, exist_ok=True)
-    source = f"rsync://{rsync_user}@mirror.sharlio.fr/{os_name}/{distri}/"
-    
-    
-    cmd = ["rsync", "-rlt",  "--partial", "--partial-dir=.rsync-partial", "--append-verify","--no-inplace", "--progress", source, target_dir]
-    
-    process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, errors='replace')
-    
-    for line in process.stdout:
-        line = line.strip()
+def staging_root(path):
+    """Dossier des stagings pour la destination path : STAGING_DIR s'il est défini, sinon
+    <path>/.staging (dans le cache si aucune destination n'est connue)."""
+    if STAGING_DIR:
+        return STAGING_DIR
+    if not path:
+        return os.path.join(CACHE_DIR, "staging")
+    return os.path.join(path, STAGING_SUBDIR)
+
+def get_staging_dir(name: str, path=None, seed_from=None, text_callback=None) -> str:
+    """Dossier de travail persistant de debmirror pour la destination path.
+
+    Il n'est jamais vidé : debmirror y retrouve son pool et son cache d'état, et ne
+    télécharge que ce qui a changé. S'il est vide et que seed_from contient déjà un
+    miroir, il est amorcé à partir de celui-ci par liens physiques. Un staging situé sur un
+    autre système de fichiers que seed_from n'est pas amorcé : il faudrait copier tout le
+    miroir, puis stocker l'archive en double."""
+    staging_path = os.path.join(staging_root(path), name)
+    os.makedirs(staging_path, exist_ok=True)
+    # Les stagings étaient auparavant dans le cache : ils ne servent plus et occupent l'espace d'une archive
+    legacy = os.path.join(CACHE_DIR, "staging", name)
+    if path and not STAGING_DIR and os.path.isdir(legacy) and text_callback:
+        text_callback(f"ATTENTION : l'ancien staging {legacy} n'est plus utilisé ; il peut être supprimé.")
+    if not seed_from or not os.path.isdir(seed_from):
+        return staging_path
+    empty = not os.listdir(staging_path)
+    if os.stat(seed_from).st_dev != os.stat(staging_path).st_dev:
+        if text_callback:
+            seeding = " et le staging n'est pas amorcé" if empty else ""
+            text_callback(f"ATTENTION : {staging_path} n'est pas sur le système de fichiers de {seed_from} : "
+                          f"l'archive y est stockée en double{seeding} (voir SHARLIO_STAGING_DIR).")
+    elif empty:
+        skipped = _seed_staging(seed_from, staging_path)
+        if skipped and text_callback:
+            text_callback(f"ATTENTION : {skipped} fichiers de {seed_from} n'ont pas pu être liés dans le staging ; "
+                          "ils seront téléchargés de nouveau.")
+    return staging_path
+
+def _seed_staging(source, staging_path):
+    # Liens physiques uniquement ; renvoie le nombre de fichiers qui n'ont pas pu être liés
+    skipped = 0
+    for root, dirs, files in os.walk(source):
+        target_root = os.path.join(staging_path, os.path.relpath(root, source))
+        os.makedirs(target_root, exist_ok=True)
+        for name in dirs + files:
+            src = os.path.join(root, name)
+            dst = os.path.join(target_root, name)
+            if os.path.lexists(dst):
+                continue
+            if os.path.islink(src):
+                os.symlink(os.readlink(src), dst)
+                continue
+            if name in dirs:
+                continue
+            try:
+                os.link(src, dst)
+            except OSError:
+                skipped += 1
+    return skipped
+
+
+@contextmanager
+def _phase(result, name):
+    if result is None:
+        yield
+    else:
+        with result.phase(name):
+            yield
+
+class JobControl:
+    """Annulation, pause et reprise d'une tâche. Chaque processus de la tâche (rsync,
+    debmirror) est lancé dans son propre groupe de processus : les signaux atteignent
+    ainsi toute l'arborescence (ssh, rsync récepteur…) et pas seulement le premier processus."""
+
+    def __init__(self, job=None):
+        self.lock = threading.Lock()
+        self.processes = []
+        self.cancelled = False
+        self.paused = False
+        self.job = job
+
+    def add(self, process):
+        with self.lock:
+            self.processes = [p for p in self.processes if p.poll() is None]
+            self.processes.append(process)
+            if self.cancelled:
+                self._signal(process, signal.SIGTERM)
+            elif self.paused:
+                self._signal(process, signal.SIGSTOP)
+
+    def cancel(self):
+        with self.lock:
+            self.cancelled = True
+            for process in self.processes:
+                if self.paused:
+                    self._signal(process, signal.SIGCONT)
+                self._signal(process, signal.SIGTERM)
+            self.paused = False
+
+    def pause(self):
+        with self.lock:
+            if self.cancelled or self.paused:
+                return
+            self.paused = True
+            for process in self.processes:
+                self._signal(process, signal.SIGSTOP)
+
+    def resume(self):
+        with self.lock:
+            if not self.paused:
+                return
+            self.paused = False
+            for process in self.processes:
+                self._signal(process, signal.SIGCONT)
+
+    @staticmethod
+    def _signal(process, signum):
+        if process.poll() is not None:
+            return
+        try:
+            os.killpg(process.pid, signum)
+        except (ProcessLookupError, PermissionError):
+            pass
+
+
+def current_job_control():
+    return getattr(_job_context, "control", None)
+
+@contextmanager
+def job_control(control):
+    """Rattache à control les processus lancés par le thread courant."""
+    previous = current_job_control()
+    _job_context.control = control
+    try:
+        yield control
+    finally:
+        _job_context.control = previous
+
+# Fin d'enregistrement dans la sortie brute : rsync réécrit sa ligne de progression avec \r
+_RECORD_END = re.compile(rb"\r\n?|\n")
+
+
+class _ChildProcess:
+    """Processus de ProcessEngine, vu par JobControl et BandwidthBudget comme un Popen."""
+
+    def __init__(self, process):
+        self.process = process
+        self.pid = process.pid
+
+    def poll(self):
+        return self.process.returncode
+
+    def terminate(self):
+        self.signal(signal.SIGTERM)
+
+    def kill(self):
+        self.signal(signal.SIGKILL)
+
+    def signal(self, signum):
+        if self.process.returncode is not None:
+            return
+        try:
+            os.killpg(self.pid, signum)
+        except (ProcessLookupError, PermissionError):
+            pass
+
+
+class ProcessEngine:
+    """Exécute les processus externes (rsync, debmirror) depuis une seule boucle asyncio, qui
+    tourne dans son propre thread : leurs sorties sont lues sans bloquer un thread par processus.
+
+    Chaque processus publie des événements (dict dont "type" vaut start, line, progress,
+    timeout ou exit, avec "job" et "pid") à ses abonnés : interface, ligne de commande, métriques ;
+    chaque tâche y ajoute son avancement (percent, stats, voir notify). La file
+    de chaque abonné est bornée ; quand elle est pleine, la lecture de la sortie attend, et le
+    processus ralentit au lieu que la mémoire grossisse. Un processus muet depuis idle_timeout
+    secondes (hors pause) est arrêté et rend PROCESS_TIMEOUT_CODE."""
+
+    def __init__(self, queue_size=EVENT_QUEUE_SIZE, idle_timeout=PROCESS_IDLE_TIMEOUT):
+        self.queue_size = queue_size
+        self.idle_timeout = idle_timeout
+        self.lock = threading.Lock()
+        self._loop = None
+        self._subscribers = {}
+
+    @property
+    def loop(self):
+        with self.lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                threading.Thread(target=self._loop.run_forever, name="process-engine", daemon=True).start()
+            return self._loop
+
+    def wait(self, coroutine):
+        """Exécute coroutine dans la boucle et attend son résultat (depuis un autre thread)."""
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    def gather(self, coroutines):
+        """Exécute les coroutines en même temps dans la boucle ; renvoie leurs résultats."""
+        async def run_all():
+            return await asyncio.gather(*coroutines)
+
+        return self.wait(run_all())
+
+    def subscribe(self, callback, types=None, queue_size=None):
+        """Abonne callback (fonction ou coroutine, appelée dans la boucle : elle doit rendre la
+        main vite) aux événements des types donnés (tous par défaut). Renvoie le jeton à
+        passer à unsubscribe."""
+        async def register():
+            queue = asyncio.Queue(queue_size or self.queue_size)
+            token = object()
+            self._subscribers[token] = (queue, set(types) if types else None,
+                                        asyncio.get_running_loop().create_task(self._deliver(queue, callback)))
+            return token
+
+        return self.wait(register())
+
+    def unsubscribe(self, token):
+        """Désabonne après avoir livré les événements en attente."""
+        async def unregister():
+            queue, _, task = self._subscribers.pop(token)
+            await queue.join()
+            task.cancel()
+
+        self.wait(unregister())
+
+    async def _deliver(self, queue, callback):
+        while True:
+            event = await queue.get()
+            try:
+                outcome = callback(event)
+                if asyncio.iscoroutine(outcome):
+                    await outcome
+            except Exception as e:
+                # Un abonné défaillant ne doit ni bloquer les processus ni perdre les suivants
+                print(f"ERREUR: abonné aux événements des processus. {e}", file=sys.stderr)
+            finally:
+                queue.task_done()
+
+    async def publish(self, event):
+        for queue, types, _ in list(self._subscribers.values()):
+            if types is None or event["type"] in types:
+                await queue.put(event)
+
+    def notify(self, event):
+        """Publie event depuis n'importe quel thread (y compris celui de la boucle) sans
+        attendre sa livraison."""
+        if self._subscribers:
+            loop = self.loop
+            loop.call_soon_threadsafe(lambda: loop.create_task(self.publish(event)))
+
+    async def run(self, cmd, line_callback=None, control=None, on_start=None, progress_callback=None):
+        """Lance cmd dans son propre groupe de processus, rattaché à control (JobControl). La
+        sortie est lue par blocs d'octets et découpée sur \\n et \\r : chaque ligne va à
+        line_callback, et chaque mise à jour d'une ligne de progression (terminée par \\r) à
+        progress_callback dès son arrivée. on_start reçoit le processus dès son lancement.
+        Renvoie le code de sortie."""
+        job = control.job if control is not None else None
+        started = time.monotonic()
+        process = await asyncio.create_subprocess_exec(*cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT,
+                                                       start_new_session=True)
+        child = _ChildProcess(process)
+        if on_start:
+            on_start(child)
+        if control is not None:
+            control.add(child)
+        await self.publish({"type": "start", "job": job, "pid": process.pid, "cmd": cmd})
+
+        async def emit(raw, transient):
+            record = raw.decode(errors="replace").strip()
+            if not record:
+                return
+            callback = progress_callback if transient else line_callback
+            if callback:
+                callback(record)
+            if self._subscribers:
+                await self.publish({"type": "progress" if transient else "line", "job": job, "pid": process.pid, "line": record})
+
+        timed_out = False
+        deadline = self.idle_timeout or None
+        buffer = b""
+        # rsync écrit \r avant chaque mise à jour et ne termine la ligne qu'à la suivante : la
+        # fin du tampon qui suit un \r est transmise sans attendre, une seule fois
+        after_cr = False
+        shown = None
+        while True:
+            try:
+                chunk = await asyncio.wait_for(process.stdout.read(PROCESS_READ_CHUNK), deadline)
+            except asyncio.TimeoutError:
+                if timed_out:
+                    child.kill()
+                    deadline = None
+                elif control is None or not control.paused:
+                    timed_out = True
+                    child.terminate()
+                    deadline = PROCESS_KILL_GRACE
+                    await self.publish({"type": "timeout", "job": job, "pid": process.pid, "idle": self.idle_timeout})
+                continue
+            if not chunk:
+                await emit(buffer, False)
+                break
+            buffer += chunk
+            start = 0
+            for end in _RECORD_END.finditer(buffer):
+                record = buffer[start:end.start()]
+                after_cr = end.group() == b"\r"
+                if not (after_cr and record == shown):
+                    await emit(record, after_cr)
+                start = end.end()
+            buffer = buffer[start:]
+            if len(buffer) > PROCESS_LINE_LIMIT:
+                await emit(buffer, False)
+                buffer = b""
+            elif after_cr and buffer and buffer != shown:
+                await emit(buffer, True)
+                shown = buffer
+
+        code = await process.wait()
+        if timed_out:
+            code = PROCESS_TIMEOUT_CODE
+        await self.publish({"type": "exit", "job": job, "pid": process.pid, "code": code,
+                            "duration": time.monotonic() - started})
+        return code
+
+ENGINE = ProcessEngine()
+
+def _line_handler(text_callback=None, line_callback=None):
+    def on_line(line):
         if text_callback:
             text_callback(line)
-        _parse_rsync_progress(line, percent_callback)
+        if line_callback:
+            line_callback(line)
+    return on_line
+
+def _run_command(cmd, text_callback=None, line_callback=None):
+    # Les mises à jour de progression vont à line_callback seulement, pas au journal
+    return ENGINE.wait(ENGINE.run(cmd, _line_handler(text_callback, line_callback), current_job_control(),
+                                  progress_callback=line_callback))
+
+def _parse_minutes(value):
+    hours, _, minutes = value.strip().partition(":")
+    if not hours.isdigit() or not (minutes or "0").isdigit():
+        raise ValueError(f"Heure invalide : {value!r}")
+    total = int(hours) * 60 + int(minutes or 0)
+    if not 0 <= total <= 24 * 60:
+        raise ValueError(f"Heure invalide : {value!r}")
+    return total
+
+def _parse_rate(value):
+    match = re.fullmatch(r"(\d+(?:\.\d+)?)\s*([kKmMgG]?)(?:i?B)?(?:/s)?", value.strip())
+    if not match:
+        raise ValueError(f"Débit invalide : {value!r} (ex. 5M, 500K, 0 pour illimité)")
+    return int(float(match.group(1)) * RATE_UNITS[match.group(2).lower()])
+
+def parse_bandwidth_schedule(text):
+    """"5M" (débit constant) ou "08:00-19:00=5M,19:00-08:00=0" -> [(début, fin, octets/s)],
+    heures en minutes depuis minuit. 0, ou une heure hors de toute plage, signifie illimité."""
+    windows = []
+    for item in (text or "").split(","):
+        if not item.strip():
+            continue
+        span, _, rate = item.rpartition("=")
+        start, _, end = (span or "00:00-24:00").partition("-")
+        windows.append((_parse_minutes(start), _parse_minutes(end), _parse_rate(rate)))
+    return windows
+
+
+class BandwidthShare:
+    """Part du budget d'un processus rsync : tâche, nombre de flux parallèles de la tâche,
+    limite et budget total avec lesquels il tourne."""
+
+    def __init__(self, job=None, streams=1, restartable=True):
+        self.job = job
+        self.streams = max(1, streams)
+        self.restartable = restartable
+        self.limit = 0
+        self.rate = 0
+        self.started = time.monotonic()
+        self.process = None
+        self.restart = False
+
+
+class BandwidthBudget:
+    """Budget de bande passante partagé à parts égales entre les tâches en cours ; la part
+    d'une tâche est divisée entre ses flux parallèles (shards, moteur delta).
+
+    Le budget suit des plages horaires. Un processus reçoit sa limite au lancement. Il n'est
+    arrêté puis relancé (rsync reprend grâce à --partial) que si le budget ou la plage
+    change sensiblement sa part, ou si, depuis l'arrivée d'autres tâches, il dépasse
+    nettement sa part depuis BANDWIDTH_MIN_RUN secondes : la fin d'un flux ou d'une tâche ne
+    relance rien. debmirror reçoit sa limite au lancement et n'est jamais relancé."""
+
+    def __init__(self, schedule=""):
+        self.lock = threading.Lock()
+        self.windows = parse_bandwidth_schedule(schedule)
+        self.shares = []
+        self._monitor = None
+
+    def configure(self, schedule):
+        windows = parse_bandwidth_schedule(schedule)
+        with self.lock:
+            self.windows = windows
+        self._start_monitor()
+        self.rebalance()
+
+    def current_rate(self, now=None):
+        """Budget total (octets/s) à l'heure now, 0 si illimité."""
+        now = time.localtime(now)
+        minute = now.tm_hour * 60 + now.tm_min
+        for start, end, rate in self.windows:
+            if start <= minute < end or (end < start and (minute >= start or minute < end)):
+                return rate
+        return 0
+
+    def share_limit(self, share, rate=None):
+        # Limite rsync (Kio/s) d'un flux de la tâche de share, 0 si illimité ; à appeler sous self.lock
+        rate = self.current_rate() if rate is None else rate
+        if not rate:
+            return 0
+        jobs = {id(other) if other.job is None else other.job for other in self.shares}
+        return max(1, rate // 1024 // max(1, len(jobs)) // share.streams)
+
+    def assign(self, share):
+        """Fixe la limite de share pour le lancement de son processus."""
+        with self.lock:
+            share.rate = self.current_rate()
+            share.limit = self.share_limit(share, share.rate)
+            share.started = time.monotonic()
+            share.restart = False
+            return share.limit
+
+    @contextmanager
+    def share(self, job=None, streams=1, restartable=True):
+        share = BandwidthShare(job, streams, restartable)
+        with self.lock:
+            self.shares.append(share)
+        self.assign(share)
+        self._start_monitor()
+        try:
+            yield share
+        finally:
+            with self.lock:
+                self.shares.remove(share)
+
+    def _needs_restart(self, share, rate, now):
+        limit = self.share_limit(share, rate)
+        if rate != share.rate:
+            if not limit or not share.limit:
+                return limit != share.limit
+            return abs(limit - share.limit) > share.limit * BANDWIDTH_HYSTERESIS
+        return bool(limit) and share.limit > limit * (1 + BANDWIDTH_HYSTERESIS) and now - share.started >= BANDWIDTH_MIN_RUN
+
+    def rebalance(self):
+        with self.lock:
+            rate = self.current_rate()
+            now = time.monotonic()
+            for share in self.shares:
+                if share.restartable and share.process and not share.restart and self._needs_restart(share, rate, now):
+                    share.restart = True
+                    share.process.terminate()
+
+    def _start_monitor(self):
+        with self.lock:
+            if self._monitor is not None or not self.windows:
+                return
+            self._monitor = threading.Thread(target=self._watch, daemon=True)
+            self._monitor.start()
+
+    def _watch(self):
+        while True:
+            time.sleep(BANDWIDTH_CHECK_INTERVAL)
+            self.rebalance()
+
+
+try:
+    BANDWIDTH = BandwidthBudget(BANDWIDTH_SCHEDULE)
+except ValueError as e:
+    print(f"ERREUR: SHARLIO_BANDWIDTH ignoré. {e}", file=sys.stderr)
+    BANDWIDTH = BandwidthBudget()
+
+async def _rsync_process(cmd, text_callback=None, line_callback=None, control=None, streams=1):
+    """Comme ENGINE.run, pour un rsync qui transfère le contenu d'une tâche depuis le miroir :
+    il reçoit la part d'un de ses streams flux dans le budget de bande passante (--bwlimit)
+    et est relancé si BANDWIDTH le demande."""
+    on_line = _line_handler(text_callback, line_callback)
+    with BANDWIDTH.share(control.job if control else None, streams) as share:
+        while True:
+            limit = BANDWIDTH.assign(share)
+            limited_cmd = cmd[:1] + ([f"--bwlimit={limit}"] if limit else []) + cmd[1:]
+            code = await ENGINE.run(limited_cmd, on_line, control, on_start=lambda child: setattr(share, "process", child),
+                                    progress_callback=line_callback)
+            if not share.restart:
+                return code
+            if text_callback:
+                limit = BANDWIDTH.assign(share)
+                text_callback(f"Nouvelle limite de bande passante : {format_size(limit * 1024) + '/s' if limit else 'aucune'} (rsync relancé).")
+
+def _run_rsync(cmd, text_callback=None, line_callback=None):
+    return ENGINE.wait(_rsync_process(cmd, text_callback, line_callback, current_job_control()))
+
+def _count_changes(source, previous):
+    """Compte les fichiers nouveaux, modifiés et supprimés de source par rapport à previous
+    (rsync en simulation, sans copie)."""
+    counts = {"new": 0, "updated": 0, "deleted": 0}
+
+    def on_line(line):
+        if line.startswith("*deleting") and not line.endswith("/"):
+            counts["deleted"] += 1
+        elif line.startswith(">f"):
+            counts["new" if line[2:11] == "+++++++++" else "updated"] += 1
+
+    cmd = ["rsync", "-rltn", "--delete", "--itemize-changes", *PUBLISH_EXCLUDES, f"{source}/", f"{previous}/"]
+    if _run_command(cmd, line_callback=on_line) != 0:
+        return None
+    return counts
+
+def _snapshot_name(snapshots_root):
+    # Les noms doivent rester triables : le plus récent est toujours le dernier
+    name = time.strftime("%Y%m%d-%H%M%S")
+    latest = max((entry for entry in os.listdir(snapshots_root) if entry[:1].isdigit()), default="")
+    candidate = name
+    suffix = 1
+    while candidate <= latest:
+        candidate = f"{name}-{suffix:02d}"
+        suffix += 1
+    return candidate
+
+def _replace_symlink(target, link_path):
+    tmp_link = f"{link_path}.tmp"
+    if os.path.lexists(tmp_link):
+        os.remove(tmp_link)
+    os.symlink(target, tmp_link)
+    os.replace(tmp_link, link_path)
+
+def _link_tree(source, target, excludes=()):
+    # Équivalent de cp -al : arborescence de liens physiques vers source, sans les entrées de
+    # premier niveau excludes. Renvoie le nombre de fichiers liés.
+    files = 0
+    created = []
+    for root, dirs, names in os.walk(source):
+        target_root = os.path.normpath(os.path.join(target, os.path.relpath(root, source)))
+        if root == source:
+            dirs[:] = [name for name in dirs if name not in excludes]
+            names = [name for name in names if name not in excludes]
+        os.makedirs(target_root, exist_ok=True)
+        created.append((root, target_root))
+        for name in dirs + names:
+            src = os.path.join(root, name)
+            if os.path.islink(src):
+                os.symlink(os.readlink(src), os.path.join(target_root, name))
+            elif name in names:
+                os.link(src, os.path.join(target_root, name))
+                files += 1
+    for root, target_root in reversed(created):
+        shutil.copystat(root, target_root)
+    return files
+
+def publish_snapshot(source, final_dest, text_callback=None, keep=SNAPSHOT_RETENTION, result=None):
+    """Publie source dans final_dest sous forme d'instantané.
+
+    L'instantané est construit dans <parent>/.snapshots/<nom>/<horodatage> par liens
+    physiques vers les fichiers du staging source, sans aucune copie : le staging ne modifie
+    jamais un fichier sur place (rsync, debmirror et le moteur delta écrivent un fichier
+    temporaire puis le renomment). Si source est sur un autre système de fichiers, rsync
+    copie les fichiers modifiés et lie les autres à l'instantané précédent (--link-dest).
+    Le lien <parent>/.snapshots/<nom>/current est ensuite basculé atomiquement. final_dest est un lien
+    vers ce dernier : les clients ne voient jamais un dépôt à moitié mis à jour.
+    Si result est fourni, les fichiers nouveaux, modifiés et supprimés y sont comptés."""
+    parent, name = os.path.split(os.path.normpath(final_dest))
+    snapshots_root = os.path.join(parent, ".snapshots", name)
+    current_link = os.path.join(snapshots_root, "current")
+    os.makedirs(snapshots_root, exist_ok=True)
+
+    if os.path.islink(current_link):
+        previous = os.path.realpath(current_link)
+    elif os.path.isdir(final_dest) and not os.path.islink(final_dest):
+        previous = final_dest
+    else:
+        previous = None
+
+    if result is not None and previous:
+        changes = _count_changes(source, previous)
+        if changes:
+            result.add_changes(**changes)
+
+    snapshot = os.path.join(snapshots_root, _snapshot_name(snapshots_root))
+    if os.stat(source).st_dev == os.stat(snapshots_root).st_dev:
+        try:
+            files = _link_tree(source, snapshot, (DELTA_WORK_DIR, POOL_INDEX_FILE))
+        except OSError as e:
+            shutil.rmtree(snapshot, ignore_errors=True)
+            if text_callback:
+                text_callback(f"ERREUR: Impossible de construire l'instantané {snapshot}. {e}")
+            return 1
+    else:
+        cmd = ["rsync", "-rlt", "--stats", *PUBLISH_EXCLUDES]
+        if previous:
+            cmd.append(f"--link-dest={os.path.abspath(previous)}")
+        cmd += [f"{source}/", f"{snapshot}/"]
+        stats = {}
+        returncode = _run_command(cmd, text_callback, lambda line: _parse_rsync_stats(line, stats))
+        if returncode != 0:
+            shutil.rmtree(snapshot, ignore_errors=True)
+            return returncode
+        files = stats.get("transferred", 0)
+    if result is not None and not previous:
+        result.add_changes(new=files)
+
+    _replace_symlink(os.path.basename(snapshot), current_link)
+
+    if not os.path.islink(final_dest) or os.readlink(final_dest) != os.path.relpath(current_link, parent):
+        if os.path.isdir(final_dest) and not os.path.islink(final_dest):
+            # Ancien miroir copié en place : il devient l'instantané le plus ancien
+            os.rename(final_dest, os.path.join(snapshots_root, "00000000-000000"))
+        _replace_symlink(os.path.relpath(current_link, parent), final_dest)
+
+    if text_callback:
+        text_callback(f"Instantané publié : {snapshot}")
+    prune_snapshots(snapshots_root, keep, text_callback)
+    return 0
+
+def prune_snapshots(snapshots_root, keep=SNAPSHOT_RETENTION, text_callback=None):
+    current = os.path.realpath(os.path.join(snapshots_root, "current"))
+    snapshots = sorted(
+        entry for entry in os.listdir(snapshots_root)
+        if entry[:1].isdigit() and os.path.isdir(os.path.join(snapshots_root, entry))
+    )
+    for entry in snapshots[:-max(1, keep)]:
+        path = os.path.join(snapshots_root, entry)
+        if os.path.realpath(path) == current:
+            continue
+        shutil.rmtree(path, ignore_errors=True)
+        if text_callback:
+            text_callback(f"Ancien instantané supprimé : {entry}")
+
+
+def _parse_release(text):
+    """{chemin relatif à dists/<dist>: (taille, sha256)} d'après la section SHA256 d'un Release."""
+    files = {}
+    in_sha256 = False
+    for line in text.splitlines():
+        if line.startswith("SHA256:"):
+            in_sha256 = True
+        elif in_sha256 and line.startswith(" "):
+            sha256, size, name = line.split()
+            files[name] = (int(size), sha256)
+        else:
+            in_sha256 = False
+    return files
+
+def _parse_packages(text):
+    """{chemin dans le pool: (taille, sha256)} d'après un index Packages."""
+    files = {}
+    filename = size = sha256 = None
+    for line in text.splitlines():
+        if line.startswith("Filename: "):
+            filename = line[10:].strip()
+        elif line.startswith("Size: "):
+            size = int(line[6:])
+        elif line.startswith("SHA256: "):
+            sha256 = line[8:].strip()
+        elif not line:
+            if filename:
+                files[filename] = (size, sha256)
+            filename = size = sha256 = None
+    if filename:
+        files[filename] = (size, sha256)
+    return files
+
+def _parse_sources(text):
+    """{chemin dans le pool: (taille, sha256)} d'après un index Sources."""
+    files = {}
+    directory = None
+    checksums = []
+    in_sha256 = False
+    for line in text.splitlines() + [""]:
+        if line.startswith(" ") and in_sha256:
+            sha256, size, name = line.split()
+            checksums.append((name, int(size), sha256))
+            continue
+        in_sha256 = line.startswith("Checksums-Sha256:")
+        if line.startswith("Directory: "):
+            directory = line[11:].strip()
+        elif not line:
+            for name, size, sha256 in checksums:
+                files[f"{directory}/{name}"] = (size, sha256)
+            directory = None
+            checksums = []
+    return files
+
+def _read_index(path):
+    # Packages/Sources : la version .xz, sinon .gz, sinon non compressée
+    for suffix, opener in ((".xz", lzma.open), (".gz", gzip.open), ("", open)):
+        if os.path.exists(path + suffix):
+            with opener(path + suffix, "rt", encoding="utf-8", errors="replace") as f:
+                return f.read()
+    return None
+
+def _sha256_file(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def _load_pool_index(staging_dest):
+    try:
+        with open(os.path.join(staging_dest, POOL_INDEX_FILE), encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def _save_pool_index(staging_dest, index):
+    path = os.path.join(staging_dest, POOL_INDEX_FILE)
+    with open(f"{path}.tmp", "w", encoding="utf-8") as f:
+        json.dump(index, f)
+    os.replace(f"{path}.tmp", path)
+
+def _file_list_cmd(rsync_user, root, paths, dest_root, list_path, extra_args=()):
+    with open(list_path, "w", encoding="utf-8") as f:
+        f.write("\n".join(paths) + "\n")
+    return ["rsync", "-t", f"--files-from={list_path}", *extra_args, rsync_url(rsync_user, f"{root}/"), dest_root]
 
-    process.wait()
+def _rsync_file_list(rsync_user, root, paths, dest_root, list_path, extra_args=(), text_callback=None, line_callback=None):
+    # Release et index : courts, ils ne prennent pas de part du budget de bande passante
+    return _run_command(_file_list_cmd(rsync_user, root, paths, dest_root, list_path, extra_args), text_callback, line_callback)
+
+def _hash_pool_files(staging_dest, entries, workers=DELTA_WORKERS):
+    """Empreintes SHA256 des fichiers (chemin, stat) du pool local, calculées en parallèle."""
+    def digest(entry):
+        path, stat = entry
+        return path, [stat.st_size, stat.st_mtime_ns, _sha256_file(os.path.join(staging_dest, path))]
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        return dict(executor.map(digest, entries))
+
+def _plan_dist(root, dist, sections, work_dir, rsync_user, arches, source, i18n, link_args, text_callback):
+    # Release et index d'une distribution dans work_dir/dists/<dist> -> fichiers du pool voulus
+    new_dists = os.path.join(work_dir, "dists", dist)
+    os.makedirs(new_dists)
+    top_files = [f"dists/{dist}/{name}" for name in ("Release", "InRelease", "Release.gpg")]
+    code = _rsync_file_list(rsync_user, root, top_files, work_dir, os.path.join(work_dir, f"release-{dist}.list"), link_args, text_callback)
+    release_path = os.path.join(new_dists, "Release")
+    if code != 0 or not os.path.exists(release_path):
+        if text_callback:
+            text_callback(f"ERREUR: Release de {root}/dists/{dist} introuvable (code {code}).")
+        return None
+    with open(release_path, encoding="utf-8", errors="replace") as f:
+        release = _parse_release(f.read())
+
+    kinds = {f"binary-{arch}" for arch in arches} | ({"source"} if source else set()) | ({"i18n"} if i18n else set())
+    indexes = {name: entry for name, entry in release.items()
+               if name.split("/")[0] in sections and len(name.split("/")) > 2 and name.split("/")[1] in kinds
+               and "by-hash" not in name}
+    code = _rsync_file_list(rsync_user, root, [f"dists/{dist}/{name}" for name in sorted(indexes)], work_dir,
+                            os.path.join(work_dir, f"indexes-{dist}.list"), link_args, text_callback)
+    if code != 0:
+        return None
+    for name, (size, sha256) in indexes.items():
+        path = os.path.join(new_dists, name)
+        if os.path.exists(path) and (os.path.getsize(path) != size or _sha256_file(path) != sha256):
+            if text_callback:
+                text_callback(f"ERREUR: {name} ne correspond pas au Release (miroir en cours de mise à jour ?).")
+            return None
+
+    wanted = {}
+    for section in sections:
+        for arch in arches:
+            text = _read_index(os.path.join(new_dists, section, f"binary-{arch}", "Packages"))
+            if text is not None:
+                wanted.update(_parse_packages(text))
+        if source:
+            text = _read_index(os.path.join(new_dists, section, "source", "Sources"))
+            if text is not None:
+                wanted.update(_parse_sources(text))
+    return wanted
+
+def plan_delta(root, dist, sections, staging_dest, rsync_user, arches=DEBIAN_ARCHES, source=False, i18n=False,
+               excludes=MIRROR_EXCLUDES, text_callback=None, workers=DELTA_WORKERS, pool_dir=None, verify=True,
+               work_dir=None):
+    """Prépare la synchronisation par index de dists/<dist> du module root ; dist peut
+    désigner plusieurs distributions ("bookworm,trixie") qui partagent alors le pool.
+
+    Release et les index Packages/Sources des sections et architectures voulues sont
+    téléchargés dans <staging_dest>/.delta (les index inchangés sont liés depuis le
+    staging), vérifiés, puis comparés au pool local (taille et SHA256, mémorisés dans
+    .pool-index.json). Renvoie le plan : fichiers voulus, fichiers à télécharger et leur
+    taille totale exacte ; None en cas d'échec.
+    pool_dir désigne un autre miroir à comparer (tailles et empreintes y sont lues) ; avec
+    verify=False, seule la taille compte. work_dir remplace <staging_dest>/.delta : le
+    staging n'est alors ni créé ni modifié."""
+    work_dir = work_dir or os.path.join(staging_dest, DELTA_WORK_DIR)
+    shutil.rmtree(work_dir, ignore_errors=True)
+    os.makedirs(work_dir)
+    link_args = ["--ignore-missing-args", *reference_args(work_dir, [staging_dest])]
+
+    wanted = {}
+    for name in dist.split(","):
+        dist_wanted = _plan_dist(root, name, sections, work_dir, rsync_user, arches, source, i18n, link_args, text_callback)
+        if dist_wanted is None:
+            return None
+        wanted.update(dist_wanted)
+    if excludes:
+        excluded = re.compile("|".join(excludes))
+        wanted = {path: entry for path, entry in wanted.items() if not excluded.search(os.path.basename(path))}
+
+    pool_dir = pool_dir or staging_dest
+    index = _load_pool_index(staging_dest) if verify else {}
+    fetch = []
+    to_hash = []
+    for path, (size, sha256) in wanted.items():
+        try:
+            stat = os.stat(os.path.join(pool_dir, path))
+        except OSError:
+            fetch.append(path)
+            continue
+        known = index.get(path)
+        if stat.st_size != size:
+            fetch.append(path)
+        elif not verify:
+            continue
+        elif not known or known[:2] != [stat.st_size, stat.st_mtime_ns]:
+            to_hash.append((path, stat))
+        elif known[2] != sha256:
+            fetch.append(path)
+    if to_hash:
+        if text_callback:
+            text_callback(f"Indexation du pool local : {len(to_hash)} fichiers à vérifier.")
+        hashed = _hash_pool_files(pool_dir, to_hash, workers)
+        index.update(hashed)
+        fetch += [path for path, entry in hashed.items() if entry[2] != wanted[path][1]]
+
+    return {
+        "root": root,
+        "dist": dist,
+        "work_dir": work_dir,
+        "wanted": wanted,
+        "index": index,
+        "fetch": sorted(fetch),
+        "bytes": sum(wanted[path][0] for path in fetch),
+    }
+
+def _split_by_size(paths, sizes, count):
+    # Répartit les fichiers en count lots de tailles voisines, les plus gros d'abord
+    chunks = [[] for _ in range(max(1, min(count, len(paths))))]
+    loads = [0] * len(chunks)
+    for path in sorted(paths, key=lambda p: sizes[p][0], reverse=True):
+        i = loads.index(min(loads))
+        chunks[i].append(path)
+        loads[i] += sizes[path][0]
+    return chunks
+
+def delta_sync(root, dist, sections, staging_dest, rsync_user, text_callback=None, percent_callback=None, progress=None,
+               workers=DELTA_WORKERS, seed_root=None, **plan_options):
+    """Synchronise dists/<dist> de root dans staging_dest sans debmirror : seuls les fichiers
+    du pool absents ou différents sont téléchargés, par workers processus rsync en parallèle,
+    puis les nouveaux index remplacent les anciens et les fichiers du pool qui ne sont plus
+    référencés sont supprimés. dist peut regrouper plusieurs distributions (voir plan_delta).
+    Avec seed_root, les fichiers déjà présents sous ce dossier (index de mirror_dedup) sont
+    liés ou copiés localement au lieu d'être téléchargés. Renvoie un code de sortie."""
+    progress = progress or TransferProgress()
+    plan = plan_delta(root, dist, sections, staging_dest, rsync_user, text_callback=text_callback, workers=workers, **plan_options)
+    if plan is None:
+        return 1
+    fetch, wanted, index = plan["fetch"], plan["wanted"], plan["index"]
+    download = fetch
+    if seed_root and fetch:
+        seeded = set(seed_files(seed_root, staging_dest, {path: wanted[path] for path in fetch}, text_callback))
+        if seeded:
+            download = [path for path in fetch if path not in seeded]
+            plan["bytes"] -= sum(wanted[path][0] for path in seeded)
+            if text_callback:
+                text_callback(f"Pré-remplissage : {len(seeded)} fichiers repris du miroir local.")
+    if text_callback:
+        text_callback(f"À télécharger : {len(download)} fichiers sur {len(wanted)}, {format_size(plan['bytes'])}.")
+    progress.update(0, plan["bytes"])
+
+    parts = []
+    control = current_job_control()
+
+    async def worker(cmd):
+        # Les rsync du pool tournent ensemble dans la boucle de ENGINE
+        part = TransferProgress()
+        parts.append(part)
+
+        def on_line(line):
+            if "%" in line:
+                _parse_rsync_progress(line, None, part)
+                progress.update(sum(p.bytes_done for p in parts), plan["bytes"], rate=sum(p.rate for p in parts))
+                if percent_callback:
+                    percent_callback(progress.percent)
+
+        code = await _rsync_process(cmd, text_callback, on_line, control, len(cmds))
+        part.rate = 0.0
+        return code
+
+    cmds = [_file_list_cmd(rsync_user, root, chunk, staging_dest, os.path.join(plan["work_dir"], f"pool-{number}.list"),
+                           ["--partial", "--partial-dir=.rsync-partial", "--info=progress2", "--no-inc-recursive"])
+            for number, chunk in enumerate(_split_by_size(download, wanted, workers)) if chunk]
+    codes = [code for code in ENGINE.gather([worker(cmd) for cmd in cmds]) if code != 0]
+    if codes:
+        if text_callback:
+            text_callback(f"ERREUR rsync sur le pool de {root}/{dist} (code {codes[0]}).")
+        return codes[0]
+
+    fetched = [(path, os.stat(os.path.join(staging_dest, path))) for path in fetch]
+    index.update(_hash_pool_files(staging_dest, fetched, workers))
+    corrupted = [path for path in fetch if index[path][2] != wanted[path][1]]
+    if corrupted:
+        for path in corrupted:
+            os.remove(os.path.join(staging_dest, path))
+            del index[path]
+        if text_callback:
+            text_callback(f"ERREUR: {len(corrupted)} fichiers téléchargés ne correspondent pas aux index (ex. {corrupted[0]}).")
+        _save_pool_index(staging_dest, index)
+        return 1
+
+    for name in dist.split(","):
+        dists_dir = os.path.join(staging_dest, "dists", name)
+        os.makedirs(os.path.dirname(dists_dir), exist_ok=True)
+        if os.path.isdir(dists_dir):
+            os.rename(dists_dir, f"{dists_dir}.old")
+        os.rename(os.path.join(plan["work_dir"], "dists", name), dists_dir)
+        shutil.rmtree(f"{dists_dir}.old", ignore_errors=True)
+
+    removed = 0
+    for dirpath, dirs, files in os.walk(os.path.join(staging_dest, "pool"), topdown=False):
+        for name in files:
+            path = os.path.relpath(os.path.join(dirpath, name), staging_dest)
+            if path not in wanted:
+                os.remove(os.path.join(dirpath, name))
+                removed += 1
+        if not os.listdir(dirpath):
+            os.rmdir(dirpath)
+    if removed and text_callback:
+        text_callback(f"{removed} fichiers retirés du pool.")
+    _save_pool_index(staging_dest, {path: index[path] for path in wanted if path in index})
+    shutil.rmtree(plan["work_dir"], ignore_errors=True)
+    progress.update(plan["bytes"], plan["bytes"])
+    return 0
+
+# Pas de --append/--append-verify : ils écrivent dans le fichier existant, et un fichier lié
+# par la déduplication changerait aussi dans l'autre miroir. --partial-dir suffit à reprendre
+RSYNC_OPTIONS = ["--partial", "--partial-dir=.rsync-partial", "--no-inplace",
+                 "--info=progress2", "--no-inc-recursive", "--stats"]
+
+
+def content_filter(profile=None, arches=None, isos=None, debug=None, source=None):
+    """Contenu retenu pour une tâche rsync : le profil (DEFAULT_CONTENT_PROFILE par défaut),
+    précisé par les réglages explicites qui ne valent pas None."""
+    profile = profile or DEFAULT_CONTENT_PROFILE
+    if profile not in CONTENT_PROFILES:
+        raise ValueError(f"Profil de contenu inconnu : {profile!r} (choix : {', '.join(CONTENT_PROFILES)})")
+    content = dict(CONTENT_PROFILES[profile])
+    for key, value in (("arches", arches), ("isos", isos), ("debug", debug), ("source", source)):
+        if value is not None:
+            content[key] = value
+    return content
+
+def rsync_filter_rules(content):
+    """Règles d'exclusion rsync ("- motif") correspondant au contenu retenu."""
+    if not content:
+        return []
+    rules = []
+    if content.get("arches"):
+        rules += [f"- {arch}/" for arch in RPM_ARCHES if arch not in content["arches"]]
+    if not content.get("isos", True):
+        rules += ["- /isos/", "- *.iso"]
+    if not content.get("debug", True):
+        rules += ["- debug/", "- *-debuginfo-*.rpm", "- *-debugsource-*.rpm"]
+    if not content.get("source", True):
+        rules += ["- Source/", "- source/", "- SRPMS/", "- *.src.rpm"]
+    return rules
+
+def _filtered_out(relpath, rules):
+    # Même lecture que rsync pour les seuls motifs produits par rsync_filter_rules
+    parts = relpath.split("/")
+    for rule in rules:
+        pattern = rule[2:]
+        if pattern.endswith("/"):
+            dirs = parts[:-1][:1] if pattern.startswith("/") else parts[:-1]
+            if pattern.strip("/") in dirs:
+                return True
+        elif fnmatch.fnmatchcase(parts[-1], pattern):
+            return True
+    return False
+
+def crawl_job(job, content=None, ttl=CRAWL_TTL, text_callback=None):
+    """Parcourt en HTTP l'arborescence d'une tâche AlmaLinux/Rocky sur le serveur courant, sans
+    descendre dans les dossiers exclus par content, et met à jour son index local.
+    Renvoie (index, bilan de RemoteIndex.crawl) ; index vaut None si le miroir ne répond pas."""
+    os_name, distri = job
+    rules = rsync_filter_rules(content)
+    index = RemoteIndex(f"{os_name}/{distri}/").load()
+    stats = index.crawl(_get_session(), current_endpoint().url, ttl=ttl, text_callback=text_callback,
+                        include=(lambda relpath: not _filtered_out(relpath, rules)) if rules else None)
+    return (index if stats["dirs"] else None), stats
+
+def indexed_size(os_name, distri, content=None):
+    """Volume retenu par content d'après le dernier parcours HTTP de la tâche, sans requête :
+    {"bytes", "files", "crawled"}, ou None si la tâche n'a pas été parcourue ou que les pages
+    d'index ne donnent pas toutes les tailles."""
+    index = RemoteIndex(f"{os_name}/{distri}/").load()
+    if not index.dirs:
+        return None
+    rules = rsync_filter_rules(content)
+    totals = index.total(keep=lambda relpath: not _filtered_out(relpath, rules))
+    if totals["unknown"]:
+        return None
+    return {"bytes": totals["bytes"], "files": totals["files"], "crawled": index.crawled}
+
+def _estimate_from_index(job, dest, content):
+    # Fichiers de l'index HTTP absents de dest ou de taille différente ; les dates sont ignorées,
+    # les pages d'index les donnent à la minute et dans le fuseau du serveur
+    index, _ = crawl_job(job, content)
+    if index is None:
+        return None
+    rules = rsync_filter_rules(content)
+    needed = total = 0
+    for relpath, size, _, exact in index.files():
+        if _filtered_out(relpath, rules):
+            continue
+        if size is None:
+            return None
+        total += size
+        try:
+            local_size = os.stat(os.path.join(dest, relpath)).st_size
+        except OSError:
+            local_size = None
+        if local_size is None or not size_matches(local_size, size, exact):
+            needed += size
+    return {"bytes": needed, "total": total, "staging": False}
+
+def estimate_content_savings(os_name, distri, rsync_user, content):
+    """Compare la taille complète et la taille retenue par le filtre de contenu, d'après
+    l'index HTTP de la tâche, à défaut un listage récursif du module rsync. Renvoie None si
+    le listage échoue."""
+    rules = rsync_filter_rules(content)
+    totals = {"bytes_total": 0, "bytes_kept": 0, "files_total": 0, "files_kept": 0}
+
+    def add_file(relpath, size):
+        totals["bytes_total"] += size
+        totals["files_total"] += 1
+        if not _filtered_out(relpath, rules):
+            totals["bytes_kept"] += size
+            totals["files_kept"] += 1
+
+    def on_line(line):
+        fields = line.split(None, 4)
+        if len(fields) != 5 or not fields[0].startswith("-"):
+            return
+        add_file(fields[4], int(fields[1].replace(",", "")))
+
+    index, _ = crawl_job((os_name, distri))
+    if index is not None and not index.total()["unknown"]:
+        for relpath, size, _, _ in index.files():
+            add_file(relpath, size)
+        return totals
+    if _run_command(["rsync", "-r", "--list-only", rsync_url(rsync_user, f"{os_name}/{distri}/")], line_callback=on_line) != 0:
+        return None
+    return totals
+
+def _list_module_dirs(rsync_user, module_path):
+    """Sous-dossiers de premier niveau d'un module rsync, ou None si le listage échoue."""
+    dirs = []
+
+    def on_line(line):
+        # "drwxr-xr-x          4,096 2024/05/01 12:00:00 BaseOS"
+        fields = line.split(None, 4)
+        if len(fields) == 5 and fields[0].startswith("d") and fields[4] != ".":
+            dirs.append(fields[4])
+
+    if _run_command(["rsync", "--list-only", rsync_url(rsync_user, module_path)], line_callback=on_line) != 0:
+        return None
+    return sorted(dirs)
+
+def _merge_progress(progress, parts, percent_callback=None):
+    progress.update(sum(part.bytes_done for part in parts), sum(part.bytes_total for part in parts),
+                    rate=sum(part.rate for part in parts),
+                    files_remaining=sum(part.files_remaining or 0 for part in parts),
+                    files_total=sum(part.files_total or 0 for part in parts))
+    if percent_callback:
+        percent_callback(progress.percent)
+
+def _sharded_rsync(module_path, target_dir, rsync_user, shards, text_callback=None, percent_callback=None, progress=None, stats=None, filter_args=()):
+    """Synchronise module_path avec plusieurs processus rsync : chaque sous-dossier de premier
+    niveau (BaseOS, AppStream, isos…) est un lot, et shards processus se partagent les lots.
+    L'avancement des processus est cumulé dans progress et les compteurs --stats dans stats.
+    Les fichiers du premier niveau sont copiés en dernier. Renvoie None si le module n'a pas
+    assez de sous-dossiers pour être découpé."""
+    dirs = _list_module_dirs(rsync_user, module_path)
+    if not dirs or len(dirs) < 2:
+        return None
+    if text_callback:
+        text_callback(f"Synchronisation en {min(shards, len(dirs))} flux de {len(dirs)} dossiers : {', '.join(dirs)}")
+
+    # Adresses calculées ici : le serveur courant est propre au thread de la tâche
+    pending = [(name, rsync_url(rsync_user, module_path + name)) for name in dirs]
+    parts = []
+    codes = []
+    control = current_job_control()
+
+    async def worker():
+        # shards rsync tournent ensemble dans la boucle de ENGINE et se partagent les lots
+        while pending and not codes:
+            name, url = pending.pop(0)
+            part = TransferProgress()
+            parts.append(part)
+            part_stats = {}
+
+            def on_line(line):
+                _parse_rsync_stats(line, part_stats)
+                if "%" in line:
+                    _parse_rsync_progress(line, None, part)
+                    _merge_progress(progress, parts, percent_callback)
+
+            def on_text(line, name=name):
+                if text_callback:
+                    text_callback(f"[{name}] {line}")
+
+            cmd = ["rsync", "-rlt"] + RSYNC_OPTIONS + list(filter_args) + [url, target_dir]
+            code = await _rsync_process(cmd, on_text, on_line, control, streams)
+            part.rate = 0.0
+            _merge_progress(progress, parts)
+            for key, value in part_stats.items():
+                stats[key] = stats.get(key, 0) + value
+            if code != 0:
+                codes.append(code)
+                if text_callback:
+                    text_callback(f"ERREUR rsync sur {module_path}{name} (code {code}).")
+
+    streams = min(shards, len(dirs))
+    ENGINE.gather([worker() for _ in range(streams)])
+    if codes:
+        return codes[0]
+
+    part_stats = {}
+    # Fichiers de premier niveau (horodatage, sommes) : hors budget de bande passante
+    cmd = ["rsync", "-lt", "--dirs"] + RSYNC_OPTIONS + list(filter_args) + [rsync_url(rsync_user, module_path), target_dir]
+    code = _run_command(cmd, text_callback, lambda line: _parse_rsync_stats(line, part_stats))
+    for key, value in part_stats.items():
+        stats[key] = stats.get(key, 0) + value
+    return code
+
+def _reference_dirs(path, os_name, distri):
+    # Miroirs locaux proches de os_name/distri, les plus ressemblants d'abord : même version
+    # majeure (même OS en tête), puis les autres versions
+    major = distri.split(".")[0]
+    candidates = []
+    for other_os in ("almalinux", "rockylinux"):
+        os_dir = os.path.join(path, other_os)
+        if not os.path.isdir(os_dir):
+            continue
+        for name in os.listdir(os_dir):
+            if (other_os, name) != (os_name, distri) and not name.startswith("."):
+                candidates.append((name.split(".")[0] != major, other_os != os_name, name != distri,
+                                   [-int(part) if part.isdigit() else 0 for part in name.split(".")], other_os, name))
+    return [os.path.join(path, other_os, name) for *_, other_os, name in sorted(candidates)]
+
+def _manage_rsync_download(os_name, distri, path, rsync_user, text_callback=None, percent_callback=None, stats_callback=None, result=None, shards=None, content=None, dedup=False):
+    target_dir = f"{path}/{os_name}/{distri}" 
+    os.makedirs(target_dir, exist_ok=True)
+    module_path = f"{os_name}/{distri}/"
+    shards = RSYNC_SHARDS if shards is None else shards
+    rules = rsync_filter_rules(content)
+    filter_args = [f"--filter={rule}" for rule in rules]
+    if rules and text_callback:
+        text_callback(f"Filtre de contenu : {' '.join(rule[2:] for rule in rules)}")
+    if dedup:
+        seed_args = reference_args(target_dir, _reference_dirs(path, os_name, distri))
+        filter_args += seed_args
+        if seed_args and text_callback:
+            text_callback(f"Pré-remplissage depuis : {', '.join(arg.split('=', 1)[1] for arg in seed_args)}")
+
+    progress = TransferProgress(stats_callback)
+    stats = {}
+
+    def on_line(line):
+        _parse_rsync_progress(line, percent_callback, progress)
+        _parse_rsync_stats(line, stats)
+
+    with _phase(result, "download"):
+        returncode = None
+        if shards > 1:
+            returncode = _sharded_rsync(module_path, target_dir, rsync_user, shards, text_callback, percent_callback, progress, stats, filter_args)
+        if returncode is None:
+            cmd = ["rsync", "-rlt"] + RSYNC_OPTIONS + filter_args + [rsync_url(rsync_user, module_path), target_dir]
+            returncode = _run_rsync(cmd, text_callback, on_line)
+        progress.report(force=True)
+    _add_rsync_stats(result, stats, progress)
+
+    if returncode != 0:
+        if text_callback:
+            text_callback(f"ERREUR rsync sur {os_name}/{distri} (code {returncode}).")
+        return returncode
     if text_callback:
         text_callback(f"{os_name}/{distri} terminé.")
     if percent_callback:
         percent_callback(100)
+    return 0
 
+def manage_alma_download(os_name, distri, path, rsync_user, text_callback=None, percent_callback=None, stats_callback=None, result=None, shards=None, content=None, dedup=False):
+    return _manage_rsync_download(os_name, distri, path, rsync_user, text_callback, percent_callback, stats_callback, result, shards, content, dedup)
 
-def manage_debian_download(os_name, distri, path, rsync_user, text_callback=None, percent_callback=None):
-    final_dest = os.path.join(path, os_name, distri)
-    os.makedirs(final_dest, exist_ok=True)
 
-    temp_dest = get_temp_dir(f"debmirror-debian-{distri}")
+def _run_debmirror(cmd, text_callback=None, percent_callback=None, progress=None):
+    pool_started = False
+
+    def on_line(line):
+        nonlocal pool_started
+        pool_started = _parse_debmirror_progress(line, pool_started, percent_callback, progress)
+
+    return _run_command(cmd, text_callback, on_line)
+
+def manage_debian_download(os_name, distri, path, rsync_user, text_callback=None, percent_callback=None, stats_callback=None, result=None, engine=None, dedup=False):
+    engine = engine or DEBIAN_ENGINE
+    dists = distri.split(",")
+    final_dest = job_dest(path, (os_name, distri))
+    os.makedirs(os.path.dirname(final_dest), exist_ok=True)
 
     if text_callback:
         text_callback(f"--- Début Debian {distri} ---")
-        text_callback(f"[Étape 1/2] Téléchargement vers {temp_dest}")
+    if len(dists) > 1:
+        _migrate_dist_stagings(os_name, distri, path, text_callback)
+    staging_dest = get_staging_dir(_staging_name(os_name, distri), path, _seed_source(final_dest, dists), text_callback)
+
+    if text_callback:
+        text_callback(f"[Étape 1/2] Téléchargement vers {staging_dest}")
 
     cmd_debmirror = [
         "debmirror",
-        temp_dest,
-        f"--host={rsync_user}@mirror.sharlio.fr",
+        staging_dest,
+        *_debmirror_host_args(rsync_user),
         "--root=debian",
         "--method=rsync",
         f"--dist={distri}",
@@ -123,93 +2002,74 @@ def manage_debian_download(os_name, distri, path, rsync_user, text_callback=None
         "--i18n",
         "--ignore-release-gpg",
         "--progress",
+        f"--state-cache-days={DEBMIRROR_STATE_CACHE_DAYS}",
         "--exclude=aircrack",
         "--exclude=aircrack-ng"
     ]
 
-    process = subprocess.Popen(
-        cmd_debmirror,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.STDOUT,
-        text=True,
-        errors="replace"
-    )
-
-    pool_started = False
+    progress = TransferProgress(stats_callback)
     if percent_callback:
         percent_callback(0)
 
-    for line in process.stdout:
-        line = line.strip()
-        if text_callback:
-            text_callback(line)
-        pool_started = _parse_debmirror_progress(line, pool_started, percent_callback)
+    with BANDWIDTH.share(getattr(current_job_control(), "job", None), restartable=False) if engine != "delta" else nullcontext() as share, _phase(result, "download"):
+        if engine == "delta":
+            returncode = delta_sync("debian", distri, DEBIAN_SECTIONS, staging_dest, rsync_user, text_callback,
+                                    percent_callback, progress, seed_root=staging_root(path) if dedup else None, source=True, i18n=True)
+        else:
+            returncode = _run_debmirror(cmd_debmirror + _debmirror_rsync_args(share.limit), text_callback, percent_callback, progress)
+    progress.report(force=True)
+    if result is not None and returncode == 0:
+        result.add_transfer(progress.bytes_total, progress.peak_rate)
 
-    process.wait()
-
-    if process.returncode != 0:
+    if returncode != 0:
         if text_callback:
-            text_callback(f" ERREUR Debmirror (code {process.returncode}) – arrêt.")
-        shutil.rmtree(temp_dest, ignore_errors=True)
-        return
+            text_callback(f" ERREUR {engine} (code {returncode}) – arrêt.")
+        return returncode
+    if dedup:
+        _dedup_staging(staging_dest, path, result, text_callback)
 
     if text_callback:
-        text_callback(f"[Étape 2/2] Synchronisation vers {final_dest}")
+        text_callback(f"[Étape 2/2] Publication vers {final_dest}")
 
-    cmd_rsync = [
-        "rsync", "-rlt", "--delete",
-        "--no-inplace", "--partial", "--append-verify",
-        f"{temp_dest}/",
-        f"{final_dest}/"
-    ]
-
-    rsync_process = subprocess.Popen(
-        cmd_rsync,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.STDOUT,
-        text=True,
-        errors="replace"
-    )
-
-    for line in rsync_process.stdout:
+    with _phase(result, "publish"):
+        returncode = publish_snapshot(staging_dest, final_dest, text_callback, result=result)
+    if returncode != 0:
         if text_callback:
-            text_callback(line.strip())
-
-    rsync_process.wait()
-
-    shutil.rmtree(temp_dest, ignore_errors=True)
+            text_callback(f" ERREUR publication vers {final_dest} (code {returncode}).")
+        return returncode
+    if len(dists) > 1:
+        _link_shared_dists(final_dest, dists, text_callback)
 
     if text_callback:
         text_callback(f"✔ Miroir Debian {distri} terminé.")
     if percent_callback:
         percent_callback(100)
+    return 0
 
-def manage_proxmox_download(os_name, proxmox_category, debian_dist, path, rsync_user, text_callback=None, percent_callback=None):
-    repo_map = {
-        "pve": {"root": "proxmox-pve", "section": "pve-no-subscription"},
-        "pbs": {"root": "proxmox-pbs", "section": "pbs-no-subscription"},
-        "ceph-reef": {"root": "proxmox-ceph-reef", "section": "no-subscription"},
-        "ceph-squid": {"root": "proxmox-ceph-squid", "section": "no-subscription"}
-    }
-
-    if proxmox_category not in repo_map:
+def manage_proxmox_download(os_name, proxmox_category, debian_dist, path, rsync_user, text_callback=None, percent_callback=None, stats_callback=None, result=None, engine=None, dedup=False):
+    if proxmox_category not in PROXMOX_REPOS:
         if text_callback: text_callback(f"Catégorie Proxmox inconnue : {proxmox_category}")
-        return
+        return 1
 
-    repo_config = repo_map[proxmox_category]
+    repo_config = PROXMOX_REPOS[proxmox_category]
+    engine = engine or DEBIAN_ENGINE
     rsync_module = repo_config["root"]
     section = repo_config["section"]
     
-    final_dest = f"{path}/proxmox/{proxmox_category}/{debian_dist}"
-    temp_dest = get_temp_dir(f"debmirror-proxmox-{proxmox_category}-{debian_dist}")
+    dists = debian_dist.split(",")
+    final_dest = job_dest(path, (os_name, f"{proxmox_category}:{debian_dist}"))
+    if len(dists) > 1:
+        _migrate_dist_stagings(os_name, f"{proxmox_category}:{debian_dist}", path, text_callback)
+    staging_dest = get_staging_dir(_staging_name(os_name, f"{proxmox_category}:{debian_dist}"), path,
+                                   _seed_source(final_dest, dists), text_callback)
     
     if text_callback:
         text_callback(f"\n--- [Proxmox] Sync {proxmox_category} (Dist: {debian_dist}) ---")
-        text_callback(f"[Étape 1/2] DL vers temp: {temp_dest}")
+        text_callback(f"[Étape 1/2] DL vers staging : {staging_dest}")
 
     cmd_debmirror = [
-        "debmirror", temp_dest,
-        f"--host={rsync_user}@mirror.sharlio.fr",
+        "debmirror", staging_dest,
+        *_debmirror_host_args(rsync_user),
         f"--root={rsync_module}", 
         "--method=rsync",
         f"--dist={debian_dist}",
@@ -218,74 +2078,871 @@ def manage_proxmox_download(os_name, proxmox_category, debian_dist, path, rsync_
         "--ignore-release-gpg",
         "--exclude=aircrack",
         "--exclude=aircrack-ng",
+        f"--state-cache-days={DEBMIRROR_STATE_CACHE_DAYS}",
         "--progress"
     ]
 
-    process = subprocess.Popen(cmd_debmirror, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, 
-                               text=True, errors='replace')
-    
-    pool_started = False
+    progress = TransferProgress(stats_callback)
     if percent_callback: percent_callback(0)
 
-    for line in process.stdout:
-        line = line.strip()
-        if text_callback: text_callback(line)
-        pool_started = _parse_debmirror_progress(line, pool_started, percent_callback)
-    
-    process.wait()
-    if process.returncode != 0:
-        if text_callback: text_callback(f"ERREUR sur {proxmox_category} {debian_dist} (code {process.returncode}).")
-        shutil.rmtree(temp_dest, ignore_errors=True)
-        return 
+    with BANDWIDTH.share(getattr(current_job_control(), "job", None), restartable=False) if engine != "delta" else nullcontext() as share, _phase(result, "download"):
+        if engine == "delta":
+            returncode = delta_sync(rsync_module, debian_dist, (section,), staging_dest, rsync_user, text_callback,
+                                    percent_callback, progress, seed_root=staging_root(path) if dedup else None)
+        else:
+            returncode = _run_debmirror(cmd_debmirror + _debmirror_rsync_args(share.limit), text_callback, percent_callback, progress)
+    progress.report(force=True)
+    if result is not None and returncode == 0:
+        result.add_transfer(progress.bytes_total, progress.peak_rate)
+    if returncode != 0:
+        if text_callback: text_callback(f"ERREUR sur {proxmox_category} {debian_dist} (code {returncode}).")
+        return returncode
+    if dedup:
+        _dedup_staging(staging_dest, path, result, text_callback)
 
     if text_callback:
-        text_callback(f"[Étape 2/2] Synchro vers: {final_dest}")
-
-    os.makedirs(final_dest, exist_ok=True)
+        text_callback(f"[Étape 2/2] Publication vers : {final_dest}")
 
-    cmd_rsync = [
-        "rsync", "-rlt", "--delete", "--no-inplace", "--partial", "--append-verify",
-        f"{temp_dest}/", f"{final_dest}/"
-    ]
+    os.makedirs(os.path.dirname(final_dest), exist_ok=True)
 
-    rsync_process = subprocess.Popen(cmd_rsync, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, errors='replace')
-    for line in rsync_process.stdout:
+    with _phase(result, "publish"):
+        returncode = publish_snapshot(staging_dest, final_dest, text_callback, result=result)
+    if returncode != 0:
         if text_callback:
-            text_callback(line.strip())
-    rsync_process.wait()
-
-    shutil.rmtree(temp_dest, ignore_errors=True)
+            text_callback(f"ERREUR publication vers {final_dest} (code {returncode}).")
+        return returncode
+    if len(dists) > 1:
+        _link_shared_dists(final_dest, dists, text_callback)
 
     if text_callback:
         text_callback(f"✔ Miroir Proxmox {proxmox_category} ({debian_dist}) terminé.")
     if percent_callback:
         percent_callback(100)
+    return 0
 
 
-def manage_rocky_download(os_name, distri, path, rsync_user, text_callback=None, percent_callback=None):
-    target_dir = f"{path}/{os_name}/{distri}" 
-    os.makedirs(target_dir, exist_ok=True)
-    
-    source = f"rsync://{rsync_user}@mirror.sharlio.fr/{os_name}/{distri}/"
-    
-    cmd = ["rsync", "-rlt",  "--partial", "--partial-dir=.rsync-partial", "--append-verify","--no-inplace", "--progress", source, target_dir]
-    
-    process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, errors='replace')
-    
-    for line in process.stdout:
-        line = line.strip()
-        if text_callback:
-            text_callback(line)
-        _parse_rsync_progress(line, percent_callback)
-    
-    process.wait()
+def manage_rocky_download(os_name, distri, path, rsync_user, text_callback=None, percent_callback=None, stats_callback=None, result=None, shards=None, content=None, dedup=False):
+    return _manage_rsync_download(os_name, distri, path, rsync_user, text_callback, percent_callback, stats_callback, result, shards, content, dedup)
+
+
+def job_label(job):
+    os_name, distri = job
+    return f"{os_name}/{distri}"
+
+def job_host(os_name):
+    # Serveur d'après le dernier classement connu, sans sondage
+    return ENDPOINTS.best(os_name, probe=False).host
+
+def job_size_hint(os_name, distri):
+    return JOB_SIZE_HINTS.get(os_name, 0)
+
+
+class JobLog:
+    """Journal complet d'une tâche, écrit dans LOG_DIR/<tâche>-<horodatage>.log."""
+
+    def __init__(self, job):
+        os.makedirs(LOG_DIR, exist_ok=True)
+        name = job_spec(job).replace(":", "_").replace("/", "_")
+        self.path = os.path.join(LOG_DIR, f"{name}-{time.strftime('%Y%m%d-%H%M%S')}.log")
+        self._file = open(self.path, "a", encoding="utf-8", errors="replace")
+
+    def write(self, line):
+        self._file.write(line + "\n")
+
+    def close(self):
+        self._file.close()
+
+
+class JobScheduler:
+    """File des tâches : les plus volumineuses d'abord, dans la limite de max_workers
+    tâches simultanées et de per_host_limit tâches par serveur."""
+
+    def __init__(self, jobs, max_workers=DEFAULT_MAX_WORKERS, per_host_limit=DEFAULT_PER_HOST_LIMIT, sizes=None):
+        self.max_workers = max(1, max_workers)
+        self.per_host_limit = max(1, per_host_limit)
+        self.sizes = dict(sizes or {})
+        self.pending = sorted(jobs, key=self.job_size, reverse=True)
+        self.running = []
+        self.finished = []
+
+    def job_size(self, job):
+        # Octets : estimation si elle existe, sinon taille indicative
+        if job in self.sizes:
+            return self.sizes[job]
+        return job_size_hint(*job) * 1024 ** 3
+
+    def _host_load(self, host):
+        return sum(1 for os_name, _ in self.running if job_host(os_name) == host)
+
+    def next_jobs(self):
+        started = []
+        for job in list(self.pending):
+            if len(self.running) >= self.max_workers:
+                break
+            if self._host_load(job_host(job[0])) >= self.per_host_limit:
+                continue
+            self.pending.remove(job)
+            self.running.append(job)
+            started.append(job)
+        return started
+
+    def job_done(self, job):
+        if job in self.running:
+            self.running.remove(job)
+        self.finished.append(job)
+
+    def cancel_pending(self):
+        cancelled = list(self.pending)
+        self.pending.clear()
+        return cancelled
+
+    def is_done(self):
+        return not self.pending and not self.running
+
+
+class JobJournal:
+    """État persistant d'une file de tâches : destination, options et état de chaque tâche
+    (pending, running, ok, skipped, failed, cancelled). Après un arrêt ou un plantage, les
+    tâches non terminées sont relancées et rsync reprend depuis ses fichiers partiels."""
+
+    UNFINISHED = ("pending", "running", "cancelled")
+
+    def __init__(self, path=JOURNAL_FILE):
+        self.path = path
+        self.lock = threading.Lock()
+        self.data = None
+
+    def load(self):
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def start(self, dest, jobs, job_options=None):
+        job_options = job_options or {}
+        with self.lock:
+            self.data = {
+                "dest": dest,
+                "started": time.time(),
+                "jobs": {job_spec(job): {"state": "pending", "options": job_options.get(job, {})} for job in jobs},
+            }
+            self._save()
+
+    def set_state(self, job, state):
+        with self.lock:
+            if self.data is None or job_spec(job) not in self.data["jobs"]:
+                return
+            self.data["jobs"][job_spec(job)]["state"] = state
+            self._save()
+
+    def unfinished(self):
+        """(dest, tâches, options par tâche) des tâches à reprendre, None s'il n'y en a pas."""
+        data = self.load()
+        if not data:
+            return None
+        try:
+            entries = [(parse_job_spec(spec), entry) for spec, entry in data["jobs"].items()
+                       if entry.get("state") in self.UNFINISHED]
+            dest = data["dest"]
+        except (KeyError, AttributeError, ValueError):
+            return None
+        if not entries:
+            return None
+        return dest, [job for job, _ in entries], {job: entry.get("options", {}) for job, entry in entries}
+
+    def clear(self):
+        with self.lock:
+            self.data = None
+            try:
+                os.remove(self.path)
+            except FileNotFoundError:
+                pass
+
+    def _save(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self.data, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, self.path)
+
+
+def estimate_download(os_name, distri, path, rsync_user, content=None):
+    """Volume que la tâche va télécharger, sans rien télécharger : index HTTP (crawl_job)
+    comparé au miroir existant pour AlmaLinux/Rocky, rsync en simulation si les pages d'index
+    ne donnent pas les tailles ; index Packages/Sources comparés au miroir existant (tailles seules)
+    pour Debian/Proxmox. Renvoie {"bytes", "total", "staging"} ou None si l'estimation échoue ;
+    staging est vrai si les fichiers transitent par le staging (staging_root) avant publication."""
+    job = (os_name, distri)
+    dest = job_dest(path, job)
+    if os_name in ("almalinux", "rockylinux"):
+        estimate = _estimate_from_index(job, dest, content)
+        if estimate is not None:
+            return estimate
+        stats = {}
+        filter_args = [f"--filter={rule}" for rule in rsync_filter_rules(content)]
+        cmd = ["rsync", "-rltn", "--stats", "--no-inc-recursive", *filter_args,
+               rsync_url(rsync_user, f"{os_name}/{distri}/"), dest]
+        if _run_command(cmd, line_callback=lambda line: _parse_rsync_stats(line, stats)) != 0 or "bytes" not in stats:
+            return None
+        return {"bytes": stats["bytes"], "total": stats.get("total", stats["bytes"]), "staging": False}
+
+    plan = _estimate_plan(job, path, rsync_user, verify=False)
+    if plan is None:
+        return None
+    return {"bytes": plan["bytes"], "total": sum(size for size, _ in plan["wanted"].values()), "staging": True}
+
+def _estimate_plan(job, path, rsync_user, verify):
+    # plan_delta sans effet de bord : index téléchargés dans un dossier temporaire, comparés au
+    # staging s'il existe déjà, sinon au miroir publié ; un staging absent compte comme vide
+    root, dist, sections, plan_options, staging_name = _delta_target(*job)
+    staging_dest = os.path.join(staging_root(path), staging_name)
+    if os.path.isdir(os.path.join(staging_dest, "pool")) or not path:
+        pool_dir = staging_dest
+    else:
+        pool_dir = _seed_source(job_dest(path, job), dist.split(","))
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    work_dir = tempfile.mkdtemp(prefix="delta-estimate-", dir=CACHE_DIR)
+    try:
+        return plan_delta(root, dist, sections, staging_dest, rsync_user, pool_dir=pool_dir,
+                          verify=verify, work_dir=work_dir, **plan_options)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+def _existing_parent(path):
+    path = os.path.abspath(path)
+    while not os.path.exists(path):
+        path = os.path.dirname(path)
+    return path
+
+def check_free_space(needs):
+    """needs : {dossier: octets à écrire}. Les besoins sont cumulés par système de fichiers
+    et comparés à l'espace libre ; renvoie une entrée par système de fichiers."""
+    filesystems = {}
+    for path, size in needs.items():
+        existing = _existing_parent(path)
+        entry = filesystems.setdefault(os.stat(existing).st_dev, {
+            "paths": [], "needed": 0, "free": shutil.disk_usage(existing).free,
+        })
+        entry["paths"].append(path)
+        entry["needed"] += size
+    for entry in filesystems.values():
+        entry["ok"] = entry["needed"] <= entry["free"]
+    return list(filesystems.values())
+
+def preflight(jobs, path, rsync_user, job_options=None, max_workers=DISCOVERY_WORKERS):
+    """Estime en parallèle le volume de chaque tâche et vérifie l'espace libre de path et du
+    staging (staging_root). Les tâches Debian/Proxmox n'occupent que le staging : l'instantané
+    publié n'en contient que des liens physiques."""
+    job_options = job_options or {}
+    estimates = {}
+
+    def estimate(job):
+        with use_endpoint(ENDPOINTS.best(job[0], _marker_paths(*job)[0])):
+            return estimate_download(*job, path, rsync_user, job_options.get(job, {}).get("content"))
+
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(jobs)))) as executor:
+        futures = {executor.submit(estimate, job): job for job in jobs}
+        for future in as_completed(futures):
+            try:
+                estimates[futures[future]] = future.result()
+            except (OSError, ValueError, ImportError):
+                estimates[futures[future]] = None
+
+    staging = staging_root(path)
+    needs = {path: 0, staging: 0}
+    for estimate in estimates.values():
+        if estimate:
+            needs[staging if estimate["staging"] else path] += estimate["bytes"]
+    filesystems = check_free_space(needs)
+    return {
+        "jobs": estimates,
+        "bytes": sum(estimate["bytes"] for estimate in estimates.values() if estimate),
+        "filesystems": filesystems,
+        "ok": all(entry["ok"] for entry in filesystems),
+    }
+
+def format_preflight(report):
+    """Lignes lisibles du rapport de preflight()."""
+    lines = []
+    for job, estimate in sorted(report["jobs"].items()):
+        if estimate is None:
+            lines.append(f"{job_label(job)} : estimation impossible")
+        else:
+            lines.append(f"{job_label(job)} : {format_size(estimate['bytes'])} à télécharger "
+                         f"(miroir complet {format_size(estimate['total'])})")
+    lines.append(f"Total à télécharger : {format_size(report['bytes'])}")
+    for entry in report["filesystems"]:
+        state = "OK" if entry["ok"] else "INSUFFISANT"
+        lines.append(f"{', '.join(entry['paths'])} : {format_size(entry['needed'])} nécessaires, "
+                     f"{format_size(entry['free'])} libres ({state})")
+    return lines
+
+
+def _dispatch_job(os_name, distri, path, rsync_user, callbacks, shards=None, content=None, engine=None, dedup=False):
+    text_callback = callbacks["text_callback"]
+    if os_name == "almalinux":
+        return manage_alma_download(os_name, distri, path, rsync_user, shards=shards, content=content, dedup=dedup, **callbacks)
+    if os_name == "debian":
+        return manage_debian_download(os_name, distri, path, rsync_user, engine=engine, dedup=dedup, **callbacks)
+    if os_name == "proxmox":
+        try:
+            proxmox_category, debian_dist = distri.split(':')
+        except ValueError:
+            if text_callback:
+                text_callback(f"ERREUR: Tâche Proxmox mal formée : {distri}")
+            return 1
+        return manage_proxmox_download(os_name, proxmox_category, debian_dist, path, rsync_user, engine=engine, dedup=dedup, **callbacks)
+    if os_name == "rockylinux":
+        return manage_rocky_download(os_name, distri, path, rsync_user, shards=shards, content=content, dedup=dedup, **callbacks)
     if text_callback:
-        text_callback(f"{os_name}/{distri} terminé.")
-    if percent_callback:
-        percent_callback(100)
+        text_callback(f"ERREUR: OS non pris en charge : {os_name}")
+    return 1
+
+def _format_dedup(report):
+    text = (f"Déduplication : {report['linked']} fichiers liés, {format_size(report['bytes_saved'])} libérés "
+            f"({report['scanned']} fichiers parcourus, {format_size(report['bytes_hashed'])} relus).")
+    if report["unlinked"]:
+        text += f" {report['unlinked']} copies identiques datées différemment restent distinctes."
+    return text
+
+def _dedup_staging(staging_dest, path, result=None, text_callback=None):
+    # Les instantanés Debian/Proxmox sont des liens vers le staging : le dédupliquer avant la
+    # publication libère réellement la place, et le prochain instantané hérite des liens
+    with _phase(result, "dedup"):
+        try:
+            report = dedup_tree(staging_root(path), [staging_dest], text_callback=text_callback)
+        except OSError as e:
+            report = None
+            if text_callback:
+                text_callback(f"ERREUR: Déduplication impossible. {e}")
+    if report and text_callback:
+        text_callback(_format_dedup(report))
+
+def run_download_job(os_name, distri, path, rsync_user, text_callback=None, percent_callback=None, stats_callback=None, shards=None, content=None, force=False, engine=None, control=None, dedup=False):
+    """Lance la tâche (os_name, distri), enregistre ses métriques et renvoie son SyncResult.
+    Pour AlmaLinux/Rocky, shards est le nombre de processus rsync parallèles (défaut
+    RSYNC_SHARDS) et content le contenu retenu (voir content_filter). Pour Debian/Proxmox,
+    engine choisit debmirror ou le moteur delta (défaut DEBIAN_ENGINE).
+    Sauf si force est vrai, la tâche est ignorée quand ses fichiers témoins n'ont pas changé.
+    control (JobControl) permet d'annuler, suspendre ou reprendre la tâche depuis un autre thread ;
+    les événements de ses processus (voir ProcessEngine) et de son avancement portent son nom.
+    La tâche passe par le serveur le plus rapide et bascule sur le suivant si celui-ci échoue.
+    Avec dedup, les fichiers déjà présents dans path sont repris localement avant le
+    téléchargement, et les copies identiques sont liées physiquement après (mirror_dedup)."""
+    job = (os_name, distri)
+    dest = job_dest(path, job)
+    result = SyncResult(job_spec(job))
+    control = control or JobControl()
+    control.job = job_spec(job)
+    last_percent = None
+
+    def on_percent(pct):
+        # Avancement publié sur ENGINE (interface, --events) en plus des callbacks
+        nonlocal last_percent
+        if pct != last_percent:
+            last_percent = pct
+            ENGINE.notify({"type": "percent", "job": control.job, "percent": pct})
+        if percent_callback:
+            percent_callback(pct)
+
+    def on_stats(stats):
+        ENGINE.notify({"type": "stats", "job": control.job, "stats": stats})
+        if stats_callback:
+            stats_callback(stats)
+
+    callbacks = dict(text_callback=text_callback, percent_callback=on_percent, stats_callback=on_stats, result=result)
+    events = ENGINE.subscribe(result.process_event, types=("start", "timeout"))
+    try:
+        try:
+            endpoints = ENDPOINTS.ranked(os_name, _marker_paths(*job)[0])
+        except (ValueError, OSError, ImportError):
+            endpoints = [default_endpoint()]
+        with job_control(control), use_endpoint(endpoints[0]):
+            result.endpoint = str(endpoints[0])
+            with result.phase("probe"):
+                try:
+                    markers = probe_upstream(job, dest)
+                except (ImportError, ValueError) as e:
+                    markers = None
+                    if text_callback:
+                        text_callback(f"Vérification de fraîcheur impossible : {e}")
+            if not force and is_up_to_date(job, dest, markers, content):
+                result.skipped = True
+                if text_callback:
+                    text_callback(f"{job_label(job)} : fichiers témoins inchangés, synchronisation ignorée.")
+                on_percent(100)
+                code = 0
+            else:
+                for attempt, endpoint in enumerate(endpoints):
+                    result.endpoint = str(endpoint)
+                    with use_endpoint(endpoint):
+                        code = _dispatch_job(os_name, distri, path, rsync_user, callbacks, shards, content, engine, dedup)
+                    if (code == 0 or control.cancelled or attempt == len(endpoints) - 1
+                            or not ENDPOINTS.report_failure(os_name, endpoint, code)):
+                        break
+                    if text_callback:
+                        text_callback(f"Serveur {endpoint} en échec (code {code}) : bascule vers {endpoints[attempt + 1]}.")
+
+        result.cancelled = control.cancelled and code != 0
+        result.finish(code)
+        if result.cancelled and text_callback:
+            text_callback(f"{job_label(job)} : tâche annulée, les fichiers partiels sont conservés pour la reprise.")
+        if code == 0 and markers and not result.skipped:
+            try:
+                save_freshness(job, dest, markers, content)
+            except OSError as e:
+                if text_callback:
+                    text_callback(f"ERREUR: Impossible d'enregistrer les fichiers témoins. {e}")
+        if code == 0 and dedup and not result.skipped and os_name in ("almalinux", "rockylinux"):
+            with result.phase("dedup"):
+                try:
+                    report = dedup_tree(path, [dest], text_callback=text_callback)
+                except OSError as e:
+                    report = None
+                    if text_callback:
+                        text_callback(f"ERREUR: Déduplication impossible. {e}")
+            if report and text_callback:
+                text_callback(_format_dedup(report))
+    finally:
+        # Une exception ne doit ni laisser l'abonné sur ENGINE ni priver la tâche de ses métriques
+        ENGINE.unsubscribe(events)
+        if result.exit_code is None:
+            result.cancelled = control.cancelled
+            result.finish(EXIT_JOB_FAILED)
+        try:
+            write_metrics(result)
+        except OSError as e:
+            if text_callback:
+                text_callback(f"ERREUR: Impossible d'écrire les métriques. {e}")
+    return result
+
+
+def run_jobs(jobs, path, rsync_user, max_workers=DEFAULT_MAX_WORKERS, per_host_limit=DEFAULT_PER_HOST_LIMIT, text_callback=None, job_options=None, sizes=None, journal=None):
+    """Exécute les tâches via JobScheduler sans interface graphique.
+    job_options associe à une tâche des arguments supplémentaires de run_download_job,
+    sizes sa taille estimée (ordre de la file). L'état de chaque tâche est tenu dans journal
+    (JobJournal) s'il est fourni. Sur KeyboardInterrupt, les tâches en cours sont annulées
+    et les tâches en attente restent à reprendre.
+    Renvoie un résultat par tâche lancée, dans l'ordre de fin d'exécution."""
+    job_options = job_options or {}
+    scheduler = JobScheduler(jobs, max_workers=max_workers, per_host_limit=per_host_limit, sizes=sizes)
+    results = []
+    controls = {job: JobControl() for job in jobs}
+    condition = threading.Condition()
+    if journal:
+        journal.start(path, jobs, job_options)
+
+    def worker(job):
+        label = job_label(job)
+        job_log = JobLog(job)
+
+        def on_text(text):
+            job_log.write(text)
+            if text_callback:
+                text_callback(f"[{label}] {text}")
+
+        if journal:
+            journal.set_state(job, "running")
+        try:
+            record = run_download_job(*job, path, rsync_user, text_callback=on_text, control=controls[job],
+                                      **job_options.get(job, {})).as_dict()
+        except Exception as e:
+            on_text(f"ERREUR: {e}")
+            record = SyncResult(job_spec(job)).finish(-1).as_dict()
+        finally:
+            job_log.close()
+        record["log"] = job_log.path
+        if journal:
+            journal.set_state(job, record["status"])
+        with condition:
+            results.append(record)
+            scheduler.job_done(job)
+            condition.notify()
+
+    try:
+        with condition:
+            while not scheduler.is_done():
+                for job in scheduler.next_jobs():
+                    threading.Thread(target=worker, args=(job,), daemon=True).start()
+                if not scheduler.is_done():
+                    condition.wait()
+    except KeyboardInterrupt:
+        if text_callback:
+            text_callback("Interruption : annulation des tâches en cours…")
+        with condition:
+            scheduler.cancel_pending()
+            for job in scheduler.running:
+                controls[job].cancel()
+            while scheduler.running:
+                condition.wait()
+    return results
+
+
+def job_spec(job):
+    os_name, distri = job
+    return f"{os_name}:{distri}"
+
+def parse_job_spec(spec):
+    """'debian:bookworm' -> ('debian', 'bookworm'), 'proxmox:pve:bookworm' -> ('proxmox', 'pve:bookworm')."""
+    os_name, _, distri = spec.strip().partition(":")
+    if os_name not in SUPPORTED_OS or not distri:
+        raise ValueError(f"Tâche invalide : {spec!r} (attendu os:distribution, ex. debian:bookworm)")
+    if os_name == "proxmox" and distri.count(":") != 1:
+        raise ValueError(f"Tâche Proxmox invalide : {spec!r} (attendu proxmox:catégorie:dist)")
+    return os_name, distri
+
+def batch_jobs(jobs, job_options=None):
+    """Regroupe les tâches Debian d'une part, et Proxmox de même catégorie d'autre part, en
+    une seule tâche par archive ("debian:bookworm,trixie") : un seul passage de debmirror ou
+    du moteur delta, un pool partagé (voir SHARED_DIST_DIR). Renvoie (tâches, options) ; une
+    tâche regroupée prend les options de la première tâche de son groupe."""
+    job_options = job_options or {}
+    groups = {}
+    for job in jobs:
+        os_name, distri = job
+        if os_name == "debian":
+            groups.setdefault((os_name, ""), []).append(job)
+        elif os_name == "proxmox" and distri.count(":") == 1:
+            groups.setdefault((os_name, distri.split(":")[0] + ":"), []).append(job)
+        else:
+            groups.setdefault(job, []).append(job)
+    batched = []
+    options = {}
+    for (os_name, prefix), members in groups.items():
+        if len(members) == 1:
+            job = members[0]
+        else:
+            dists = dict.fromkeys(distri[len(prefix):] for _, distri in members)
+            job = (os_name, prefix + ",".join(dists))
+        batched.append(job)
+        if members[0] in job_options:
+            options[job] = job_options[members[0]]
+    return batched, options
+
+def load_config(config_path):
+    """Lit le fichier de configuration : une section [mirror] pour les réglages généraux
+    et une section par tâche, nommée d'après la tâche (ex. [debian:bookworm])."""
+    config = configparser.ConfigParser(interpolation=None)
+    if config_path:
+        with open(config_path, encoding="utf-8") as f:
+            config.read_file(f)
+    if not config.has_section("mirror"):
+        config.add_section("mirror")
+    return config
+
+def _job_options(config, job, shards=RSYNC_SHARDS, profile=None, engine=None, dedup=False):
+    """Réglages d'une tâche : ceux de sa section [os:distri], à défaut ceux de [mirror]."""
+    if not config.has_section(job_spec(job)):
+        config.add_section(job_spec(job))
+    options = config[job_spec(job)]
+    engine = options.get("engine", engine)
+    if engine and engine not in DEBIAN_ENGINES:
+        raise ValueError(f"Moteur inconnu : {engine!r} (choix : {', '.join(DEBIAN_ENGINES)})")
+    arches = options.get("arches")
+    return {
+        "shards": options.getint("shards", shards),
+        "engine": engine,
+        "dedup": options.getboolean("dedup", dedup),
+        "content": content_filter(options.get("profile", profile),
+                                  arches=[arch.strip() for arch in arches.split(",") if arch.strip()] if arches else None,
+                                  isos=options.getboolean("isos"), debug=options.getboolean("debug"),
+                                  source=options.getboolean("source")),
+    }
+
+def _build_parser():
+    parser = argparse.ArgumentParser(
+        prog="mirror_util",
+        description="Synchronise les miroirs Sharlio sans interface graphique. "
+                    "L'utilisateur rsync est lu dans SHARLIO_RSYNC_USER et le mot de passe dans RSYNC_PASSWORD.")
+    parser.add_argument("jobs", nargs="*",
+                        help="tâches à lancer (ex. debian:bookworm proxmox:pve:bookworm almalinux:9) ; "
+                             "par défaut toutes celles du fichier de configuration")
+    parser.add_argument("-c", "--config", default=os.environ.get("SHARLIO_MIRROR_CONFIG"),
+                        help="fichier de configuration (défaut : $SHARLIO_MIRROR_CONFIG)")
+    parser.add_argument("-d", "--dest", help="dossier de destination des miroirs")
+    parser.add_argument("--workers", type=int, help="nombre de tâches simultanées")
+    parser.add_argument("--per-host", type=int, help="nombre de tâches simultanées par serveur")
+    parser.add_argument("--shards", type=int, help="processus rsync parallèles par tâche AlmaLinux/Rocky")
+    parser.add_argument("--profile", choices=sorted(CONTENT_PROFILES),
+                        help="contenu retenu pour AlmaLinux/Rocky (défaut : [mirror] profile ou full)")
+    parser.add_argument("--preflight", action="store_true",
+                        help="estime les volumes et vérifie l'espace disque avant de lancer les tâches")
+    parser.add_argument("--force", action="store_true",
+                        help="synchronise même si les fichiers témoins du miroir source n'ont pas changé")
+    parser.add_argument("--engine", choices=DEBIAN_ENGINES,
+                        help="moteur des tâches Debian/Proxmox (défaut : [mirror] engine ou $SHARLIO_DEBIAN_ENGINE)")
+    parser.add_argument("--dedup", action="store_true",
+                        help="reprend les fichiers déjà présents dans la destination et lie les copies identiques")
+    parser.add_argument("--dedup-all", action="store_true",
+                        help="déduplique tout le dossier de destination par liens physiques, sans rien télécharger")
+    parser.add_argument("--batch", action="store_true",
+                        help="regroupe les distributions Debian/Proxmox d'une même archive en une tâche à pool partagé")
+    parser.add_argument("--bwlimit",
+                        help="budget de bande passante, ex. 5M ou '08:00-19:00=5M,19:00-08:00=0' (relu sur SIGHUP)")
+    parser.add_argument("--resume", action="store_true",
+                        help="reprend les tâches non terminées de la dernière exécution (destination et options comprises)")
+    parser.add_argument("--journal", default=JOURNAL_FILE,
+                        help=f"fichier d'état de la file de tâches (défaut : {JOURNAL_FILE})")
+    parser.add_argument("--summary", help="fichier où écrire le bilan JSON ('-' pour la sortie standard)")
+    parser.add_argument("--events",
+                        help="fichier où écrire les événements des processus, un objet JSON par ligne ('-' pour la sortie d'erreur)")
+    parser.add_argument("--list", action="store_true", help="affiche les tâches sélectionnées sans les lancer")
+    parser.add_argument("--endpoints", action="store_true",
+                        help="sonde les serveurs source des tâches sélectionnées et affiche leur classement")
+    parser.add_argument("--estimate", action="store_true",
+                        help="estime le volume économisé par les filtres de contenu, sans rien télécharger")
+    parser.add_argument("--crawl", action="store_true",
+                        help="parcourt en HTTP l'arborescence des tâches AlmaLinux/Rocky, met à jour leur index et affiche les changements")
+    parser.add_argument("-q", "--quiet", action="store_true", help="n'affiche pas la sortie de rsync/debmirror")
+    return parser
+
+def _open_events(destination):
+    """Abonne un fichier JSON Lines (ou la sortie d'erreur pour '-') aux événements de ENGINE ;
+    renvoie la fonction qui le désabonne et le ferme."""
+    f = sys.stderr if destination == "-" else open(destination, "a", encoding="utf-8")
+
+    def write(event):
+        f.write(json.dumps({"time": round(time.time(), 3), **event}, ensure_ascii=False) + "\n")
+        f.flush()
+
+    token = ENGINE.subscribe(write)
+
+    def close():
+        ENGINE.unsubscribe(token)
+        if f is not sys.stderr:
+            f.close()
+
+    return close
+
+def _write_summary(summary, destination):
+    data = json.dumps(summary, ensure_ascii=False, indent=2)
+    if destination == "-":
+        print(data)
+        return
+    directory = os.path.dirname(os.path.abspath(destination))
+    os.makedirs(directory, exist_ok=True)
+    tmp_path = f"{destination}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(data + "\n")
+    os.replace(tmp_path, destination)
+
+def _delta_target(os_name, distri):
+    # Module rsync, distribution, sections, options d'index et dossier de travail d'une tâche Debian/Proxmox
+    if os_name == "debian":
+        return "debian", distri, DEBIAN_SECTIONS, {"source": True, "i18n": True}, _staging_name(os_name, distri)
+    proxmox_category, debian_dist = distri.split(":")
+    repo_config = PROXMOX_REPOS[proxmox_category]
+    return repo_config["root"], debian_dist, (repo_config["section"],), {}, _staging_name(os_name, distri)
+
+def _print_delta_estimate(job, dest, rsync_user):
+    plan = _estimate_plan(job, dest, rsync_user, verify=True)
+    if plan is None:
+        return False
+    wanted = plan["wanted"]
+    print(f"{job_spec(job)} : {format_size(plan['bytes'])} à télécharger ({len(plan['fetch'])}/{len(wanted)} fichiers), "
+          f"pool complet {format_size(sum(size for size, _ in wanted.values()))}.")
+    return True
+
+def _print_estimates(jobs, dest, rsync_user, job_options):
+    code = EXIT_OK
+    for job in jobs:
+        os_name, distri = job
+        if os_name not in ("almalinux", "rockylinux"):
+            if (job_options[job].get("engine") or DEBIAN_ENGINE) != "delta":
+                print(f"{job_spec(job)} : estimation disponible avec le moteur delta uniquement.")
+            elif not _print_delta_estimate(job, dest, rsync_user):
+                print(f"{job_spec(job)} : lecture des index impossible.", file=sys.stderr)
+                code = EXIT_JOB_FAILED
+            continue
+        totals = estimate_content_savings(os_name, distri, rsync_user, job_options[job]["content"])
+        if totals is None:
+            print(f"{job_spec(job)} : listage impossible.", file=sys.stderr)
+            code = EXIT_JOB_FAILED
+            continue
+        saved = totals["bytes_total"] - totals["bytes_kept"]
+        ratio = saved * 100 / totals["bytes_total"] if totals["bytes_total"] else 0
+        print(f"{job_spec(job)} : {format_size(totals['bytes_kept'])} retenus sur {format_size(totals['bytes_total'])} "
+              f"({totals['files_kept']}/{totals['files_total']} fichiers), {format_size(saved)} économisés ({ratio:.0f} %).")
+    return code
+
+def _print_crawl(jobs, job_options, quiet=False):
+    code = EXIT_OK
+    for job in jobs:
+        if job[0] not in ("almalinux", "rockylinux"):
+            print(f"{job_spec(job)} : parcours HTTP disponible pour AlmaLinux/Rocky uniquement.")
+            continue
+        content = job_options[job]["content"]
+        with use_endpoint(ENDPOINTS.best(job[0], _marker_paths(*job)[0])):
+            index, stats = crawl_job(job, content, ttl=0,
+                                     text_callback=None if quiet else lambda text: print(text, file=sys.stderr, flush=True))
+        if index is None:
+            print(f"{job_spec(job)} : index HTTP injoignable.", file=sys.stderr)
+            code = EXIT_JOB_FAILED
+            continue
+        totals = indexed_size(*job, content)
+        size = f"{format_size(totals['bytes'])} retenus ({totals['files']} fichiers)" if totals else "tailles non fournies par le miroir"
+        print(f"{job_spec(job)} : {stats['dirs']} dossiers ({stats['fetched']} relus, {stats['revalidated']} inchangés, "
+              f"{stats['errors']} en erreur), {size}.")
+        changes = stats["changes"]
+        if changes is not None:
+            print(f"  depuis le dernier parcours : {len(changes['added'])} ajoutés, {len(changes['changed'])} modifiés, "
+                  f"{len(changes['removed'])} supprimés.")
+            if not quiet:
+                for label, key in (("+", "added"), ("~", "changed"), ("-", "removed")):
+                    for relpath in changes[key]:
+                        print(f"  {label} {relpath}")
+    return code
+
+def configure_endpoints(settings):
+    """Serveurs de secours d'après [mirror] : hosts pour tous les OS, hosts_<os> pour un seul."""
+    ENDPOINTS.configure(settings.get("hosts", MIRROR_HOSTS),
+                        {os_name: settings[f"hosts_{os_name}"] for os_name in SUPPORTED_OS if f"hosts_{os_name}" in settings})
+
+def _print_endpoints(jobs):
+    for os_name in sorted({os_name for os_name, _ in jobs}):
+        ranked = ENDPOINTS.ranked(os_name)
+        entry = ENDPOINTS._load().get(os_name, {})
+        print(f"{os_name} :")
+        for endpoint in ranked:
+            probe = entry.get("probes", {}).get(str(endpoint))
+            state = (f"{probe['latency'] * 1000:.0f} ms, {format_size(probe['throughput'])}/s" if probe
+                     else "injoignable" if entry else "non sondé")
+            print(f"  {endpoint} ({state})")
+
+def _reload_bandwidth(config_path):
+    try:
+        schedule = load_config(config_path)["mirror"].get("bandwidth", BANDWIDTH_SCHEDULE)
+        BANDWIDTH.configure(schedule)
+    except (OSError, ValueError, configparser.Error) as e:
+        print(f"ERREUR: budget de bande passante inchangé. {e}", file=sys.stderr)
+        return
+    print(f"Budget de bande passante rechargé : {schedule or 'illimité'}", file=sys.stderr)
+
+def main(argv=None):
+    args = _build_parser().parse_args(argv)
+
+    try:
+        config = load_config(args.config)
+        settings = config["mirror"]
+        specs = args.jobs or [name for name in config.sections() if name != "mirror"]
+        jobs = [parse_job_spec(spec) for spec in specs]
+        configure_mirror(settings.get("host"), settings.get("url"), settings.get("rsync_port"))
+        configure_endpoints(settings)
+        dest = args.dest or settings.get("dest")
+        workers = args.workers or settings.getint("workers", DEFAULT_MAX_WORKERS)
+        per_host = args.per_host or settings.getint("per_host_limit", DEFAULT_PER_HOST_LIMIT)
+        shards = args.shards or settings.getint("shards", RSYNC_SHARDS)
+        profile = args.profile or settings.get("profile")
+        engine = args.engine or settings.get("engine")
+        dedup = args.dedup or settings.getboolean("dedup", False)
+        bandwidth = args.bwlimit or settings.get("bandwidth")
+        if bandwidth is not None:
+            BANDWIDTH.configure(bandwidth)
+        job_options = {job: dict(_job_options(config, job, shards, profile, engine, dedup), force=args.force) for job in jobs}
+        if args.batch or settings.getboolean("batch", False):
+            jobs, job_options = batch_jobs(jobs, job_options)
+    except (OSError, ValueError, configparser.Error) as e:
+        print(f"ERREUR: {e}", file=sys.stderr)
+        return EXIT_USAGE
+    summary_path = args.summary or settings.get("summary")
+
+    journal = JobJournal(args.journal)
+    if args.resume:
+        unfinished = journal.unfinished()
+        if unfinished is None:
+            print("Aucune tâche à reprendre.", file=sys.stderr)
+            return EXIT_OK
+        dest, jobs, job_options = unfinished
+        print(f"Reprise vers {dest} : {' '.join(job_spec(job) for job in jobs)}", file=sys.stderr)
+
+    if args.list:
+        for job in jobs:
+            print(job_spec(job))
+        return EXIT_OK
+    if args.dedup_all:
+        if not dest:
+            print("ERREUR: dossier de destination (--dest ou [mirror] dest) requis.", file=sys.stderr)
+            return EXIT_USAGE
+        log = None if args.quiet else lambda text: print(text, file=sys.stderr, flush=True)
+        print(_format_dedup(dedup_tree(dest, text_callback=log)))
+        if os.path.isdir(staging_root(dest)):
+            print(_format_dedup(dedup_tree(staging_root(dest), text_callback=log)))
+        return EXIT_OK
+    if not jobs:
+        print("Aucune tâche à lancer.", file=sys.stderr)
+        return EXIT_OK
+    if args.endpoints:
+        _print_endpoints(jobs)
+        return EXIT_OK
+    if args.crawl:
+        return _print_crawl(jobs, job_options, args.quiet)
+
+    rsync_user = os.environ.get("SHARLIO_RSYNC_USER")
+    if args.estimate:
+        if not rsync_user:
+            print("ERREUR: SHARLIO_RSYNC_USER requis.", file=sys.stderr)
+            return EXIT_USAGE
+        return _print_estimates(jobs, dest, rsync_user, job_options)
+    if not dest or not rsync_user:
+        print("ERREUR: dossier de destination (--dest ou [mirror] dest) et SHARLIO_RSYNC_USER requis.", file=sys.stderr)
+        return EXIT_USAGE
+    if "RSYNC_PASSWORD" not in os.environ:
+        print("ATTENTION: RSYNC_PASSWORD n'est pas défini.", file=sys.stderr)
+
+    if hasattr(signal, "SIGHUP") and not args.bwlimit:
+        signal.signal(signal.SIGHUP, lambda signum, frame: _reload_bandwidth(args.config))
+    # SIGTERM (arrêt du service) annule les tâches proprement, comme Ctrl-C
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+
+    sizes = None
+    if args.preflight:
+        report = preflight(jobs, dest, rsync_user, job_options, workers)
+        for line in format_preflight(report):
+            print(line, file=sys.stderr)
+        if not report["ok"]:
+            print("ERREUR: espace disque insuffisant, aucune tâche lancée.", file=sys.stderr)
+            return EXIT_NO_SPACE
+        sizes = {job: estimate["bytes"] for job, estimate in report["jobs"].items() if estimate}
+
+    started = time.time()
+    try:
+        events = _open_events(args.events) if args.events else None
+    except OSError as e:
+        print(f"ERREUR: Impossible d'ouvrir {args.events}. {e}", file=sys.stderr)
+        return EXIT_USAGE
+    try:
+        results = run_jobs(jobs, dest, rsync_user, max_workers=workers, per_host_limit=per_host, sizes=sizes,
+                           text_callback=None if args.quiet else lambda text: print(text, flush=True), job_options=job_options,
+                           journal=journal)
+    finally:
+        if events:
+            events()
+    failed = [r for r in results if r["status"] == "failed"]
+    skipped = [r for r in results if r["status"] == "skipped"]
+    cancelled = [r for r in results if r["status"] == "cancelled"]
+    not_started = len(jobs) - len(results)
+    summary = {
+        "started": time.strftime("%Y-%m-%dT%H:%M:%S%z", time.localtime(started)),
+        "duration": round(time.time() - started, 3),
+        "dest": dest,
+        "ok": len(results) - len(failed) - len(skipped) - len(cancelled),
+        "skipped": len(skipped),
+        "failed": len(failed),
+        "cancelled": len(cancelled),
+        "not_started": not_started,
+        "jobs": results,
+    }
+    if summary_path:
+        try:
+            _write_summary(summary, summary_path)
+        except OSError as e:
+            print(f"ERREUR: Impossible d'écrire le bilan {summary_path}. {e}", file=sys.stderr)
+    if cancelled or not_started:
+        print(f"Interrompu : reprendre avec --resume (journal {args.journal}).", file=sys.stderr)
+        return EXIT_INTERRUPTED
+    return EXIT_JOB_FAILED if failed else EXIT_OK
 
 
-def main():
-    print("Test")
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    sys.exit(main())
\ No newline at end of file
@@ -0,0 +1,362 @@
+"""Vérification d'intégrité des miroirs locaux.
+
+Chaque fichier est comparé aux sommes de contrôle des métadonnées du dépôt : Release puis
+Packages/Sources pour Debian/Proxmox, repomd.xml puis primary.xml pour AlmaLinux/Rocky.
+Les empreintes sont calculées en parallèle par un pool de processus et mémorisées avec la
+taille et la date de modification de chaque fichier : une nouvelle vérification ne relit
+que les fichiers modifiés depuis. Avec --repair, les fichiers corrompus ou manquants sont
+supprimés et leur tâche est relancée :
+
+    python3 mirror_verify.py -c /etc/sharlio-mirror.ini
+    python3 mirror_verify.py -c /etc/sharlio-mirror.ini --repair debian:bookworm
+"""
+import argparse
+import bz2
+import configparser
+import gzip
+import hashlib
+import json
+import lzma
+import os
+import re
+import sys
+import xml.etree.ElementTree as ET
+from concurrent.futures import ProcessPoolExecutor
+
+import mirror_util
+
+VERIFY_CACHE_DIR = os.path.join(mirror_util.CACHE_DIR, "verify")
+VERIFY_WORKERS = int(os.environ.get("SHARLIO_VERIFY_WORKERS", os.cpu_count() or 1))
+HASH_CHUNK = 16
+PROGRESS_EVERY = 1000
+REPO_NS = "{http://linux.duke.edu/metadata/repo}"
+COMMON_NS = "{http://linux.duke.edu/metadata/common}"
+CHECKSUM_TYPES = {"sha": "sha1", "sha1": "sha1", "sha224": "sha224", "sha256": "sha256", "sha384": "sha384",
+                  "sha512": "sha512", "md5": "md5"}
+# Cache d'état de debmirror : supprimé avant une réparation pour qu'il revérifie tout le pool
+DEBMIRROR_STATE_CACHE = os.path.join(".temp", "debmirror_state.cache")
+
+
+def debian_manifest(root):
+    """{chemin relatif: (taille, algorithme, empreinte)} d'un miroir Debian/Proxmox : index
+    présents listés par chaque dists/<dist>/Release, puis paquets et sources de ces index."""
+    manifest = {}
+    dists_dir = os.path.join(root, "dists")
+    excluded = re.compile("|".join(mirror_util.MIRROR_EXCLUDES)) if mirror_util.MIRROR_EXCLUDES else None
+    for dist in sorted(os.listdir(dists_dir)) if os.path.isdir(dists_dir) else []:
+        release_path = os.path.join(dists_dir, dist, "Release")
+        if not os.path.isfile(release_path):
+            continue
+        with open(release_path, encoding="utf-8", errors="replace") as f:
+            release = mirror_util._parse_release(f.read())
+        indexes = set()
+        for name, (size, sha256) in release.items():
+            path = f"dists/{dist}/{name}"
+            if "by-hash" in name or not os.path.exists(os.path.join(root, path)):
+                continue
+            manifest[path] = (size, "sha256", sha256)
+            base = re.sub(r"\.(xz|gz|bz2)$", "", name)
+            if os.path.basename(base) in ("Packages", "Sources"):
+                indexes.add(base)
+        for base in sorted(indexes):
+            text = mirror_util._read_index(os.path.join(dists_dir, dist, base))
+            if text is None:
+                continue
+            parse = mirror_util._parse_sources if base.endswith("Sources") else mirror_util._parse_packages
+            for path, (size, sha256) in parse(text).items():
+                if excluded and excluded.search(os.path.basename(path)):
+                    continue
+                manifest[path] = (size, "sha256" if sha256 else None, sha256)
+    return manifest
+
+def _open_metadata(path):
+    if path.endswith(".gz"):
+        return gzip.open(path, "rb")
+    if path.endswith(".xz"):
+        return lzma.open(path, "rb")
+    if path.endswith(".bz2"):
+        return bz2.open(path, "rb")
+    if path.endswith(".zst"):
+        import zstandard
+        return zstandard.ZstdDecompressor().stream_reader(open(path, "rb"), closefd=True)
+    return open(path, "rb")
+
+def _checksum(element, namespace):
+    checksum = element.find(f"{namespace}checksum")
+    if checksum is None or not checksum.text:
+        return None, None
+    return CHECKSUM_TYPES.get(checksum.get("type")), checksum.text.strip()
+
+def _repomd_entries(path):
+    # [(type, href, taille, algorithme, empreinte)] des fichiers listés par repomd.xml
+    entries = []
+    for data in ET.parse(path).getroot().iter(f"{REPO_NS}data"):
+        location = data.find(f"{REPO_NS}location")
+        size = data.find(f"{REPO_NS}size")
+        if location is None or size is None:
+            continue
+        algo, digest = _checksum(data, REPO_NS)
+        entries.append((data.get("type"), location.get("href"), int(size.text), algo, digest))
+    return entries
+
+def _primary_packages(path):
+    """(href, taille, algorithme, empreinte) de chaque paquet d'un primary.xml, lu en flux."""
+    with _open_metadata(path) as f:
+        for _, element in ET.iterparse(f):
+            if element.tag != f"{COMMON_NS}package":
+                continue
+            location = element.find(f"{COMMON_NS}location")
+            size = element.find(f"{COMMON_NS}size")
+            if location is not None and size is not None:
+                algo, digest = _checksum(element, COMMON_NS)
+                yield location.get("href"), int(size.get("package")), algo, digest
+            element.clear()
+
+def rpm_manifest(root, text_callback=None):
+    """{chemin relatif: (taille, algorithme, empreinte)} d'un miroir AlmaLinux/Rocky : fichiers
+    de chaque repodata/repomd.xml, puis paquets de son primary.xml."""
+    manifest = {}
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = sorted(name for name in dirnames if not name.startswith("."))
+        if os.path.basename(dirpath) != "repodata" or "repomd.xml" not in filenames:
+            continue
+        dirnames[:] = []
+        repo_dir = os.path.dirname(dirpath)
+        prefix = os.path.relpath(repo_dir, root)
+        try:
+            entries = _repomd_entries(os.path.join(dirpath, "repomd.xml"))
+        except (OSError, ET.ParseError) as e:
+            if text_callback:
+                text_callback(f"ERREUR: {os.path.join(prefix, 'repodata/repomd.xml')} illisible. {e}")
+            continue
+        for kind, href, size, algo, digest in entries:
+            manifest[os.path.normpath(os.path.join(prefix, href))] = (size, algo, digest)
+        for kind, href, *_ in entries:
+            if kind != "primary":
+                continue
+            try:
+                for package, size, algo, digest in _primary_packages(os.path.join(repo_dir, href)):
+                    manifest[os.path.normpath(os.path.join(prefix, package))] = (size, algo, digest)
+            except ImportError:
+                if text_callback:
+                    text_callback(f"{os.path.join(prefix, href)} ignoré : module zstandard absent.")
+            except (OSError, EOFError, lzma.LZMAError, ET.ParseError) as e:
+                if text_callback:
+                    text_callback(f"ERREUR: {os.path.join(prefix, href)} illisible. {e}")
+    return manifest
+
+def job_manifest(job, root, text_callback=None):
+    if job[0] in ("debian", "proxmox"):
+        return debian_manifest(root)
+    return rpm_manifest(root, text_callback)
+
+
+def _cache_path(root):
+    key = os.path.abspath(root)
+    return os.path.join(VERIFY_CACHE_DIR, hashlib.sha256(key.encode()).hexdigest() + ".json")
+
+def _load_cache(path):
+    try:
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def _save_cache(path, cache):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(cache, f)
+    os.replace(tmp_path, path)
+
+def _file_digest(item):
+    # Exécuté dans un processus du pool : renvoie None si le fichier a disparu
+    path, algo = item
+    digest = hashlib.new(algo)
+    try:
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1024 * 1024), b""):
+                digest.update(block)
+    except OSError:
+        return None
+    return digest.hexdigest()
+
+def verify_tree(root, manifest, workers=VERIFY_WORKERS, text_callback=None):
+    """Compare les fichiers de root au manifeste. Seuls les fichiers dont la taille ou la
+    date de modification a changé depuis la dernière vérification sont relus.
+    Renvoie {"checked", "hashed", "bytes_hashed", "missing", "corrupt"}."""
+    cache_path = _cache_path(root)
+    cache = _load_cache(cache_path)
+    new_cache = {}
+    missing = []
+    corrupt = []
+    to_hash = []
+    for path, (size, algo, digest) in sorted(manifest.items()):
+        try:
+            stat = os.stat(os.path.join(root, path))
+        except OSError:
+            missing.append(path)
+            continue
+        if stat.st_size != size:
+            corrupt.append(path)
+            continue
+        if algo is None:
+            continue
+        key = [stat.st_size, stat.st_mtime_ns, algo]
+        known = cache.get(path)
+        if known and known[:3] == key:
+            new_cache[path] = known
+            if known[3] != digest:
+                corrupt.append(path)
+        else:
+            to_hash.append((path, key))
+
+    bytes_hashed = sum(key[0] for _, key in to_hash)
+    if to_hash:
+        if text_callback:
+            text_callback(f"{len(to_hash)} fichiers à relire ({mirror_util.format_size(bytes_hashed)}).")
+        with ProcessPoolExecutor(max_workers=max(1, workers)) as executor:
+            digests = executor.map(_file_digest, [(os.path.join(root, path), key[2]) for path, key in to_hash],
+                                   chunksize=HASH_CHUNK)
+            for done, ((path, key), actual) in enumerate(zip(to_hash, digests), 1):
+                if actual is None:
+                    missing.append(path)
+                    continue
+                new_cache[path] = key + [actual]
+                if actual != manifest[path][2]:
+                    corrupt.append(path)
+                if text_callback and done % PROGRESS_EVERY == 0:
+                    text_callback(f"{done}/{len(to_hash)} fichiers relus.")
+    _save_cache(cache_path, new_cache)
+    return {
+        "checked": len(manifest),
+        "hashed": len(to_hash),
+        "bytes_hashed": bytes_hashed,
+        "missing": sorted(missing),
+        "corrupt": sorted(corrupt),
+    }
+
+def verify_job(job, path, workers=VERIFY_WORKERS, text_callback=None):
+    """Vérifie le miroir publié de la tâche. Renvoie le bilan de verify_tree, ou None si le
+    miroir ou ses métadonnées sont introuvables."""
+    root = mirror_util.job_dest(path, job)
+    if not os.path.isdir(root):
+        if text_callback:
+            text_callback(f"ERREUR: {root} introuvable.")
+        return None
+    manifest = job_manifest(job, root, text_callback)
+    if not manifest:
+        if text_callback:
+            text_callback(f"ERREUR: aucune métadonnée (Release, repomd.xml) trouvée dans {root}.")
+        return None
+    return verify_tree(root, manifest, workers, text_callback)
+
+def repair_job(job, path, paths, text_callback=None):
+    """Supprime les fichiers corrompus pour que la prochaine synchronisation de la tâche les
+    télécharge de nouveau. Le miroir publié d'une tâche Debian/Proxmox (instantané courant)
+    n'est jamais modifié : les fichiers sont retirés du staging, amorcé au besoin depuis le
+    miroir publié, et de l'index du pool ; la synchronisation forcée publie ensuite un nouvel
+    instantané. Les miroirs AlmaLinux/Rocky, synchronisés en place, sont réparés en place."""
+    os_name, distri = job
+    if os_name in ("debian", "proxmox"):
+        _, dist, _, _, staging_name = mirror_util._delta_target(os_name, distri)
+        final_dest = mirror_util.job_dest(path, job)
+        root = mirror_util.get_staging_dir(staging_name, path, mirror_util._seed_source(final_dest, dist.split(",")), text_callback)
+    else:
+        root = mirror_util.job_dest(path, job)
+    for relpath in paths:
+        try:
+            os.remove(os.path.join(root, relpath))
+        except FileNotFoundError:
+            pass
+    if os_name in ("debian", "proxmox"):
+        index = mirror_util._load_pool_index(root)
+        if index:
+            for relpath in paths:
+                index.pop(relpath, None)
+            mirror_util._save_pool_index(root, index)
+        try:
+            os.remove(os.path.join(root, DEBMIRROR_STATE_CACHE))
+        except FileNotFoundError:
+            pass
+    if text_callback:
+        text_callback(f"{len(paths)} fichiers supprimés de {root}, la tâche sera relancée.")
+
+
+def _print_report(job, report):
+    missing, corrupt = report["missing"], report["corrupt"]
+    print(f"{mirror_util.job_spec(job)} : {report['checked']} fichiers vérifiés ({report['hashed']} relus, "
+          f"{mirror_util.format_size(report['bytes_hashed'])}), {len(missing)} manquants, {len(corrupt)} corrompus.")
+    for relpath in missing:
+        print(f"  manquant : {relpath}")
+    for relpath in corrupt:
+        print(f"  corrompu : {relpath}")
+
+def _verify_all(jobs, dest, workers, text_callback):
+    reports = {}
+    for job in jobs:
+        label = mirror_util.job_label(job)
+        report = verify_job(job, dest, workers, text_callback and (lambda text, label=label: text_callback(f"[{label}] {text}")))
+        reports[job] = report
+        if report is not None:
+            _print_report(job, report)
+    return reports
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="mirror_verify",
+        description="Vérifie les miroirs locaux d'après les sommes de contrôle de leurs métadonnées.")
+    parser.add_argument("jobs", nargs="*", help="tâches à vérifier (défaut : toutes celles du fichier de configuration)")
+    parser.add_argument("-c", "--config", default=os.environ.get("SHARLIO_MIRROR_CONFIG"),
+                        help="fichier de configuration (défaut : $SHARLIO_MIRROR_CONFIG)")
+    parser.add_argument("-d", "--dest", help="dossier des miroirs")
+    parser.add_argument("--workers", type=int, default=VERIFY_WORKERS, help="processus de calcul des empreintes")
+    parser.add_argument("--repair", action="store_true",
+                        help="supprime les fichiers corrompus ou manquants et relance leurs tâches")
+    parser.add_argument("-q", "--quiet", action="store_true", help="n'affiche que les bilans")
+    args = parser.parse_args(argv)
+
+    try:
+        config = mirror_util.load_config(args.config)
+        settings = config["mirror"]
+        specs = args.jobs or [name for name in config.sections() if name != "mirror"]
+        jobs = [mirror_util.parse_job_spec(spec) for spec in specs]
+        mirror_util.configure_mirror(settings.get("host"), settings.get("url"), settings.get("rsync_port"))
+        mirror_util.configure_endpoints(settings)
+        dest = args.dest or settings.get("dest")
+        shards = settings.getint("shards", mirror_util.RSYNC_SHARDS)
+        job_options = {job: dict(mirror_util._job_options(config, job, shards, settings.get("profile"), settings.get("engine")),
+                                 force=True) for job in jobs}
+    except (OSError, ValueError, configparser.Error) as e:
+        print(f"ERREUR: {e}", file=sys.stderr)
+        return mirror_util.EXIT_USAGE
+    if not dest:
+        print("ERREUR: dossier des miroirs (--dest ou [mirror] dest) requis.", file=sys.stderr)
+        return mirror_util.EXIT_USAGE
+    rsync_user = os.environ.get("SHARLIO_RSYNC_USER")
+    if args.repair and not rsync_user:
+        print("ERREUR: SHARLIO_RSYNC_USER requis pour --repair.", file=sys.stderr)
+        return mirror_util.EXIT_USAGE
+
+    text_callback = None if args.quiet else lambda text: print(text, file=sys.stderr, flush=True)
+    reports = _verify_all(jobs, dest, args.workers, text_callback)
+    damaged = [job for job, report in reports.items() if report and (report["missing"] or report["corrupt"])]
+    if args.repair and damaged:
+        for job in damaged:
+            repair_job(job, dest, reports[job]["missing"] + reports[job]["corrupt"], text_callback)
+        if "bandwidth" in settings:
+            mirror_util.BANDWIDTH.configure(settings["bandwidth"])
+        print(f"Réparation : {' '.join(mirror_util.job_spec(job) for job in damaged)}", file=sys.stderr)
+        mirror_util.run_jobs(damaged, dest, rsync_user,
+                             max_workers=settings.getint("workers", mirror_util.DEFAULT_MAX_WORKERS),
+                             per_host_limit=settings.getint("per_host_limit", mirror_util.DEFAULT_PER_HOST_LIMIT),
+                             text_callback=text_callback, job_options={job: job_options[job] for job in damaged},
+                             journal=mirror_util.JobJournal())
+        reports.update(_verify_all(damaged, dest, args.workers, text_callback))
+    if any(report is None or report["missing"] or report["corrupt"] for report in reports.values()):
+        return mirror_util.EXIT_JOB_FAILED
+    return mirror_util.EXIT_OK
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,4 +1,4 @@
-from PyQt5.QtWidgets import QPushButton, QLineEdit, QComboBox, QLabel
+from PyQt5.QtWidgets import QPushButton, QLineEdit, QComboBox, QLabel, QSpinBox
 
 def create_button(text, callback, object_name=None,width=300, height=30):
     button = QPushButton(text)
@@ -24,6 +24,10 @@ def create_dropdown(items, callback, width=300, height=30):
 
 def create_label(text):
     return QLabel(text)
-    
-
 
+def create_spinbox(minimum, maximum, value, width=60, height=30):
+    spinbox = QSpinBox()
+    spinbox.setRange(minimum, maximum)
+    spinbox.setValue(value)
+    spinbox.setFixedSize(width, height)
+    return spinbox